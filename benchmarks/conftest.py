@@ -0,0 +1,129 @@
+"""Benchmark fixtures: time per operation with pytest-benchmark, allocations with tracemalloc.
+
+Each benchmark passes the operation to the bench fixture, which measures the
+memory allocated per operation and compares it to the baseline in
+allocations.json. Allocations barely depend on the machine, so the baseline
+is kept in the repository and its changes show up in review; rewrite it with
+--update-allocations. The time per operation is measured only if
+pytest-benchmark is installed, see the README.
+"""
+
+import os
+import sys
+import json
+import warnings
+import tracemalloc
+import statistics
+import pytest
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "allocations.json")
+# an operation may allocate this much more than its baseline
+TOLERANCE = 0.1
+SLACK_BYTES = 256
+# object sizes differ between Python versions
+PYTHON_VERSION = "{}.{}".format(*sys.version_info[:2])
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--update-allocations",
+        action="store_true",
+        help="Write the measured allocations per operation to benchmarks/allocations.json.",
+    )
+
+
+def pytest_configure(config):
+    config.allocations = {}
+
+
+def pytest_sessionfinish(session):
+    config = session.config
+    if not config.getoption("--update-allocations") or not config.allocations:
+        return
+    baseline = _load_baseline() or {}
+    baseline.update(config.allocations)
+    with open(BASELINE_FILE, "w") as fd:
+        json.dump({"python": PYTHON_VERSION, "allocations": baseline}, fd, indent=2, sort_keys=True)
+        fd.write("\n")
+
+
+def _load_baseline():
+    """The allocations per benchmark, if measured with this Python version"""
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as fd:
+        baseline = json.load(fd)
+    if baseline["python"] != PYTHON_VERSION:
+        return None
+    return baseline["allocations"]
+
+
+def measure_allocations(function, setup, rounds):
+    """The median peak of traced memory during one call of function, and the
+    memory still allocated after rounds calls, per call."""
+    args, kwargs = setup()
+    # fill caches and lazily created objects
+    function(*args, **kwargs)
+    calls = [setup() for __ in range(2 * rounds)]
+    peaks = []
+    tracemalloc.start()
+    try:
+        # without any bookkeeping between the calls, which would count as retained
+        start = tracemalloc.get_traced_memory()[0]
+        for args, kwargs in calls[:rounds]:
+            function(*args, **kwargs)
+        retained = tracemalloc.get_traced_memory()[0] - start
+        for args, kwargs in calls[rounds:]:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function(*args, **kwargs)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return {
+        "peak_bytes": round(statistics.median(peaks)),
+        "retained_bytes": max(0, retained // rounds),
+    }
+
+
+def _check_allocations(name, allocations):
+    baselines = _load_baseline()
+    if baselines is None:
+        warnings.warn("the allocation baseline was measured with another Python version")
+        return
+    baseline = baselines.get(name)
+    if baseline is None:
+        pytest.fail("no allocation baseline for {}, run with --update-allocations".format(name))
+    for key, value in allocations.items():
+        if value > baseline[key] * (1 + TOLERANCE) + SLACK_BYTES:
+            pytest.fail("{} of {} bytes exceed the baseline of {} bytes".format(key, value, baseline[key]))
+
+
+@pytest.fixture
+def bench(request):
+    """Benchmark function(*args), or function(*args, **kwargs) with the arguments
+    returned by setup() for each call, which is not measured."""
+
+    def run(function, *args, setup=None, rounds=200):
+        allocations = measure_allocations(function, setup or (lambda: (args, {})), rounds)
+        name = request.node.nodeid
+        if request.config.getoption("--update-allocations"):
+            request.config.allocations[name] = allocations
+        else:
+            _check_allocations(name, allocations)
+        if pytest_benchmark is None:
+            return
+        benchmark = request.getfixturevalue("benchmark")
+        benchmark.extra_info.update(allocations)
+        if setup is None:
+            benchmark(function, *args)
+        else:
+            benchmark.pedantic(function, setup=setup, rounds=rounds, warmup_rounds=10)
+
+    return run
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Compare the ingest encodings by bytes on the wire and serialization CPU per 1,000 samples.
+
+Run from the repository root, which puts the clairttn package on the path:
+python3 -m benchmarks.encoding
+"""
+
+import json
+import time
+import random
+import click
+import jsonapi_requests as jarequests
+import clairttn.ers as ers
+import clairttn.encoding as encoding
+import clairttn.sinks as sinks
+
+
+def _records(sample_count, node_count):
+    rng = random.Random(0)
+    node_ids = [str(ers.ErsDeviceUUID(rng.getrandbits(64).to_bytes(8, "big"))) for __ in range(node_count)]
+    timestamp_s = 1632220557
+    records = []
+    for i in range(sample_count):
+        records.append(sinks.SampleRecord(node_ids[i % node_count], None, {
+            "timestamp_s": timestamp_s + i * 300 // node_count,
+            "co2_ppm": rng.randint(400, 2000),
+            "temperature_celsius": round(rng.uniform(18, 26), 1),
+            "rel_humidity_percent": rng.randint(30, 60),
+        }))
+    return records
+
+
+def _json_api_bodies(records):
+    # the request bodies of jsonapi_requests, serialized like requests does
+    return [
+        json.dumps({"data": jarequests.JsonApiObject(
+            type="Sample",
+            attributes=record.attributes,
+            relationships={"node": {"data": {"type": "Node", "id": record.node_id}}},
+        ).as_data()}).encode("utf8")
+        for record in records
+    ]
+
+
+def _compact_bodies(records, batch_size, body_encoding, compression):
+    return [
+        encoding.encode_batch(records[i:i + batch_size], body_encoding, compression)[0]
+        for i in range(0, len(records), batch_size)
+    ]
+
+
+def _measure(encode, repetitions):
+    t_start = time.process_time()
+    for __ in range(repetitions):
+        bodies = encode()
+    return bodies, (time.process_time() - t_start) / repetitions
+
+
+@click.command()
+@click.option('-n', '--samples', type=int, default=10000, show_default=True)
+@click.option('--nodes', type=int, default=100, show_default=True)
+@click.option('-b', '--batch-size', type=int, default=100, show_default=True,
+              help='Samples per request of the compact encodings, see BufferedSink.')
+@click.option('-r', '--repetitions', type=int, default=5, show_default=True)
+def main(samples, nodes, batch_size, repetitions):
+    records = _records(samples, nodes)
+    candidates = [("json:api", lambda: _json_api_bodies(records))]
+    for body_encoding in encoding.CONTENT_TYPES:
+        for compression in encoding.COMPRESSIONS:
+            candidates.append((
+                "{}+{}".format(body_encoding, compression),
+                lambda e=body_encoding, c=compression: _compact_bodies(records, batch_size, e, c),
+            ))
+
+    click.echo("per 1,000 samples, {} nodes, {} samples per compact request".format(nodes, batch_size))
+    click.echo("{:<18} {:>9} {:>12} {:>10}".format("encoding", "requests", "bytes", "CPU ms"))
+    per_thousand = 1000 / samples
+    for name, encode in candidates:
+        try:
+            bodies, cpu_seconds = _measure(encode, repetitions)
+        except ImportError as e:
+            click.echo("{:<18} skipped: {}".format(name, e))
+            continue
+        click.echo("{:<18} {:>9.0f} {:>12.0f} {:>10.2f}".format(
+            name,
+            len(bodies) * per_thousand,
+            sum(len(body) for body in bodies) * per_thousand,
+            cpu_seconds * 1000 * per_thousand,
+        ))
+
+
+if __name__ == '__main__':
+    main()
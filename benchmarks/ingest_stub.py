@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""A stand-in for the ingest endpoint of the managair, which accepts every sample.
+
+Prints the port it listens on, then serves until interrupted:
+
+python benchmarks/ingest_stub.py --port 8888
+clair-ttn -m ers-forward -k access-key.txt -a http://localhost:8888/ingest/v1/
+"""
+
+import json
+import http.server
+import click
+
+
+class _IngestHandler(http.server.BaseHTTPRequestHandler):
+    # keep the connections of the requests sessions alive
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        response = json.dumps({"data": dict(body["data"], id="1")}).encode("utf8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@click.command()
+@click.option('-p', '--port', type=int, default=0, show_default=True, help='0 lets the OS choose.')
+def main(port):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _IngestHandler)
+    click.echo(server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""Measure the uplink throughput of the worker processes, see clair-ttn --processes.
+
+Each uplink is decoded and serialized into the JSON:API request body, without
+sending it, so that the benchmark measures the CPU bound part of forwarding.
+The speedup is relative to handling the uplinks in the submitting thread and
+cannot exceed the number of cores.
+
+Run from the repository root, which puts the clairttn package on the path:
+python3 -m benchmarks.process_pool
+"""
+
+import os
+import json
+import time
+import datetime as dt
+import click
+import jsonapi_requests as jarequests
+import clairttn.ers as ers
+import clairttn.node_handler as node_handler
+import clairttn.process_pool as process_pool
+import clairttn.ttn_handler as ttn_handler
+import clairttn.types as types
+
+
+# five measurements per uplink, as sent by an ERS CO2 sensor
+PAYLOAD = bytes.fromhex("0100e202290602c7" * 5)
+
+
+class _DecodingHandler:
+    def __init__(self):
+        self.bodies = 0
+
+    def handle(self, app_id, rx_message, trace_context):
+        for sample in ers.decode_payload(rx_message.raw_data, rx_message.rx_datetime):
+            json.dumps({"data": jarequests.JsonApiObject(
+                type="Sample",
+                attributes=node_handler._sample_attributes(sample),
+                relationships={"node": {"data": {"type": "Node", "id": rx_message.device_id}}},
+            ).as_data()})
+            self.bodies += 1
+
+    def close(self):
+        pass
+
+
+def _create_decoding_handler():
+    return _DecodingHandler()
+
+
+def _rx_messages(count, devices):
+    rx_datetime = dt.datetime.now(dt.timezone.utc)
+    return [
+        ttn_handler.RxMessage(
+            raw_data=PAYLOAD,
+            device_id="ers-{}".format(i % devices),
+            device_eui=(i % devices).to_bytes(8, "big"),
+            rx_datetime=rx_datetime,
+            rx_port=5,
+            mcs=types.LoRaWanMcs.SF9BW125,
+            f_cnt=i // devices,
+        )
+        for i in range(count)
+    ]
+
+
+def _inline(rx_messages):
+    handler = _create_decoding_handler()
+    t_start = time.perf_counter()
+    for rx_message in rx_messages:
+        handler.handle("app", rx_message, None)
+    return time.perf_counter() - t_start
+
+
+def _pooled(rx_messages, processes, batch_size):
+    pool = process_pool.ProcessPool(_create_decoding_handler, processes, batch_size)
+    pool.start()
+    # let the processes import their modules before the clock starts
+    time.sleep(2)
+    t_start = time.perf_counter()
+    for rx_message in rx_messages:
+        pool.submit("app", rx_message)
+    pool.stop()
+    return time.perf_counter() - t_start
+
+
+@click.command()
+@click.option('-n', '--uplinks', type=int, default=20000, show_default=True)
+@click.option('--devices', type=int, default=500, show_default=True)
+@click.option('-p', '--max-processes', type=int, default=os.cpu_count(), show_default=True)
+@click.option('-b', '--batch-size', type=int, default=64, show_default=True)
+def main(uplinks, devices, max_processes, batch_size):
+    rx_messages = _rx_messages(uplinks, devices)
+    click.echo("{} uplinks of {} devices, {} cores".format(uplinks, devices, os.cpu_count()))
+    click.echo("{:<12} {:>12} {:>8}".format("processes", "uplinks/s", "speedup"))
+    baseline = uplinks / _inline(rx_messages)
+    click.echo("{:<12} {:>12.0f} {:>8.2f}".format("inline", baseline, 1.0))
+    for processes in range(1, max_processes + 1):
+        throughput = uplinks / _pooled(rx_messages, processes, batch_size)
+        click.echo("{:<12} {:>12.0f} {:>8.2f}".format(processes, throughput, throughput / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import datetime as dt
+import pytest
+import clairttn.types as types
+import clairttn.ers as ers
+import clairttn.clairchen as clairchen
+import clairttn.oy1012 as oy1012
+import uplinks
+
+
+RX_DATETIME = dt.datetime(2021, 9, 20, 12, 25, 52, tzinfo=dt.timezone.utc)
+DEVICE_EUI = bytes.fromhex("a81758fffe052b0f")
+
+
+@pytest.mark.parametrize("mcs", list(types.LoRaWanMcs), ids=lambda mcs: mcs.name)
+def test_ers(bench, mcs):
+    payload = uplinks.ers_payload(mcs)
+    assert len(ers.decode_payload(payload, RX_DATETIME)) == ers.PROTOCOL_PAYLOAD_SPECIFICATION[mcs].measurement_count
+    bench(ers.decode_payload, payload, RX_DATETIME)
+
+
+@pytest.mark.parametrize("mcs", list(types.LoRaWanMcs), ids=lambda mcs: mcs.name)
+def test_clairchen(bench, mcs):
+    payload = uplinks.clairchen_payload(mcs)
+    assert len(clairchen.decode_payload(payload, RX_DATETIME, mcs)) == (
+        clairchen.PROTOCOL_PAYLOAD_SPECIFICATION[mcs].measurement_count
+    )
+    bench(clairchen.decode_payload, payload, RX_DATETIME, mcs)
+
+
+def test_oy1012(bench):
+    # OY1012 devices send a single measurement regardless of the MCS
+    assert len(oy1012.decode_payload(uplinks.OY1012_PAYLOAD, RX_DATETIME)) == 1
+    bench(oy1012.decode_payload, uplinks.OY1012_PAYLOAD, RX_DATETIME)
+
+
+@pytest.mark.parametrize("uuid_class", [
+    ers.ErsDeviceUUID,
+    clairchen.ClairchenDeviceUUID,
+    oy1012.Oy1012DeviceUUID,
+], ids=lambda uuid_class: uuid_class.__name__)
+def test_device_uuid(bench, uuid_class):
+    bench(lambda: str(uuid_class(DEVICE_EUI)))
@@ -0,0 +1,26 @@
+import json
+import pytest
+import clairttn.types as types
+import clairttn.ttn_handler as ttn_handler
+import uplinks
+
+
+@pytest.mark.parametrize("mcs", [types.LoRaWanMcs.SF7BW125, types.LoRaWanMcs.SF12BW125], ids=lambda mcs: mcs.name)
+def test_v3(bench, mcs):
+    handler = ttn_handler.TtnV3Handler("clair-benchmark", "dummy")
+    ttn_rxmsg = uplinks.v3_uplink(uplinks.ers_payload(mcs), mcs=mcs)
+    assert handler._extract_rx_message(ttn_rxmsg).mcs == mcs
+    bench(handler._extract_rx_message, ttn_rxmsg)
+
+
+def test_v2(bench):
+    handler = ttn_handler.TtnV2Handler("clair-benchmark", "dummy")
+    ttn_rxmsg = uplinks.v2_uplink(uplinks.ers_payload(types.LoRaWanMcs.SF9BW125))
+    assert handler._extract_rx_message(ttn_rxmsg).mcs == types.LoRaWanMcs.SF9BW125
+    bench(handler._extract_rx_message, ttn_rxmsg)
+
+
+def test_v3_json_and_extract(bench):
+    handler = ttn_handler.TtnV3Handler("clair-benchmark", "dummy")
+    mqtt_payload = json.dumps(uplinks.v3_uplink(uplinks.ers_payload(types.LoRaWanMcs.SF9BW125))).encode("utf8")
+    bench(lambda: handler._extract_rx_message(json.loads(mqtt_payload.decode("utf8"))))
@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import itertools
+import subprocess
+import pytest
+import paho.mqtt.client as mqtt
+import clairttn.types as types
+import clairttn.ers as ers
+import clairttn.ttn_handler as ttn_handler
+import clairttn.node_handler as node_handler
+import uplinks
+
+
+@pytest.fixture(scope="module")
+def api_root():
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "ingest_stub.py")],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        port = int(stub.stdout.readline())
+        yield "http://127.0.0.1:{}/ingest/v1/".format(port)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+def _mqtt_messages(mcs):
+    payload = uplinks.ers_payload(mcs)
+    for f_cnt in itertools.count():
+        message = mqtt.MQTTMessage(topic=b"v3/clair-benchmark@ttn/devices/ers-co2-sample1/up")
+        message.payload = json.dumps(uplinks.v3_uplink(payload, f_cnt=f_cnt, mcs=mcs)).encode("utf8")
+        yield message
+
+
+@pytest.mark.parametrize("mcs", [types.LoRaWanMcs.SF7BW125, types.LoRaWanMcs.SF12BW125], ids=lambda mcs: mcs.name)
+def test_on_message(bench, api_root, mcs):
+    """An uplink from the MQTT client thread until the backend acknowledged its samples"""
+    ttn_client = ttn_handler.TtnV3Handler("clair-benchmark", "dummy")
+    handler = node_handler.ErsForwardingHandler(ttn_client, api_root)
+    messages = _mqtt_messages(mcs)
+    samples = handler.metrics.samples
+
+    before = samples.value
+    ttn_client._on_message(None, None, next(messages))
+    assert samples.value - before == ers.PROTOCOL_PAYLOAD_SPECIFICATION[mcs].measurement_count
+
+    bench(ttn_client._on_message, setup=lambda: ((None, None, next(messages)), {}), rounds=100)
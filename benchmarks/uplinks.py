@@ -0,0 +1,115 @@
+"""Payloads and TTN uplink messages of the benchmarks"""
+
+import base64
+import clairttn.types as types
+import clairttn.ers as ers
+import clairttn.clairchen as clairchen
+
+
+def ers_payload(mcs):
+    """An ERS payload of the number of measurements sent at mcs, newest first"""
+    with_temperature = ers.PARAMETER_SETS[mcs].temperature_period
+    group = "0100e2" "0229" "0602c7" if with_temperature else "0602c7"
+    return bytes.fromhex(group * ers.PROTOCOL_PAYLOAD_SPECIFICATION[mcs].measurement_count)
+
+
+def clairchen_payload(mcs):
+    """A Clairchen payload of the number of measurements sent at mcs"""
+    count = clairchen.PROTOCOL_PAYLOAD_SPECIFICATION[mcs].measurement_count
+    return bytes([count - 1]) + bytes.fromhex("1be4") * count
+
+
+OY1012_PAYLOAD = bytes.fromhex("3e441d021b")
+
+
+def v3_uplink(payload, device_id="ers-co2-sample1", dev_eui="A81758FFFE052B0F", f_cnt=2621,
+              mcs=types.LoRaWanMcs.SF9BW125):
+    """An uplink message of the TTN v3 MQTT API, as relayed via Packet Broker"""
+    return {
+        "end_device_ids": {
+            "device_id": device_id,
+            "application_ids": {"application_id": "clair-benchmark"},
+            "dev_eui": dev_eui,
+            "join_eui": "70B3D57ED00347BA",
+            "dev_addr": "260BC3D6",
+        },
+        "correlation_ids": [
+            "as:up:01FG1JPY8VGZWRTHPJGY4Y41VM",
+            "ns:uplink:01FG1JPY2DYSQ25A54MTNHWRXZ",
+            "pba:conn:up:01FG16560GWJ3GWMXXXEH02WCH",
+            "pba:uplink:01FG1JPY2AJ2PQ0YCFKYT6ZGXF",
+            "rpc:/ttn.lorawan.v3.GsNs/HandleUplink:01FG1JPY2DSWV5XCSEJ1M92T4J",
+            "rpc:/ttn.lorawan.v3.NsAs/HandleUplink:01FG1JPY8VY8M6M3FH1RH5MJQ0",
+        ],
+        "received_at": "2021-09-20T12:25:53.180595270Z",
+        "uplink_message": {
+            "session_key_id": "AXuyqD7znKml0qbj/8Y0QQ==",
+            "f_port": 5,
+            "f_cnt": f_cnt,
+            "frm_payload": base64.b64encode(payload).decode("ascii"),
+            "rx_metadata": [
+                {
+                    "gateway_ids": {"gateway_id": "packetbroker"},
+                    "packet_broker": {
+                        "message_id": "01FG1JPY2AJ2PQ0YCFKYT6ZGXF",
+                        "forwarder_net_id": "000013",
+                        "forwarder_tenant_id": "ttnv2",
+                        "forwarder_cluster_id": "ttn-v2-eu-3",
+                        "forwarder_gateway_eui": "C0EE40FFFF293507",
+                        "forwarder_gateway_id": "eui-c0ee40ffff293507",
+                        "home_network_net_id": "000013",
+                        "home_network_tenant_id": "ttn",
+                        "home_network_cluster_id": "ttn-eu1",
+                    },
+                    "rssi": -121,
+                    "channel_rssi": -121,
+                    "snr": -10.2,
+                    "location": {"latitude": 52.48453486, "longitude": 13.34653402, "altitude": 46},
+                    "uplink_token": "eyJnIjoiWlhsS2FHSkhZMmxQYVVwQ1RWUkpORkl3VGs1VE1XTnBURU5LYkdKdFRXbFBhVXBDVFZSSk5GSXdUazVKYVhkcFlWaFphVTlwU1RCU1Z6RXdaVzEwWVZOc2FIWlhWRVpHVVd0d05FbHBkMmxrUjBadVNXcHZhVlJJU2paaWJFSnhZV3hrTlUxc1pGWlJNMEpWVDFWS1JWUXlaRUprZVVvNUxtTjVWbGt6Y3pocmJGZFdja1pYTjJsVGJXUnZkMmN1T1VocmNYRjVWbk5ZVVZsTVh6SkNXaTVOV1dGblQwWkRUMkpUU1VodWQwTkZjMUZ3VUZseVprNVVXRlZvVVZSWlJVeFhVM3BoVWswM01qZEhWa016ZEhOdWJqVnhVV2RSVlVKRk5WUlFTVWR1VkdwbFJHMVVTVEJhVUVFelRWVmFkV0kxU1VWUE5qaHJSemM0ZDJsSVNEQTRXRTVvVTNoa01VaFBVako1ZVY5cFNFOUZOMjFGTW5BNVEzcHlXa1owZDNscVdTMXhUamhXUTE5aU1rYzNVVE5FVEMxVk1XOHhhazFYTFRkVlZsOU1aVGswY0VGSlpFbFNVVWRHVVRSbkxsQjJORXRCT0RJMlpFOUNXSFpzU0hFNFUyRlhZVkU9IiwiYSI6eyJmbmlkIjoiMDAwMDEzIiwiZnRpZCI6InR0bnYyIiwiZmNpZCI6InR0bi12Mi1ldS0zIn19",
+                }
+            ],
+            "settings": {
+                "data_rate": {"lora": {"bandwidth": 125000, "spreading_factor": 9}},
+                "data_rate_index": types.DATA_RATE_INDEX.index(mcs),
+                "coding_rate": "4/5",
+                "frequency": "867100000",
+            },
+            "received_at": "2021-09-20T12:25:52.973476075Z",
+            "consumed_airtime": "0.185344s",
+            "network_ids": {"net_id": "000013", "tenant_id": "ttn", "cluster_id": "ttn-eu1"},
+        },
+    }
+
+
+def v2_uplink(payload, device_id="ers-co2-sample1", hardware_serial="A81758FFFE052B0F", counter=2621):
+    """An uplink message of the TTN v2 MQTT API"""
+    return {
+        "app_id": "clair-benchmark",
+        "dev_id": device_id,
+        "hardware_serial": hardware_serial,
+        "port": 5,
+        "counter": counter,
+        "payload_raw": base64.b64encode(payload).decode("ascii"),
+        "metadata": {
+            "time": "2021-09-20T12:25:52.973476075Z",
+            "frequency": 867.1,
+            "modulation": "LORA",
+            "data_rate": "SF9BW125",
+            "airtime": 185344000,
+            "coding_rate": "4/5",
+            "gateways": [
+                {
+                    "gtw_id": "eui-c0ee40ffff293507",
+                    "timestamp": 2395571796,
+                    "time": "2021-09-20T12:25:52.948394Z",
+                    "channel": 3,
+                    "rssi": -121,
+                    "snr": -10.2,
+                    "rf_chain": 0,
+                    "latitude": 52.48453,
+                    "longitude": 13.346534,
+                    "altitude": 46,
+                }
+            ],
+        },
+    }
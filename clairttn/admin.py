@@ -0,0 +1,111 @@
+import logging
+import threading
+import http.server
+import urllib.parse
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.profiling as profiling
+import clairttn.device_index as device_index
+import clairttn.negative_cache as negative_cache
+import clairttn.dead_letter as dead_letter
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    # set on the subclass created by AdminServer.start()
+    admin_server = None
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        route = self.admin_server.get_route(method, url.path)
+        if route is None:
+            self._respond(404, "text/plain; charset=utf-8", b"not found\n")
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            status, content_type, body = route(query)
+        except Exception as e:
+            logging.error("exception in admin endpoint %s: %s", url.path, e)
+            self._respond(500, "text/plain; charset=utf-8", b"internal error\n")
+            return
+        self._respond(status, content_type, body)
+
+    def _respond(self, status, content_type, body):
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("admin endpoint: " + format, *args)
+
+
+class AdminServer:
+    """A lightweight HTTP server thread exposing operational endpoints
+
+    Routes are callables which take the parsed query parameters and return a
+    tuple of HTTP status, content type and body.
+    """
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._routes = {}
+        self._http_server = None
+        self._thread = None
+        self.add_route("/metrics", _metrics_route)
+        self.add_route("/livez", health.liveness_route)
+        self.add_route("/readyz", health.readiness_route)
+        self.add_route("/latency", metrics.end_to_end_latency_route)
+        self.add_route("/devices/silent", device_index.silent_devices_route)
+        self.add_route("/devices/last-seen", device_index.last_seen_route)
+        self.add_route("/nodes/rejected", negative_cache.rejected_nodes_route)
+        self.add_route(
+            "/nodes/invalidate", negative_cache.invalidate_route, methods=("POST",)
+        )
+        self.add_route("/dead-letters", dead_letter.dead_letters_route)
+        self.add_route("/debug/profile", profiling.profile_route, methods=("POST",))
+
+    def add_route(self, path, route, methods=("GET",)):
+        for method in methods:
+            self._routes[(method, path)] = route
+
+    def get_route(self, method, path):
+        return self._routes.get((method, path))
+
+    @property
+    def port(self):
+        """The port the server listens on, which is chosen by the OS if configured as 0."""
+        return self._http_server.server_address[1]
+
+    def start(self):
+        handler_class = type(
+            "AdminRequestHandler", (_RequestHandler,), {"admin_server": self}
+        )
+        self._http_server = http.server.ThreadingHTTPServer(
+            (self._host, self._port), handler_class
+        )
+        self._http_server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._http_server.serve_forever, name="admin-server", daemon=True
+        )
+        self._thread.start()
+        logging.info("Admin endpoint listening on %s:%d", self._host, self.port)
+
+    def stop(self):
+        if self._http_server:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            logging.debug("Admin endpoint stopped.")
+
+
+def _metrics_route(_query, snapshots=()):
+    return 200, metrics.CONTENT_TYPE, metrics.render(snapshots)
@@ -0,0 +1,278 @@
+import json
+import logging
+import threading
+import collections
+import urllib.parse
+from collections import namedtuple
+import requests
+import paho.mqtt.client as mqtt
+import clairttn.metrics as metrics
+import clairttn.sinks as sinks
+
+
+VentilationEvent = namedtuple('VentilationEvent', [
+    'node_id',
+    'device_id',
+    'timestamp_s',
+    'co2_ppm',
+    'level',
+    'previous_level',
+    'threshold_ppm'])
+VentilationEvent.__doc__ = """The CO2 concentration of a node crossed a threshold: level is the number
+of thresholds exceeded now, previous_level before, and threshold_ppm the
+highest threshold crossed, upwards if level > previous_level"""
+
+
+class RollingWindow:
+    """Statistics of the CO2 samples of a node within the last window seconds
+
+    Each sample updates running sums, so adding a sample and evicting the
+    samples which left the window takes constant time (amortized), no matter
+    how many samples the window holds. A sample counts as above a threshold
+    until the next sample of the node. Samples older than the latest one are
+    ignored.
+    """
+
+    def __init__(self, window, thresholds):
+        self.window = window
+        self.thresholds = thresholds
+        # (timestamp, co2, seconds above each threshold since the previous sample)
+        self._samples = collections.deque()
+        # the candidates for the maximum, decreasing in CO2
+        self._maxima = collections.deque()
+        self._origin = None
+        self._sum_co2 = 0.0
+        self._sum_t = 0.0
+        self._sum_tt = 0.0
+        self._sum_t_co2 = 0.0
+        self._seconds_above = [0.0] * len(thresholds)
+        self.latest = None
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, timestamp, co2):
+        if self.latest is not None and timestamp < self.latest[0]:
+            return False
+        if not self._samples:
+            # keep the time offsets of the trend small
+            self._origin = timestamp
+        if self.latest is None:
+            above = (0.0,) * len(self.thresholds)
+        else:
+            interval = min(timestamp - self.latest[0], self.window)
+            above = tuple(interval if self.latest[1] >= threshold else 0.0 for threshold in self.thresholds)
+        self._samples.append((timestamp, co2, above))
+        t = timestamp - self._origin
+        self._sum_co2 += co2
+        self._sum_t += t
+        self._sum_tt += t * t
+        self._sum_t_co2 += t * co2
+        for i, seconds in enumerate(above):
+            self._seconds_above[i] += seconds
+        while self._maxima and self._maxima[-1][1] <= co2:
+            self._maxima.pop()
+        self._maxima.append((timestamp, co2))
+        self.latest = (timestamp, co2)
+        self._evict(timestamp - self.window)
+        return True
+
+    def _evict(self, oldest):
+        while self._samples[0][0] < oldest:
+            timestamp, co2, above = self._samples.popleft()
+            t = timestamp - self._origin
+            self._sum_co2 -= co2
+            self._sum_t -= t
+            self._sum_tt -= t * t
+            self._sum_t_co2 -= t * co2
+            for i, seconds in enumerate(above):
+                self._seconds_above[i] -= seconds
+            if self._maxima[0][0] == timestamp:
+                self._maxima.popleft()
+
+    @property
+    def mean(self):
+        return self._sum_co2 / len(self._samples)
+
+    @property
+    def max(self):
+        return self._maxima[0][1]
+
+    @property
+    def seconds_above(self):
+        """The seconds above each threshold, within the window"""
+        return {threshold: round(seconds) for threshold, seconds in zip(self.thresholds, self._seconds_above)}
+
+    @property
+    def trend(self):
+        """The least squares slope of the CO2 concentration in ppm per hour, None for less than two samples"""
+        n = len(self._samples)
+        variance = n * self._sum_tt - self._sum_t ** 2
+        if n < 2 or variance <= 0:
+            return None
+        return (n * self._sum_t_co2 - self._sum_t * self._sum_co2) / variance * 3600
+
+    def summary(self):
+        trend = self.trend
+        return {
+            "samples": len(self._samples),
+            "latest_timestamp_s": self.latest[0],
+            "latest_co2_ppm": self.latest[1],
+            "mean_co2_ppm": round(self.mean, 1),
+            "max_co2_ppm": self.max,
+            "seconds_above": self.seconds_above,
+            "trend_ppm_per_hour": None if trend is None else round(trend, 1),
+        }
+
+
+class _NodeState:
+    __slots__ = ("window", "level")
+
+    def __init__(self, window):
+        self.window = window
+        self.level = 0
+
+
+class Analytics:
+    """Rolling CO2 statistics per node and ventilation alerts, fed like an output sink
+
+    An alert level is raised as soon as the CO2 concentration reaches its
+    threshold, and lowered only once it has fallen hysteresis ppm below it
+    again, so that readings around a threshold do not raise an event with
+    every sample. The events are handed to the event sinks, which send them
+    from threads of their own. At most capacity nodes are tracked; the node
+    which has not sent samples for the longest time is evicted.
+    """
+
+    def __init__(self, window=3600, thresholds=(1000, 1400), hysteresis=100, capacity=65536):
+        self.name = "analytics"
+        self.window = window
+        self.thresholds = tuple(sorted(thresholds))
+        self.hysteresis = hysteresis
+        self.capacity = capacity
+        self.event_sinks = []
+        self._nodes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, record):
+        co2 = record.attributes.get("co2_ppm")
+        if co2 is None:
+            return
+        with self._lock:
+            node = self._nodes.get(record.node_id)
+            if node is None:
+                node = self._nodes[record.node_id] = _NodeState(RollingWindow(self.window, self.thresholds))
+                if len(self._nodes) > self.capacity:
+                    self._nodes.popitem(last=False)
+            else:
+                self._nodes.move_to_end(record.node_id)
+            if not node.window.add(record.attributes["timestamp_s"], co2):
+                return
+            previous_level = node.level
+            node.level = self._level(previous_level, co2)
+        if node.level != previous_level:
+            self._emit(VentilationEvent(
+                record.node_id,
+                record.device_id,
+                record.attributes["timestamp_s"],
+                co2,
+                node.level,
+                previous_level,
+                self.thresholds[max(node.level, previous_level) - 1],
+            ))
+
+    def _level(self, level, co2):
+        while level < len(self.thresholds) and co2 >= self.thresholds[level]:
+            level += 1
+        while level > 0 and co2 < self.thresholds[level - 1] - self.hysteresis:
+            level -= 1
+        return level
+
+    def _emit(self, event):
+        logging.info(
+            "CO2 of node %s %s %d ppm: %d ppm",
+            event.node_id,
+            "exceeded" if event.level > event.previous_level else "fell below",
+            event.threshold_ppm,
+            event.co2_ppm,
+        )
+        metrics.VENTILATION_EVENTS.labels(
+            "raised" if event.level > event.previous_level else "cleared"
+        ).inc()
+        for event_sink in self.event_sinks:
+            event_sink.submit(event)
+
+    def statistics(self, node_id=None):
+        """The rolling statistics and alert level of the node, or of all nodes"""
+        with self._lock:
+            nodes = (
+                [(node_id, self._nodes[node_id])] if node_id in self._nodes
+                else [] if node_id else list(self._nodes.items())
+            )
+            return {
+                node_id: dict(node.window.summary(), alert_level=node.level)
+                for node_id, node in nodes
+            }
+
+    def statistics_route(self, query):
+        statistics = self.statistics(query.get("node"))
+        if query.get("node") and not statistics:
+            return 404, "text/plain; charset=utf-8", "unknown node\n"
+        return 200, "application/json", json.dumps(statistics)
+
+    def start(self):
+        for event_sink in self.event_sinks:
+            event_sink.start()
+
+    def stop(self, timeout=None):
+        stopped = True
+        for event_sink in self.event_sinks:
+            stopped = event_sink.stop(timeout) and stopped
+        return stopped
+
+
+class WebhookSink:
+    """Posts batches of ventilation events as a JSON array to a URL"""
+
+    def __init__(self, url):
+        self.name = "webhook:" + url
+        self._url = url
+        self._session = requests.Session()
+
+    def write(self, events):
+        response = self._session.post(
+            self._url, json=[event._asdict() for event in events], timeout=10
+        )
+        response.raise_for_status()
+
+    def close(self):
+        self._session.close()
+
+
+class MqttEventSink(sinks.MqttSink):
+    """Publishes ventilation events as JSON to <topic>/<node id> on an MQTT broker"""
+
+    def write(self, events):
+        for event in events:
+            message = self._client.publish(
+                "{}/{}".format(self._topic, event.node_id), json.dumps(event._asdict()), qos=1
+            )
+            if message.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError("cannot publish to {}: {}".format(self.name, mqtt.error_string(message.rc)))
+
+
+def create_event_sink(spec):
+    """Create a sink for ventilation events from a URL:
+
+    http[s]://...                    a webhook
+    mqtt://<host>[:<port>]/<topic>   an MQTT broker
+    """
+    url_parts = urllib.parse.urlsplit(spec)
+    if url_parts.scheme in ("http", "https") and url_parts.hostname:
+        sink = WebhookSink(spec)
+    elif url_parts.scheme == "mqtt" and url_parts.hostname:
+        sink = MqttEventSink(url_parts.hostname, url_parts.port or 1883, url_parts.path.strip("/") or "clair/alerts")
+    else:
+        raise sinks.SinkException("invalid alert sink {}, expected a http(s):// or mqtt:// URL".format(spec))
+    # send the events within a fraction of a second
+    return sinks.BufferedSink(sink, batch_size=20, flush_interval=0.2, queue_size=1000)
@@ -0,0 +1,188 @@
+import json
+import time
+import queue
+import logging
+import sqlite3
+import threading
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.sinks as sinks
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sample (
+    node TEXT NOT NULL,
+    timestamp_s INTEGER NOT NULL,
+    co2_ppm REAL,
+    temperature_celsius REAL,
+    rel_humidity_percent REAL,
+    PRIMARY KEY (node, timestamp_s)
+) WITHOUT ROWID
+"""
+
+# the retention DELETE selects by timestamp across all nodes
+_INDEX = "CREATE INDEX IF NOT EXISTS sample_timestamp ON sample (timestamp_s)"
+
+_INSERT = """
+INSERT OR REPLACE INTO sample
+    (node, timestamp_s, co2_ppm, temperature_celsius, rel_humidity_percent)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+_QUERY = """
+SELECT timestamp_s, co2_ppm, temperature_celsius, rel_humidity_percent
+FROM sample
+WHERE node = ? AND timestamp_s >= ? AND timestamp_s < ?
+ORDER BY timestamp_s
+"""
+
+COLUMNS = ["node", "timestamp_s", "co2_ppm", "temperature_celsius", "rel_humidity_percent"]
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # WAL mode is crash safe with synchronous=NORMAL, only the last
+    # transactions may be lost on power failure
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def query_samples(path, node, after, before):
+    """Return the archived samples of the node with after <= timestamp < before as dicts."""
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        rows = connection.execute(_QUERY, (str(node), int(after), int(before))).fetchall()
+    finally:
+        connection.close()
+    return [dict(zip(COLUMNS, (str(node),) + row)) for row in rows]
+
+
+class SampleArchive:
+    """A local SQLite archive of all samples forwarded to the backend
+
+    Samples are keyed by node and timestamp, so a range query for one node is
+    a single index range scan. add() only enqueues a sample; a writer thread
+    inserts them in batches of up to batch_size rows per transaction, and
+    drops a batch which still fails after WRITE_ATTEMPTS attempts. Samples
+    older than the retention period (in seconds) are deleted and the freed
+    pages returned to the file system every compaction_interval seconds.
+    """
+
+    QUEUE_NAME = "archive"
+    WRITE_ATTEMPTS = 3
+
+    def __init__(
+        self,
+        path,
+        retention=None,
+        batch_size=500,
+        flush_interval=1.0,
+        compaction_interval=3600.0,
+        queue_size=100000,
+    ):
+        self.path = path
+        self.retention = retention
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._compaction_interval = compaction_interval
+        self._queue = sinks.BatchQueue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._dropped = 0
+
+        connection = sqlite3.connect(path)
+        # incremental vacuum only takes effect if set before the table is created
+        connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.close()
+        connection = _connect(path)
+        with connection:
+            connection.execute(_SCHEMA)
+            connection.execute(_INDEX)
+        connection.close()
+
+        metrics.QUEUE_DEPTH.labels(self.QUEUE_NAME).set_function(self._queue.qsize)
+        health.HEALTH.register_queue(self.QUEUE_NAME, self._queue.qsize, queue_size)
+        self._thread = threading.Thread(target=self._run, name="sample-archive", daemon=True)
+        self._thread.start()
+
+    def add(self, node, sample):
+        """Enqueue a decoded sample of the node (a device UUID) for archiving."""
+        row = (
+            str(node),
+            sample.timestamp.value,
+            sample.co2.value,
+            sample.temperature.value if sample.temperature else None,
+            sample.relative_humidity.value if sample.relative_humidity else None,
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # never hold up forwarding because of the archive
+            self._dropped += 1
+            if self._dropped % 1000 == 1:
+                logging.warning("sample archive queue full, %d samples dropped", self._dropped)
+
+    def query(self, node, after, before):
+        return query_samples(self.path, node, after, before)
+
+    def close(self):
+        """Write all pending samples and stop the writer thread."""
+        self._stop.set()
+        self._queue.wake_up()
+        self._thread.join()
+
+    def query_route(self, query):
+        try:
+            node = query["node"]
+            after = int(query.get("after", 0))
+            before = int(query.get("before", time.time() + 1))
+        except (KeyError, ValueError):
+            return 400, "text/plain; charset=utf-8", "expected node, after and before (epoch seconds)\n"
+        return 200, "application/json", json.dumps(self.query(node, after, before))
+
+    def _run(self):
+        connection = _connect(self.path)
+        next_compaction = time.monotonic()
+        try:
+            while not (self._stop.is_set() and self._queue.empty()):
+                batch = self._queue.next_batch(self._batch_size, self._flush_interval, self._stop)
+                if batch:
+                    self._write(connection, batch)
+                if time.monotonic() >= next_compaction:
+                    try:
+                        self._compact(connection)
+                    except sqlite3.Error as e:
+                        logging.error("sample archive compaction failed: %s", e)
+                    next_compaction = time.monotonic() + self._compaction_interval
+        except Exception as e:
+            logging.error("sample archive writer failed: %s", e)
+        finally:
+            connection.close()
+
+    def _write(self, connection, batch):
+        for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+            try:
+                with connection:
+                    connection.executemany(_INSERT, batch)
+                return
+            except sqlite3.Error as e:
+                if attempt == self.WRITE_ATTEMPTS:
+                    self._dropped += len(batch)
+                    logging.error("writing to the sample archive failed, %d samples dropped: %s",
+                                  len(batch), e)
+                    return
+                logging.warning("writing to the sample archive failed, retrying: %s", e)
+                # e.g. the database is locked by a long running query
+                time.sleep(self._flush_interval * attempt)
+
+    def _compact(self, connection):
+        if self.retention is None:
+            return
+        cutoff = int(time.time() - self.retention)
+        with connection:
+            deleted = connection.execute("DELETE FROM sample WHERE timestamp_s < ?", (cutoff,)).rowcount
+        if deleted:
+            # the pragma frees one page per result row step
+            connection.execute("PRAGMA incremental_vacuum").fetchall()
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logging.info("deleted %d archived samples older than %d", deleted, cutoff)
@@ -0,0 +1,187 @@
+import time
+import logging
+import threading
+import collections
+import datetime as dt
+import clairttn.storage as storage
+import clairttn.metrics as metrics
+
+
+Gap = collections.namedtuple('Gap', [
+    'device_id',
+    'first_f_cnt',
+    'last_f_cnt',
+    'after',
+    'before'])
+Gap.__doc__ = """The frame counters of uplinks of a device which were lost between two
+received uplinks, and the reception times of those uplinks"""
+
+
+class _CounterState:
+    __slots__ = ("last_f_cnt", "last_rx_datetime", "recent", "recent_order")
+
+    def __init__(self, history):
+        self.last_f_cnt = None
+        self.last_rx_datetime = None
+        self.recent = set()
+        self.recent_order = collections.deque(maxlen=history)
+
+    def remember(self, f_cnt):
+        if len(self.recent_order) == self.recent_order.maxlen:
+            self.recent.discard(self.recent_order[0])
+        self.recent_order.append(f_cnt)
+        self.recent.add(f_cnt)
+
+
+class FrameCounterTracker:
+    """Tracks the uplink frame counters per device to find lost and duplicate uplinks
+
+    LoRaWAN devices count their uplinks in f_cnt. A frame counter which jumps
+    ahead by more than one means that uplinks were lost, e.g. during an outage
+    of the MQTT connection. A frame counter seen recently is a duplicate, as
+    redelivered by the broker or fetched twice. A frame counter which goes
+    back on a newer uplink means that the device was reset; an older uplink,
+    as recovered from the Storage Integration, just fills a gap.
+
+    Jumps by more than max_gap frames are not reported, since they are more
+    likely the result of a device reset than of a very long outage.
+    """
+
+    def __init__(self, max_gap=1000, history=256, capacity=65536):
+        self.max_gap = max_gap
+        self._history = history
+        self._capacity = capacity
+        self._states = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, device_id, f_cnt, rx_datetime):
+        """Record an uplink; return whether it is a duplicate, and the gap it reveals, if any."""
+        with self._lock:
+            state = self._states.get(device_id)
+            if state is None:
+                state = self._states[device_id] = _CounterState(self._history)
+                if len(self._states) > self._capacity:
+                    self._states.popitem(last=False)
+            else:
+                self._states.move_to_end(device_id)
+
+            gap = None
+            if state.last_f_cnt is not None and f_cnt <= state.last_f_cnt \
+                    and rx_datetime > state.last_rx_datetime:
+                # checked first, the new counters are likely still in the history
+                logging.info("frame counter of %s was reset to %d", device_id, f_cnt)
+                state.recent.clear()
+                state.recent_order.clear()
+                state.last_f_cnt = f_cnt
+                state.last_rx_datetime = rx_datetime
+            elif f_cnt in state.recent:
+                return True, None
+            elif state.last_f_cnt is None or f_cnt > state.last_f_cnt:
+                lost = f_cnt - state.last_f_cnt - 1 if state.last_f_cnt is not None else 0
+                if 0 < lost <= self.max_gap:
+                    gap = Gap(device_id, state.last_f_cnt + 1, f_cnt - 1,
+                              state.last_rx_datetime, rx_datetime)
+                state.last_f_cnt = f_cnt
+                state.last_rx_datetime = rx_datetime
+            state.remember(f_cnt)
+            return False, gap
+
+
+def _merge_ranges(gaps, max_window):
+    """Merge the time ranges of the gaps into as few ranges as possible, each at most max_window long."""
+    ranges = []
+    for gap in sorted(gaps, key=lambda g: g.after):
+        if ranges and gap.after <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], gap.before)
+        else:
+            ranges.append([gap.after, gap.before])
+    windows = []
+    for after, before in ranges:
+        windows.extend(storage.split_windows(after, before, max_window))
+    return windows
+
+
+class Backfiller:
+    """Recovers lost uplinks from the TTN's Storage Integration in the background
+
+    The Storage Integration persists uplinks with a short lag, so gaps are only
+    fetched once they are delay seconds old. The time ranges of all gaps due
+    are merged, and each merged range is fetched for the whole application in
+    a single request of at most max_window. The uplinks which fall into a gap
+    are passed to process_uplink, which is expected to skip duplicates.
+    """
+
+    QUEUE_NAME = "backfill"
+
+    def __init__(self, session, url, headers, process_uplink, delay=60.0,
+                 max_window=dt.timedelta(hours=6), timeout=60):
+        self._session = session
+        self._url = url
+        self._headers = headers
+        self._process_uplink = process_uplink
+        self._delay = delay
+        self._max_window = max_window
+        self._timeout = timeout
+        # (monotonic time at which the gap is due, gap)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        metrics.QUEUE_DEPTH.labels(self.QUEUE_NAME).set_function(lambda: len(self._pending))
+
+    def add_gap(self, gap):
+        logging.info("lost uplinks %d-%d of %s, scheduling backfill",
+                     gap.first_f_cnt, gap.last_f_cnt, gap.device_id)
+        with self._lock:
+            self._pending.append((time.monotonic() + self._delay, gap))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="backfill", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop backfilling; False if a running backfill did not finish within timeout seconds."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def _run(self):
+        while not self._stop.wait(1.0):
+            gaps = self._take_due_gaps()
+            if gaps:
+                self.backfill(gaps)
+
+    def _take_due_gaps(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [gap for due_at, gap in self._pending if due_at <= now]
+            self._pending = [(due_at, gap) for due_at, gap in self._pending if due_at > now]
+        return due
+
+    def backfill(self, gaps):
+        """Fetch the uplinks lost in the gaps and pass them to process_uplink."""
+        wanted = collections.defaultdict(list)
+        for gap in gaps:
+            wanted[gap.device_id].append((gap.first_f_cnt, gap.last_f_cnt))
+        for after, before in _merge_ranges(gaps, self._max_window):
+            logging.info("backfilling uplinks of %d devices received between %s and %s",
+                         len(wanted), after.isoformat(), before.isoformat())
+            try:
+                for uplink in storage.fetch_uplinks(self._session, self._url, self._headers,
+                                                    after, before, self._timeout):
+                    if _is_wanted(uplink, wanted):
+                        self._process_uplink(uplink)
+            except Exception as e:
+                logging.error("backfill from %s failed: %s", self._url, e)
+
+
+def _is_wanted(uplink, wanted):
+    try:
+        ranges = wanted.get(uplink["end_device_ids"]["device_id"], ())
+        f_cnt = uplink["uplink_message"].get("f_cnt", 0)
+    except (KeyError, AttributeError):
+        return False
+    return any(first <= f_cnt <= last for first, last in ranges)
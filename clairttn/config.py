@@ -0,0 +1,56 @@
+import os
+import configparser
+from collections import namedtuple
+
+
+AppConfig = namedtuple('AppConfig', [
+    'app_id',
+    'access_key',
+    'mode',
+    'stack',
+    'api_root'])
+AppConfig.__doc__ = """The connection and handler settings of one TTN application"""
+
+
+class ConfigException(Exception):
+    """Raised for an invalid application config file"""
+
+
+def load_app_configs(path, defaults):
+    """Load the TTN applications from an INI file with one section per application id.
+
+    Each section needs an access_key_file (relative to the config file) or an
+    access_key, and a mode unless given in defaults; stack and api_root are
+    optional. defaults holds the values of the command line options, which
+    the [DEFAULT] section of the file overrides.
+    """
+    parser = configparser.ConfigParser(
+        defaults={k: v for k, v in defaults.items() if v is not None},
+        interpolation=None,
+    )
+    with open(path) as fd:
+        parser.read_file(fd)
+    if not parser.sections():
+        raise ConfigException("{} configures no TTN application".format(path))
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    app_configs = []
+    for app_id in parser.sections():
+        section = parser[app_id]
+        if "access_key" in section:
+            access_key = section["access_key"]
+        elif "access_key_file" in section:
+            with open(os.path.join(base_dir, section["access_key_file"])) as fd:
+                access_key = fd.read().rstrip("\n")
+        else:
+            raise ConfigException("no access_key_file for application {}".format(app_id))
+        try:
+            app_configs.append(AppConfig(
+                app_id=app_id,
+                access_key=access_key,
+                mode=section["mode"],
+                stack=section["stack"],
+                api_root=section["api_root"]))
+        except KeyError as e:
+            raise ConfigException("no {} for application {}".format(e, app_id))
+    return app_configs
@@ -0,0 +1,155 @@
+import json
+import time
+import logging
+import threading
+import collections
+from collections import namedtuple
+
+
+DeadLetter = namedtuple('DeadLetter', [
+    'recorded_at',
+    'app_id',
+    'device_id',
+    'device_eui',
+    'protocol',
+    'mcs',
+    'rx_port',
+    'rx_datetime',
+    'error',
+    'detail',
+    'payload'])
+DeadLetter.__doc__ = """An uplink which could not be processed: the raw payload and as much of its
+metadata as was known, and the class and message of the exception.
+
+device_eui and payload are hex strings, mcs is the name of a LoRaWanMcs and
+rx_datetime an ISO 8601 string; all but recorded_at, error and detail may be
+None, depending on how far the uplink got.
+"""
+
+
+class PayloadQuarantinedException(Exception):
+    """Raised to abort the handling of an uplink which was put into the dead letter store"""
+
+
+def from_exception(exception, app_id, device_id=None, device_eui=None, protocol=None,
+                   mcs=None, rx_port=None, rx_datetime=None, raw_data=None):
+    return DeadLetter(
+        recorded_at=time.time(),
+        app_id=app_id,
+        device_id=device_id,
+        device_eui=device_eui.hex() if device_eui is not None else None,
+        protocol=protocol,
+        mcs=mcs.name if mcs is not None else None,
+        rx_port=rx_port,
+        rx_datetime=rx_datetime.isoformat() if rx_datetime is not None else None,
+        error=type(exception).__name__,
+        detail=str(exception),
+        payload=raw_data.hex() if raw_data is not None else None,
+    )
+
+
+def from_rx_message(exception, app_id, rx_message, protocol=None):
+    return from_exception(
+        exception,
+        app_id,
+        rx_message.device_id,
+        rx_message.device_eui,
+        protocol,
+        rx_message.mcs,
+        rx_message.rx_port,
+        rx_message.rx_datetime,
+        rx_message.raw_data,
+    )
+
+
+def read_dead_letters(path):
+    """Iterate over the dead letters of an NDJSON file written by a DeadLetterStore."""
+    with open(path) as fd:
+        for line in fd:
+            if line.strip():
+                yield DeadLetter(**json.loads(line))
+
+
+def write_dead_letters(path, dead_letters):
+    with open(path, "w") as fd:
+        for dead_letter in dead_letters:
+            fd.write(_to_json(dead_letter))
+
+
+def _to_json(dead_letter):
+    return json.dumps(dead_letter._asdict(), separators=(",", ":")) + "\n"
+
+
+class DeadLetterStore:
+    """Quarantines the uplinks which could not be extracted or decoded
+
+    Dead letters are appended to an NDJSON file, if one is opened, and counted
+    per device and per exception class. Instead of logging every dead letter
+    with the full message and a traceback, the first one of each device and
+    exception class is logged, and then at most one per log_interval seconds,
+    along with the number of those suppressed in between.
+    """
+
+    def __init__(self, log_interval=60.0):
+        self.log_interval = log_interval
+        self.path = None
+        self._fd = None
+        self._by_device = collections.Counter()
+        self._by_error = collections.Counter()
+        # (device id, exception class) -> (monotonic time of the last log, suppressed since)
+        self._logged = {}
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        with self._lock:
+            self._fd = open(path, "a")
+            self.path = path
+
+    def close(self):
+        with self._lock:
+            if self._fd:
+                self._fd.close()
+            self._fd = None
+
+    def quarantine(self, dead_letter):
+        with self._lock:
+            if self._fd:
+                # flushed right away, dead letters are rare and must survive a crash
+                self._fd.write(_to_json(dead_letter))
+                self._fd.flush()
+            self._by_device[dead_letter.device_id] += 1
+            self._by_error[dead_letter.error] += 1
+            suppressed = self._count_suppressed(dead_letter)
+        if suppressed is not None:
+            logging.warning(
+                "quarantined uplink of device %s: %s: %s (%d similar suppressed)",
+                dead_letter.device_id,
+                dead_letter.error,
+                dead_letter.detail,
+                suppressed,
+            )
+
+    def _count_suppressed(self, dead_letter):
+        """The number of suppressed logs if the dead letter is to be logged, else None."""
+        key = (dead_letter.device_id, dead_letter.error)
+        now = time.monotonic()
+        logged_at, suppressed = self._logged.get(key, (None, 0))
+        if logged_at is not None and now - logged_at < self.log_interval:
+            self._logged[key] = (logged_at, suppressed + 1)
+            return None
+        self._logged[key] = (now, 0)
+        return suppressed
+
+    def counts(self):
+        with self._lock:
+            return {
+                "by_device": dict(self._by_device.most_common()),
+                "by_error": dict(self._by_error.most_common()),
+            }
+
+
+DEAD_LETTERS = DeadLetterStore()
+
+
+def dead_letters_route(_query):
+    return 200, "application/json", json.dumps(DEAD_LETTERS.counts())
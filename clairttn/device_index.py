@@ -0,0 +1,100 @@
+import json
+import time
+import threading
+import collections
+
+
+class _DeviceEntry:
+    __slots__ = ("last_seen", "expected_interval")
+
+    def __init__(self, last_seen, expected_interval):
+        self.last_seen = last_seen
+        self.expected_interval = expected_interval
+
+
+class DeviceIndex:
+    """Index of the last time each device was heard from
+
+    The index keeps one small entry per device EUI and evicts the devices
+    which have been silent for the longest time once its capacity is reached,
+    so memory stays bounded for large fleets. A device counts as silent once
+    it has not been heard from for silence_factor times its expected send
+    interval.
+    """
+
+    def __init__(self, capacity=65536, silence_factor=2.5, default_interval=900):
+        self.capacity = capacity
+        self.silence_factor = silence_factor
+        self.default_interval = default_interval
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, device_eui, rx_timestamp, expected_interval=None):
+        """Record an uplink of the device received at rx_timestamp (seconds since epoch)."""
+        if expected_interval is None:
+            expected_interval = self.default_interval
+        with self._lock:
+            entry = self._entries.get(device_eui)
+            if entry is None:
+                self._entries[device_eui] = _DeviceEntry(rx_timestamp, expected_interval)
+                if len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+            elif rx_timestamp >= entry.last_seen:
+                entry.last_seen = rx_timestamp
+                entry.expected_interval = expected_interval
+                self._entries.move_to_end(device_eui)
+
+    def last_seen(self, device_eui):
+        entry = self._entries.get(device_eui)
+        return entry.last_seen if entry else None
+
+    def silent_devices(self, now=None):
+        """Return (device EUI, last seen, expected interval) of all silent devices."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = list(self._entries.items())
+        return [
+            (device_eui, entry.last_seen, entry.expected_interval)
+            for device_eui, entry in entries
+            if now - entry.last_seen > self.silence_factor * entry.expected_interval
+        ]
+
+
+def expected_send_interval(payload_specification, mcs):
+    """Seconds between two uplinks of a device which conforms to the payload specification."""
+    if payload_specification is None or mcs not in payload_specification:
+        return None
+    payload_info = payload_specification[mcs]
+    return payload_info.measurement_count * payload_info.measurement_interval
+
+
+DEVICES = DeviceIndex()
+
+
+def silent_devices_route(_query):
+    now = time.time()
+    silent_devices = [
+        {
+            "device_eui": device_eui.hex(),
+            "seconds_since_last_seen": round(now - last_seen),
+            "expected_interval": expected_interval,
+        }
+        for device_eui, last_seen, expected_interval in DEVICES.silent_devices(now)
+    ]
+    return 200, "application/json", json.dumps(silent_devices)
+
+
+def last_seen_route(query):
+    try:
+        device_eui = bytes.fromhex(query.get("eui", ""))
+    except ValueError:
+        return 400, "text/plain; charset=utf-8", "invalid device EUI\n"
+    last_seen = DEVICES.last_seen(device_eui)
+    if last_seen is None:
+        return 404, "text/plain; charset=utf-8", "unknown device\n"
+    return 200, "application/json", json.dumps(
+        {"device_eui": device_eui.hex(), "last_seen": last_seen}
+    )
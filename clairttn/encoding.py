@@ -0,0 +1,242 @@
+"""A compact encoding of sample batches for the ingest endpoint
+
+A batch lists each node id once and the samples as rows which refer to their
+node by index:
+
+    {"nodes": [<node id>, ...],
+     "samples": [[<node index>, timestamp_s, co2_ppm, temperature_celsius, rel_humidity_percent], ...]}
+
+Node ids which are UUIDs are sent as their 16 bytes, others as strings; an
+absent temperature or humidity is null. The batch is serialized with CBOR
+(RFC 8949) or MessagePack, as given by the content type, and optionally
+compressed with gzip or zstd, as given by the content encoding.
+"""
+
+import gzip
+import uuid
+import struct
+
+
+CONTENT_TYPES = {
+    "cbor": "application/vnd.clair.samples+cbor",
+    "msgpack": "application/vnd.clair.samples+msgpack",
+}
+COMPRESSIONS = ["identity", "gzip", "zstd"]
+
+FIELDS = ["timestamp_s", "co2_ppm", "temperature_celsius", "rel_humidity_percent"]
+
+
+class EncodingException(Exception):
+    """Raised for a body which is not a valid compact sample batch"""
+
+
+def to_batch(records):
+    """The batch of sinks.SampleRecords, before serialization."""
+    nodes = {}
+    samples = []
+    for record in records:
+        index = nodes.setdefault(record.node_id, len(nodes))
+        samples.append([index] + [record.attributes.get(field) for field in FIELDS])
+    return {"nodes": [_node_id_to_wire(node_id) for node_id in nodes], "samples": samples}
+
+
+def from_batch(batch):
+    try:
+        nodes = [_node_id_from_wire(node_id) for node_id in batch["nodes"]]
+        return [
+            (
+                nodes[row[0]],
+                {field: value for field, value in zip(FIELDS, row[1:]) if value is not None},
+            )
+            for row in batch["samples"]
+        ]
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise EncodingException("invalid sample batch: {}".format(e))
+
+
+def _node_id_to_wire(node_id):
+    try:
+        return uuid.UUID(node_id).bytes
+    except ValueError:
+        return node_id
+
+
+def _node_id_from_wire(node_id):
+    if isinstance(node_id, bytes):
+        return str(uuid.UUID(bytes=node_id))
+    return node_id
+
+
+def encode_batch(records, encoding="cbor", compression="gzip"):
+    """Encode the sample records; return the body and its HTTP headers."""
+    batch = to_batch(records)
+    if encoding == "cbor":
+        body = cbor_dumps(batch)
+    elif encoding == "msgpack":
+        import msgpack
+        body = msgpack.packb(batch, use_bin_type=True)
+    else:
+        raise ValueError("unsupported encoding: {}".format(encoding))
+    headers = {"Content-Type": CONTENT_TYPES[encoding]}
+    if compression != "identity":
+        body = _compress(body, compression)
+        headers["Content-Encoding"] = compression
+    return body, headers
+
+
+def decode_batch(body, content_type, content_encoding=None):
+    """The reference decoder: the (node id, sample attributes) pairs of an encoded body."""
+    if content_encoding and content_encoding != "identity":
+        body = _decompress(body, content_encoding)
+    if content_type == CONTENT_TYPES["cbor"]:
+        batch = cbor_loads(body)
+    elif content_type == CONTENT_TYPES["msgpack"]:
+        import msgpack
+        batch = msgpack.unpackb(body, raw=False)
+    else:
+        raise EncodingException("unsupported content type: {}".format(content_type))
+    return from_batch(batch)
+
+
+def _compress(body, compression):
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(body)
+    raise ValueError("unsupported compression: {}".format(compression))
+
+
+def _decompress(body, compression):
+    if compression == "gzip":
+        return gzip.decompress(body)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise EncodingException("unsupported content encoding: {}".format(compression))
+
+
+# A CBOR encoder and decoder for the data types of sample batches: integers,
+# floats, byte and text strings, arrays, maps, booleans and null.
+
+def cbor_dumps(value):
+    chunks = []
+    _cbor_encode(value, chunks)
+    return b"".join(chunks)
+
+
+def _cbor_head(major_type, argument, chunks):
+    if argument < 24:
+        chunks.append(struct.pack(">B", major_type << 5 | argument))
+    elif argument < 0x100:
+        chunks.append(struct.pack(">BB", major_type << 5 | 24, argument))
+    elif argument < 0x10000:
+        chunks.append(struct.pack(">BH", major_type << 5 | 25, argument))
+    elif argument < 0x100000000:
+        chunks.append(struct.pack(">BI", major_type << 5 | 26, argument))
+    else:
+        chunks.append(struct.pack(">BQ", major_type << 5 | 27, argument))
+
+
+def _cbor_encode(value, chunks):
+    if value is None:
+        chunks.append(b"\xf6")
+    elif value is True:
+        chunks.append(b"\xf5")
+    elif value is False:
+        chunks.append(b"\xf4")
+    elif isinstance(value, int):
+        if value >= 0:
+            _cbor_head(0, value, chunks)
+        else:
+            _cbor_head(1, -1 - value, chunks)
+    elif isinstance(value, float):
+        # single precision where it is exact, e.g. for 21.5 degrees
+        try:
+            single = struct.pack(">f", value)
+        except OverflowError:
+            single = None
+        if single is not None and struct.unpack(">f", single)[0] == value:
+            chunks.append(b"\xfa" + single)
+        else:
+            chunks.append(b"\xfb" + struct.pack(">d", value))
+    elif isinstance(value, bytes):
+        _cbor_head(2, len(value), chunks)
+        chunks.append(value)
+    elif isinstance(value, str):
+        data = value.encode("utf8")
+        _cbor_head(3, len(data), chunks)
+        chunks.append(data)
+    elif isinstance(value, (list, tuple)):
+        _cbor_head(4, len(value), chunks)
+        for item in value:
+            _cbor_encode(item, chunks)
+    elif isinstance(value, dict):
+        _cbor_head(5, len(value), chunks)
+        for key, item in value.items():
+            _cbor_encode(key, chunks)
+            _cbor_encode(item, chunks)
+    else:
+        raise TypeError("cannot encode {} as CBOR".format(type(value).__name__))
+
+
+def cbor_loads(data):
+    try:
+        value, offset = _cbor_decode(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise EncodingException("invalid CBOR: {}".format(e))
+    if offset != len(data):
+        raise EncodingException("invalid CBOR: {} trailing bytes".format(len(data) - offset))
+    return value
+
+
+_SIMPLE_VALUES = {20: False, 21: True, 22: None}
+
+
+def _cbor_decode(data, offset):
+    initial_byte = data[offset]
+    major_type, info = initial_byte >> 5, initial_byte & 0x1F
+    offset += 1
+    if major_type == 7:
+        if info in _SIMPLE_VALUES:
+            return _SIMPLE_VALUES[info], offset
+        elif info == 25:
+            return struct.unpack_from(">e", data, offset)[0], offset + 2
+        elif info == 26:
+            return struct.unpack_from(">f", data, offset)[0], offset + 4
+        elif info == 27:
+            return struct.unpack_from(">d", data, offset)[0], offset + 8
+        raise EncodingException("unsupported CBOR simple value {}".format(info))
+    if info < 24:
+        argument = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        argument = int.from_bytes(data[offset:offset + size], "big")
+        if offset + size > len(data):
+            raise EncodingException("invalid CBOR: truncated")
+        offset += size
+    else:
+        raise EncodingException("unsupported CBOR additional information {}".format(info))
+
+    if major_type == 0:
+        return argument, offset
+    elif major_type == 1:
+        return -1 - argument, offset
+    elif major_type in (2, 3):
+        value = data[offset:offset + argument]
+        if len(value) != argument:
+            raise EncodingException("invalid CBOR: truncated")
+        return (value if major_type == 2 else value.decode("utf8")), offset + argument
+    elif major_type == 4:
+        items = []
+        for __ in range(argument):
+            item, offset = _cbor_decode(data, offset)
+            items.append(item)
+        return items, offset
+    elif major_type == 5:
+        items = {}
+        for __ in range(argument):
+            key, offset = _cbor_decode(data, offset)
+            items[key], offset = _cbor_decode(data, offset)
+        return items, offset
+    raise EncodingException("unsupported CBOR major type {}".format(major_type))
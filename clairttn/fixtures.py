@@ -0,0 +1,202 @@
+import csv
+import heapq
+import json
+import tempfile
+
+
+def sample_fields(node, sample):
+    """The fields of a core.sample fixture (or row) for a decoded sample."""
+    fields = {
+        'node': node,
+        'timestamp_s': sample.timestamp.value,
+        'co2_ppm': sample.co2.value,
+        'measurement_status': 'M'
+    }
+    if sample.temperature:
+        fields['temperature_celsius'] = sample.temperature.value
+    if sample.relative_humidity:
+        fields['rel_humidity_percent'] = sample.relative_humidity.value
+    return fields
+
+
+class ExternalSorter:
+    """Sort an arbitrary number of JSON-serializable items within bounded memory
+
+    Items are collected into runs of at most run_size items, each of which is
+    sorted and spilled to a temporary file. sorted() then lazily merges the runs.
+    Items with equal keys keep their insertion order.
+    """
+
+    def __init__(self, key, run_size=100000, tmp_dir=None):
+        self._key = key
+        self._run_size = run_size
+        self._tmp_dir = tmp_dir
+        self._run = []
+        self._run_files = []
+
+    def add(self, item):
+        self._run.append(item)
+        if len(self._run) >= self._run_size:
+            self._spill()
+
+    def sorted(self):
+        """Iterate over all added items in sorted order; the sorter is consumed."""
+        if not self._run_files:
+            # everything fits in memory
+            self._run.sort(key=self._key)
+            yield from self._run
+            self._run = []
+            return
+        if self._run:
+            self._spill()
+        try:
+            runs = [self._read_run(run_file) for run_file in self._run_files]
+            yield from heapq.merge(*runs, key=self._key)
+        finally:
+            self.close()
+
+    def close(self):
+        for run_file in self._run_files:
+            run_file.close()
+        self._run_files = []
+
+    def _spill(self):
+        self._run.sort(key=self._key)
+        run_file = tempfile.TemporaryFile(mode='w+', dir=self._tmp_dir)
+        for item in self._run:
+            run_file.write(json.dumps(item, separators=(',', ':')))
+            run_file.write('\n')
+        run_file.seek(0)
+        self._run_files.append(run_file)
+        self._run = []
+
+    @staticmethod
+    def _read_run(run_file):
+        for line in run_file:
+            yield json.loads(line)
+
+
+class FixtureWriter:
+    """Writes Django fixtures as a JSON array, one fixture at a time
+
+    The output is identical to json.dumps() of the whole list with indent=4.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._count = 0
+
+    def write(self, fixture):
+        self._fd.write('[\n' if self._count == 0 else ',\n')
+        text = json.dumps(fixture, indent=4)
+        self._fd.write('    ' + text.replace('\n', '\n    '))
+        self._count += 1
+
+    def close(self):
+        # the trailing newline matches the output of print()
+        self._fd.write('[]\n' if self._count == 0 else '\n]\n')
+        self._fd.flush()
+
+
+SAMPLE_COLUMNS = [
+    'node',
+    'timestamp_s',
+    'co2_ppm',
+    'temperature_celsius',
+    'rel_humidity_percent',
+    'measurement_status'
+]
+
+
+class CopyCsvWriter:
+    """Writes sample rows for PostgreSQL's COPY ... FROM in CSV format
+
+    Load with COPY core_sample (...) FROM STDIN WITH (FORMAT csv, HEADER true);
+    missing measurements are written as empty, unquoted fields, COPY's NULL.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._writer = csv.writer(fd, lineterminator='\n')
+        self._writer.writerow(SAMPLE_COLUMNS)
+
+    def write(self, fields):
+        self._writer.writerow([fields.get(c) for c in SAMPLE_COLUMNS])
+
+    def close(self):
+        self._fd.flush()
+
+
+class CopyTextWriter:
+    """Writes sample rows for PostgreSQL's COPY ... FROM in (tab-separated) text format
+
+    Load with COPY core_sample (...) FROM STDIN; the column order is that of
+    SAMPLE_COLUMNS, and missing measurements are written as \\N.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    def write(self, fields):
+        self._fd.write('\t'.join(_copy_text_value(fields.get(c)) for c in SAMPLE_COLUMNS))
+        self._fd.write('\n')
+
+    def close(self):
+        self._fd.flush()
+
+
+def _copy_text_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+COLUMNAR_FORMATS = ['parquet', 'arrow']
+
+
+class ColumnarWriter:
+    """Writes sample rows to a Parquet or Arrow IPC file in record batches
+
+    Requires the optional pyarrow dependency (pip install clairttn[columnar]).
+    """
+
+    def __init__(self, path, file_format, batch_size=65536):
+        import pyarrow
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            ('node', pyarrow.string()),
+            ('timestamp', pyarrow.timestamp('s', tz='UTC')),
+            ('co2_ppm', pyarrow.float64()),
+            ('temperature_celsius', pyarrow.float64()),
+            ('rel_humidity_percent', pyarrow.float64()),
+            ('measurement_status', pyarrow.string()),
+        ])
+        if file_format == 'parquet':
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        elif file_format == 'arrow':
+            import pyarrow.ipc
+            self._writer = pyarrow.ipc.new_file(path, self._schema)
+        else:
+            raise ValueError("unsupported columnar format: {}".format(file_format))
+        self._batch_size = batch_size
+        self._columns = [[] for __ in SAMPLE_COLUMNS]
+
+    def write(self, fields):
+        for column, name in zip(self._columns, SAMPLE_COLUMNS):
+            column.append(fields.get(name))
+        if len(self._columns[0]) >= self._batch_size:
+            self._write_batch()
+
+    def close(self):
+        if self._columns[0]:
+            self._write_batch()
+        self._writer.close()
+
+    def _write_batch(self):
+        batch = self._pa.record_batch(
+            [self._pa.array(column, type=field.type)
+             for column, field in zip(self._columns, self._schema)],
+            schema=self._schema)
+        self._writer.write_batch(batch)
+        self._columns = [[] for __ in SAMPLE_COLUMNS]
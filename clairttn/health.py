@@ -0,0 +1,170 @@
+import json
+import time
+import threading
+
+
+class HealthState:
+    """Tracks the state needed to answer liveness and readiness probes
+
+    The process is live as long as its MQTT connections recover from outages
+    within the disconnect grace period; a restart will not help otherwise. It
+    is ready if all MQTT connections are up, the last backend write succeeded,
+    no internal queue is saturated and, if configured, uplinks keep arriving.
+
+    Worker processes write to the backend on their own. backend_sources are
+    callables returning the backend_state() of each such process, which is
+    combined with the state of this process.
+    """
+
+    def __init__(
+        self,
+        disconnect_grace=300.0,
+        max_uplink_silence=None,
+        queue_saturation_threshold=0.9,
+        latency_smoothing=0.2,
+    ):
+        self.disconnect_grace = disconnect_grace
+        self.max_uplink_silence = max_uplink_silence
+        self.queue_saturation_threshold = queue_saturation_threshold
+        self._latency_smoothing = latency_smoothing
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        # per MQTT connection: (connected, monotonic time of the last state change)
+        self._connections = {}
+        self._queues = {}
+        self._last_uplink = None
+        self._last_backend_success = None
+        self._last_backend_error = None
+        self._backend_latency = None
+        self.backend_sources = []
+        # set on shutdown, while the uplinks received so far are handled
+        self.draining = False
+
+    def set_mqtt_connected(self, name, connected):
+        with self._lock:
+            previous = self._connections.get(name)
+            if previous is None:
+                # a failed first connection attempt counts from the start
+                changed_at = time.monotonic() if connected else self._started_at
+            elif previous[0] != connected:
+                changed_at = time.monotonic()
+            else:
+                # failed reconnects must not extend the disconnect grace period
+                return
+            self._connections[name] = (connected, changed_at)
+
+    def register_queue(self, name, depth_function, capacity):
+        self._queues[name] = (depth_function, capacity)
+
+    def mark_uplink(self):
+        self._last_uplink = time.monotonic()
+
+    def mark_backend_success(self, latency):
+        self._last_backend_success = time.monotonic()
+        if self._backend_latency is None:
+            self._backend_latency = latency
+        else:
+            # exponentially weighted moving average
+            self._backend_latency += self._latency_smoothing * (
+                latency - self._backend_latency
+            )
+
+    def mark_backend_error(self):
+        self._last_backend_error = time.monotonic()
+
+    def backend_state(self):
+        """The monotonic times of the last backend success and error, and the backend latency"""
+        return self._last_backend_success, self._last_backend_error, self._backend_latency
+
+    def _combined_backend_state(self):
+        states = [self.backend_state()]
+        for source in self.backend_sources:
+            states.extend(source())
+        # the latest times and the highest latency; the monotonic clock is
+        # shared by the processes of a host
+        last_success, last_error, latency = (
+            max((value for value in values if value is not None), default=None)
+            for values in zip(*states)
+        )
+        return last_success, last_error, latency
+
+    def liveness(self):
+        now = time.monotonic()
+        report = self._report(now)
+        with self._lock:
+            connections = dict(self._connections)
+        live = all(
+            connected or now - changed_at < self.disconnect_grace
+            for connected, changed_at in connections.values()
+        )
+        if not connections:
+            # give the initial connection attempt the same grace period
+            live = now - self._started_at < self.disconnect_grace
+        report["status"] = "live" if live else "dead"
+        return live, report
+
+    def readiness(self):
+        now = time.monotonic()
+        backend_state = self._combined_backend_state()
+        report = self._report(now, backend_state)
+        with self._lock:
+            connections = dict(self._connections)
+        reasons = []
+        if self.draining:
+            reasons.append("draining")
+        if not connections or not all(c for c, __ in connections.values()):
+            reasons.append("mqtt disconnected")
+        last_backend_success, last_backend_error, __ = backend_state
+        if last_backend_error is not None and (
+            last_backend_success is None or last_backend_error > last_backend_success
+        ):
+            reasons.append("backend write failed")
+        for name, saturation in report["queue_saturation"].items():
+            if saturation >= self.queue_saturation_threshold:
+                reasons.append("queue {} saturated".format(name))
+        if self.max_uplink_silence:
+            last_uplink = self._last_uplink or self._started_at
+            if now - last_uplink > self.max_uplink_silence:
+                reasons.append("no uplink received")
+        report["status"] = "ready" if not reasons else "unready"
+        report["reasons"] = reasons
+        return not reasons, report
+
+    def _report(self, now, backend_state=None):
+        with self._lock:
+            connections = dict(self._connections)
+        last_backend_success, last_backend_error, backend_latency = (
+            backend_state or self.backend_state()
+        )
+        return {
+            "mqtt_connected": {name: c for name, (c, __) in connections.items()},
+            "seconds_since_last_uplink": _seconds_since(self._last_uplink, now),
+            "seconds_since_last_backend_write": _seconds_since(
+                last_backend_success, now
+            ),
+            "seconds_since_last_backend_error": _seconds_since(
+                last_backend_error, now
+            ),
+            "backend_latency_seconds": backend_latency,
+            "queue_saturation": {
+                name: depth_function() / capacity if capacity else 0.0
+                for name, (depth_function, capacity) in self._queues.items()
+            },
+        }
+
+
+def _seconds_since(timestamp, now):
+    return None if timestamp is None else round(now - timestamp, 3)
+
+
+HEALTH = HealthState()
+
+
+def liveness_route(_query):
+    live, report = HEALTH.liveness()
+    return (200 if live else 503), "application/json", json.dumps(report)
+
+
+def readiness_route(_query):
+    ready, report = HEALTH.readiness()
+    return (200 if ready else 503), "application/json", json.dumps(report)
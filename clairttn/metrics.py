@@ -0,0 +1,413 @@
+import bisect
+import json
+import math
+import threading
+
+
+# Latency buckets in seconds, from sub-millisecond decoding up to backend timeouts.
+DEFAULT_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# End-to-end latency buckets in seconds, from TTN reception to the backend's response.
+END_TO_END_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        # Plain attribute updates without a lock keep recording in the order of
+        # 100ns; under heavy thread contention an increment may get lost, which
+        # is acceptable for monitoring purposes.
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        # unlike a counter, a gauge never recovers from a lost update, and
+        # gauges are not updated per sample
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function):
+        """Determine the gauge value by calling function at collection time."""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "bucket_counts", "sum")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        # the last bucket counts the observations above the largest bound (+Inf)
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.bucket_counts)
+
+    def quantile(self, q):
+        """Estimate the q-quantile by linear interpolation within the buckets."""
+        counts = list(self.bucket_counts)
+        total = sum(counts)
+        if not total:
+            return math.nan
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.upper_bounds):
+                    return self.upper_bounds[-1]
+                lower = self.upper_bounds[i - 1] if i > 0 else 0.0
+                upper = self.upper_bounds[i]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.upper_bounds[-1]
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *labelvalues):
+        """Return the child metric for the given label values.
+
+        Children are created once and cached, so hot code paths should resolve
+        them up front and keep a reference.
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(
+                "{} expects labels {}".format(self.name, ", ".join(self.labelnames))
+            )
+        key = tuple(str(v) for v in labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._create_child())
+        return child
+
+    def _create_child(self):
+        raise NotImplementedError("needs to be implemented by subclass")
+
+    def _samples(self):
+        raise NotImplementedError("needs to be implemented by subclass")
+
+    def _snapshot_value(self, child):
+        raise NotImplementedError("needs to be implemented by subclass")
+
+    def _add_snapshot_value(self, child, value):
+        raise NotImplementedError("needs to be implemented by subclass")
+
+    def snapshot(self):
+        """The picklable values of the children by their label values, see merged()"""
+        return {key: self._snapshot_value(child) for key, child in list(self._children.items())}
+
+    def merged(self, snapshots):
+        """The children with the values of the snapshots, taken in other
+        processes, added to their own values"""
+        children = {}
+        for snapshot in [self.snapshot()] + list(snapshots):
+            for key, value in snapshot.items():
+                child = children.get(key)
+                if child is None:
+                    child = children[key] = self._create_child()
+                self._add_snapshot_value(child, value)
+        return children
+
+    def render(self, snapshots=()):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type_name),
+        ]
+        children = self.merged(snapshots) if snapshots else self._children
+        for suffix, labels, value in self._samples(children):
+            lines.append(
+                "{}{}{} {}".format(self.name, suffix, _format_labels(labels), _format_value(value))
+            )
+        return "\n".join(lines)
+
+    def _children_with_labels(self, children=None):
+        for key, child in list((self._children if children is None else children).items()):
+            yield dict(zip(self.labelnames, key)), child
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _create_child(self):
+        return _CounterChild()
+
+    def _snapshot_value(self, child):
+        return child.value
+
+    def _add_snapshot_value(self, child, value):
+        child.value += value
+
+    def _samples(self, children):
+        for labels, child in self._children_with_labels(children):
+            yield "_total", labels, child.value
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _create_child(self):
+        return _GaugeChild()
+
+    def _snapshot_value(self, child):
+        return child.get()
+
+    def _add_snapshot_value(self, child, value):
+        # the gauges of the processes count separate items, like queues or requests
+        child.inc(value)
+
+    def _samples(self, children):
+        for labels, child in self._children_with_labels(children):
+            yield "", labels, child.get()
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _create_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _snapshot_value(self, child):
+        return list(child.bucket_counts), child.sum
+
+    def _add_snapshot_value(self, child, value):
+        bucket_counts, bucket_sum = value
+        for i, count in enumerate(bucket_counts):
+            child.bucket_counts[i] += count
+        child.sum += bucket_sum
+
+    def _samples(self, children):
+        for labels, child in self._children_with_labels(children):
+            counts = list(child.bucket_counts)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", dict(labels, le=bound), cumulative
+            yield "_sum", labels, child.sum
+            yield "_count", labels, cumulative
+
+
+class Registry:
+    """A collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("duplicate metric: {}".format(metric.name))
+        self._metrics[metric.name] = metric
+
+    def snapshot(self):
+        """The picklable values of all metrics, to be rendered by another process"""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render(self, snapshots=()):
+        """Render the metrics, with the values of the snapshots of other processes added"""
+        return "\n".join(
+            m.render([snapshot.get(name, {}) for snapshot in snapshots])
+            for name, m in self._metrics.items()
+        ) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(k, _escape_label_value(v)) for k, v in labels.items()
+    ) + "}"
+
+
+def _escape_label_value(value):
+    if isinstance(value, float):
+        return _format_value(value)
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+MESSAGES = Counter(
+    "clair_messages", "Uplink messages received from the TTN", ["app", "mode"]
+)
+SAMPLES = Counter(
+    "clair_samples", "Samples forwarded to the backend", ["app", "mode"]
+)
+DECODE_ERRORS = Counter(
+    "clair_decode_errors",
+    "Uplink payloads that could not be decoded, by exception class",
+    ["app", "mode", "exception"],
+)
+DROPPED_MESSAGES = Counter(
+    "clair_dropped_messages", "Uplink messages dropped before decoding", ["app", "mode"]
+)
+DUPLICATE_MESSAGES = Counter(
+    "clair_duplicate_messages", "Uplink messages received more than once", ["app", "mode"]
+)
+REJECTED_SAMPLES = Counter(
+    "clair_rejected_samples",
+    "Samples not forwarded because the backend rejected their node",
+    ["app", "mode"],
+)
+BACKFILLED_MESSAGES = Counter(
+    "clair_backfilled_messages",
+    "Lost uplink messages recovered from the TTN Storage Integration",
+    ["app", "mode"],
+)
+SINK_SAMPLES = Counter(
+    "clair_sink_samples", "Samples written to an output sink", ["sink"]
+)
+SINK_DROPPED_SAMPLES = Counter(
+    "clair_sink_dropped_samples",
+    "Samples dropped by an output sink because its queue was full or writes kept failing",
+    ["sink"],
+)
+ROLLUPS = Counter(
+    "clair_rollups", "Rollups of the samples of a node, by interval in seconds", ["interval"]
+)
+LATE_SAMPLES = Counter(
+    "clair_rollup_late_samples",
+    "Samples left out of a rollup because its bucket was closed already, by interval in seconds",
+    ["interval"],
+)
+VENTILATION_EVENTS = Counter(
+    "clair_ventilation_events",
+    "CO2 threshold crossings of a node, by whether the alert was raised or cleared",
+    ["direction"],
+)
+QUEUE_DEPTH = Gauge(
+    "clair_queue_depth", "Number of items waiting in an internal queue", ["queue"]
+)
+INFLIGHT_REQUESTS = Gauge(
+    "clair_inflight_requests", "Backend requests currently in progress", ["app", "mode"]
+)
+STAGE_DURATION = Histogram(
+    "clair_stage_duration_seconds",
+    "Time spent per uplink in each stage of the processing pipeline",
+    ["app", "mode", "stage"],
+)
+
+END_TO_END_LATENCY = Histogram(
+    "clair_end_to_end_latency_seconds",
+    "Time from the reception of an uplink by the TTN until the backend acknowledged its samples",
+    ["app", "mode"],
+    buckets=END_TO_END_BUCKETS,
+)
+
+
+class PipelineMetrics:
+    """The metrics of one TTN application and handler mode, resolved up front"""
+
+    def __init__(self, app_id, mode=""):
+        self.app_id = app_id
+        self.mode = mode
+        self.messages = MESSAGES.labels(app_id, mode)
+        self.samples = SAMPLES.labels(app_id, mode)
+        self.dropped_messages = DROPPED_MESSAGES.labels(app_id, mode)
+        self.duplicate_messages = DUPLICATE_MESSAGES.labels(app_id, mode)
+        self.backfilled_messages = BACKFILLED_MESSAGES.labels(app_id, mode)
+        self.rejected_samples = REJECTED_SAMPLES.labels(app_id, mode)
+        self.inflight_requests = INFLIGHT_REQUESTS.labels(app_id, mode)
+        self.json_parse = STAGE_DURATION.labels(app_id, mode, "json_parse")
+        self.extract = STAGE_DURATION.labels(app_id, mode, "extract")
+        self.decode = STAGE_DURATION.labels(app_id, mode, "decode")
+        self.uuid = STAGE_DURATION.labels(app_id, mode, "uuid")
+        self.ingest_post = STAGE_DURATION.labels(app_id, mode, "ingest_post")
+        self.end_to_end_latency = END_TO_END_LATENCY.labels(app_id, mode)
+
+    def decode_error(self, exception):
+        DECODE_ERRORS.labels(self.app_id, self.mode, type(exception).__name__).inc()
+
+
+def render(snapshots=()):
+    """Render all metrics of the default registry in the Prometheus text format,
+    with the values of the snapshots of other processes added."""
+    return REGISTRY.render(snapshots)
+
+
+def end_to_end_latency_route(_query, snapshots=()):
+    children = END_TO_END_LATENCY.merged(
+        [snapshot.get(END_TO_END_LATENCY.name, {}) for snapshot in snapshots]
+    )
+    quantiles = [
+        dict(
+            labels,
+            count=child.count,
+            p50=child.quantile(0.5),
+            p90=child.quantile(0.9),
+            p99=child.quantile(0.99),
+        )
+        for labels, child in END_TO_END_LATENCY._children_with_labels(children)
+        if child.count
+    ]
+    return 200, "application/json", json.dumps(quantiles)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+import itertools
+import collections
+
+
+class NodeRejectedException(Exception):
+    """Raised when the backend refuses the samples of a node"""
+
+
+# the responses to a sample of a node which the backend does not know
+REJECTION_STATUS_CODES = (403, 404)
+
+
+def is_rejection(status_code):
+    """Whether a 4xx response means that the backend will reject the node's samples again.
+
+    Other client errors, e.g. 400 or 422 for an invalid or duplicate sample,
+    concern the sample only; timeouts and rate limiting are transient.
+    """
+    return status_code in REJECTION_STATUS_CODES
+
+
+class NegativeCache:
+    """Remembers the nodes whose samples the backend rejected, for ttl seconds
+
+    The samples of a rejected node, typically one which is live on the TTN but
+    not registered in the managair yet, are not posted until the entry expires
+    or is invalidated. If a spool directory is set, they are appended to a file
+    per node instead, up to spool_limit samples, to be replayed once the node
+    is accepted.
+    """
+
+    def __init__(self, ttl=600.0, capacity=65536, spool_limit=10000):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.spool_limit = spool_limit
+        self._spool_dir = None
+        # node id -> (monotonic time of the rejection, HTTP status)
+        self._rejections = collections.OrderedDict()
+        # node id -> number of spooled samples
+        self._spooled = {}
+        self._lock = threading.Lock()
+
+    def set_spool_dir(self, spool_dir):
+        """Spool rejected samples to spool_dir, picking up the samples spooled before."""
+        os.makedirs(spool_dir, exist_ok=True)
+        spooled = {}
+        for file_name in os.listdir(spool_dir):
+            if file_name.endswith(".ndjson"):
+                with open(os.path.join(spool_dir, file_name)) as fd:
+                    spooled[file_name[: -len(".ndjson")]] = sum(1 for __ in fd)
+        with self._lock:
+            self._spool_dir = spool_dir
+            self._spooled = spooled
+
+    def reject(self, node_id, status_code):
+        with self._lock:
+            self._rejections[node_id] = (time.monotonic(), status_code)
+            self._rejections.move_to_end(node_id)
+            if len(self._rejections) > self.capacity:
+                self._rejections.popitem(last=False)
+
+    def is_rejected(self, node_id):
+        rejection = self._rejections.get(node_id)
+        if rejection is None:
+            return False
+        if time.monotonic() - rejection[0] < self.ttl:
+            return True
+        with self._lock:
+            self._rejections.pop(node_id, None)
+        return False
+
+    def invalidate(self, node_id=None):
+        """Forget the rejection of the node, or of all nodes; return the number of entries removed."""
+        with self._lock:
+            if node_id is None:
+                count = len(self._rejections)
+                self._rejections.clear()
+                return count
+            return 1 if self._rejections.pop(node_id, None) else 0
+
+    def rejected_nodes(self):
+        now = time.monotonic()
+        with self._lock:
+            rejections = list(self._rejections.items())
+        return [
+            (node_id, status_code, self.ttl - (now - rejected_at))
+            for node_id, (rejected_at, status_code) in rejections
+            if now - rejected_at < self.ttl
+        ]
+
+    def spool(self, node_id, sample_attributes):
+        """Keep the sample for a later replay; return False if not spooled."""
+        with self._lock:
+            if self._spool_dir is None:
+                return False
+            count = self._spooled.get(node_id, 0)
+            if count >= self.spool_limit:
+                return False
+            with open(self._spool_path(node_id), "a") as fd:
+                fd.write(json.dumps(sample_attributes, separators=(",", ":")))
+                fd.write("\n")
+            self._spooled[node_id] = count + 1
+        return True
+
+    def has_spool(self, node_id):
+        return node_id in self._spooled
+
+    def spooled_count(self, node_id):
+        return self._spooled.get(node_id, 0)
+
+    def spooled_samples(self, node_id, limit):
+        """The first limit spooled samples of the node, see remove_spooled()."""
+        with self._lock:
+            if node_id not in self._spooled:
+                return []
+            with open(self._spool_path(node_id)) as fd:
+                return [json.loads(line) for line in itertools.islice(fd, limit)]
+
+    def remove_spooled(self, node_id, count):
+        """Remove the first count spooled samples of the node, e.g. once replayed."""
+        with self._lock:
+            if not count or node_id not in self._spooled:
+                return
+            path = self._spool_path(node_id)
+            with open(path) as fd:
+                remaining = fd.readlines()[count:]
+            if not remaining:
+                os.remove(path)
+                del self._spooled[node_id]
+                return
+            with open(path + ".tmp", "w") as fd:
+                fd.writelines(remaining)
+            os.replace(path + ".tmp", path)
+            self._spooled[node_id] = len(remaining)
+
+    def _spool_path(self, node_id):
+        return os.path.join(self._spool_dir, "{}.ndjson".format(node_id))
+
+
+NEGATIVE_CACHE = NegativeCache()
+
+
+def rejected_nodes_route(_query):
+    rejected_nodes = [
+        {
+            "node_id": node_id,
+            "status": status_code,
+            "expires_in": round(expires_in),
+            "spooled_samples": NEGATIVE_CACHE.spooled_count(node_id),
+        }
+        for node_id, status_code, expires_in in NEGATIVE_CACHE.rejected_nodes()
+    ]
+    return 200, "application/json", json.dumps(rejected_nodes)
+
+
+def invalidate_route(query):
+    node_id = query.get("node")
+    count = NEGATIVE_CACHE.invalidate(node_id)
+    logging.info("invalidated %d negative cache entries", count)
+    return 200, "application/json", json.dumps({"invalidated": count})
@@ -1,30 +1,101 @@
 import logging
 import base64
-import datetime as dt
+import time
 import jsonapi_requests as jarequests
 import clairttn.clairchen as clairchen
 import clairttn.ers as ers
 import clairttn.oy1012 as oy1012
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.tracing as tracing
+import clairttn.device_index as device_index
+import clairttn.protocols as protocols
+import clairttn.negative_cache as negative_cache
+import clairttn.dead_letter as dead_letter
+import clairttn.sinks as sinks
+import clairttn.ttn_handler as ttn_handler
+
+
+# spooled samples replayed with each uplink of their node, so that a long spool
+# does not hold up the other devices handled by the same worker
+REPLAY_CHUNK_SIZE = 100
 
 
 class _NodeHandler:
+    # the clair-ttn mode which runs this handler, used to label its metrics
+    mode = ""
+    # the name of the protocol of the handled devices, see protocols.PROTOCOLS
+    protocol = None
+
     def __init__(self, ttn_client):
         self.ttn_client = ttn_client
-        self.ttn_client.handle_message = self._handle_message
+        self.ttn_client.handle_message = self._receive
+        self.metrics = metrics.PipelineMetrics(ttn_client.app_id, self.mode)
+        self.ttn_client.metrics = self.metrics
+        # Set to BufferedSinks which receive the forwarded samples besides the ingest endpoint
+        self.sinks = []
+        # False if only rollups are forwarded, see forward_rollup()
+        self.forward_raw = True
 
     def connect(self):
         self.ttn_client.connect()
 
-    def disconnect_and_close(self):
-        self.ttn_client.disconnect_and_close()
+    def stop_receiving(self):
+        self.ttn_client.stop_receiving()
+
+    def drain(self, timeout=None):
+        return self.ttn_client.drain(timeout)
+
+    def disconnect_and_close(self, timeout=None):
+        return self.ttn_client.disconnect_and_close(timeout)
+
+    def _receive(self, rx_message):
+        device_index.DEVICES.record(
+            rx_message.device_eui,
+            rx_message.rx_datetime.timestamp(),
+            self._expected_send_interval(rx_message),
+        )
+        self._handle_message(rx_message)
+
+    def _expected_send_interval(self, rx_message):
+        return device_index.expected_send_interval(
+            self._get_payload_specification(), rx_message.mcs
+        )
 
     def _handle_message(self, rx_message):
         raise NotImplementedError("needs to be implemented by subclass")
 
+    def _get_payload_specification(self):
+        """The protocol payload specification of the handled devices, if any."""
+        return None
+
+    def _decode_payload(self, rx_message):
+        raise NotImplementedError("needs to be implemented by subclass")
+
+    def _get_protocol_name(self, rx_message):
+        return self.protocol
+
+    def _decode(self, rx_message):
+        t_start = time.perf_counter()
+        try:
+            with tracing.TRACER.span("decode"):
+                samples = self._decode_payload(rx_message)
+        except Exception as e:
+            self.metrics.decode_error(e)
+            dead_letter.DEAD_LETTERS.quarantine(
+                dead_letter.from_rx_message(
+                    e, self.metrics.app_id, rx_message, self._get_protocol_name(rx_message)
+                )
+            )
+            raise dead_letter.PayloadQuarantinedException(e) from e
+        self.metrics.decode.observe(time.perf_counter() - t_start)
+        return samples
+
 
 class _SampleForwardingHandler(_NodeHandler):
-    def __init__(self, ttn_client, api_root):
+    def __init__(self, ttn_client, api_root, sample_archive=None):
         super().__init__(ttn_client)
+        self._sample_archive = sample_archive
         api = jarequests.Api.config(
             {
                 "API_ROOT": api_root,
@@ -35,50 +106,175 @@ class _SampleForwardingHandler(_NodeHandler):
         self._sample_endpoint = api.endpoint("ingest")
 
     def _handle_message(self, rx_message):
-        uuid_class = self._get_uuid_class()
-        device_uuid = uuid_class(rx_message.device_eui)
+        samples = self._decode(rx_message)
+        self._forward_samples(rx_message, samples)
+
+    def _forward_samples(self, rx_message, samples):
+        with tracing.TRACER.span("forward", sample_count=len(samples)):
+            self._post_samples(rx_message, samples)
+
+    def _post_samples(self, rx_message, samples):
+        t_start = time.perf_counter()
+        device_uuid = self._get_device_uuid(rx_message)
+        self.metrics.uuid.observe(time.perf_counter() - t_start)
         logging.debug("device_uuid: %s", device_uuid)
 
-        samples = self._decode_payload(rx_message)
+        node_id = str(device_uuid)
+
+        # only enqueued, before posting so that a failed post cannot keep
+        # the samples from the archive and the sinks
         for sample in samples:
             # the ingest enpdoint expects the rel. humidity to be an integer
             if sample.relative_humidity:
                 sample.relative_humidity.value = round(sample.relative_humidity.value)
-            self._post_sample(sample, device_uuid)
+            if self._sample_archive:
+                self._sample_archive.add(device_uuid, sample)
+            if self.sinks:
+                record = sinks.SampleRecord(node_id, rx_message.device_id, _sample_attributes(sample))
+                for sink in self.sinks:
+                    sink.submit(record)
+        if not self.forward_raw:
+            return
+
+        rejected = self._is_rejected(node_id)
+        for sample in samples:
+            if not rejected:
+                try:
+                    self._post_sample(sample, device_uuid)
+                except negative_cache.NodeRejectedException:
+                    rejected = True
+            if rejected:
+                # skip the node's samples until the negative cache entry expires
+                negative_cache.NEGATIVE_CACHE.spool(node_id, _sample_attributes(sample))
+                self.metrics.rejected_samples.inc()
+                continue
+            self.metrics.samples.inc()
+        if not rejected:
+            self.metrics.end_to_end_latency.observe(
+                time.time() - rx_message.rx_datetime.timestamp()
+            )
 
-    def _get_uuid_class(self):
-        raise NotImplementedError("needs to be implemented by subclass")
+    def forward_rollup(self, node_id, sample_attributes):
+        """Post the rollup of a node to the ingest endpoint as a sample, see rollup.RollupStage"""
+        rejected = self._is_rejected(node_id)
+        if not rejected:
+            try:
+                self._post_sample_attributes(sample_attributes, node_id)
+            except negative_cache.NodeRejectedException:
+                rejected = True
+        if rejected:
+            negative_cache.NEGATIVE_CACHE.spool(node_id, sample_attributes)
+            self.metrics.rejected_samples.inc()
+            return
+        self.metrics.samples.inc()
+
+    def _is_rejected(self, node_id):
+        """Whether the samples of the node are to be spooled: while it is
+        rejected, and until the samples spooled before have been replayed."""
+        if negative_cache.NEGATIVE_CACHE.is_rejected(node_id):
+            return True
+        if negative_cache.NEGATIVE_CACHE.has_spool(node_id):
+            return not self._replay_spooled_samples(node_id)
+        return False
+
+    def _replay_spooled_samples(self, node_id):
+        """Post the next of the samples spooled while the node was rejected; True if all were posted."""
+        spooled_samples = negative_cache.NEGATIVE_CACHE.spooled_samples(node_id, REPLAY_CHUNK_SIZE)
+        logging.info(
+            "replaying %d of %d spooled samples of node %s",
+            len(spooled_samples), negative_cache.NEGATIVE_CACHE.spooled_count(node_id), node_id,
+        )
+        replayed = 0
+        try:
+            for sample_attributes in spooled_samples:
+                try:
+                    self._post_sample_attributes(sample_attributes, node_id)
+                except negative_cache.NodeRejectedException:
+                    return False
+                except jarequests.request_factory.ApiClientError as e:
+                    # refused on its own, spooling it again would block the node's samples for good
+                    logging.warning(
+                        "dropping spooled sample %s of node %s, refused with status %d",
+                        sample_attributes.get("timestamp_s"), node_id, e.status_code,
+                    )
+                else:
+                    self.metrics.samples.inc()
+                replayed += 1
+        except Exception as e:
+            # the backend is down, the replay continues with the next uplink
+            logging.error("replaying the spooled samples of node %s failed: %s", node_id, e)
+            return False
+        finally:
+            negative_cache.NEGATIVE_CACHE.remove_spooled(node_id, replayed)
+        return not negative_cache.NEGATIVE_CACHE.has_spool(node_id)
+
+    def _get_device_uuid(self, rx_message):
+        return self._get_uuid_class()(rx_message.device_eui)
 
-    def _decode_payload(self, rx_message):
+    def _get_uuid_class(self):
         raise NotImplementedError("needs to be implemented by subclass")
 
     def _post_sample(self, sample, device_uuid):
         logging.debug("Sample: {}".format(sample))
+        self._post_sample_attributes(_sample_attributes(sample), str(device_uuid))
 
-        sample_attributes = {
-            "timestamp_s": sample.timestamp.value,
-            "co2_ppm": sample.co2.value,
-        }
-        if sample.temperature:
-            sample_attributes["temperature_celsius"] = sample.temperature.value
-        if sample.relative_humidity:
-            sample_attributes["rel_humidity_percent"] = sample.relative_humidity.value
-
+    def _post_sample_attributes(self, sample_attributes, node_id):
         sample_object = jarequests.JsonApiObject(
             type="Sample",
             attributes=sample_attributes,
-            relationships={"node": {"data": {"type": "Node", "id": str(device_uuid)}}},
+            relationships={"node": {"data": {"type": "Node", "id": node_id}}},
         )
-        response = self._sample_endpoint.post(object=sample_object)
+        self.metrics.inflight_requests.inc()
+        t_start = time.perf_counter()
+        try:
+            response = self._sample_endpoint.post(object=sample_object)
+        except jarequests.request_factory.ApiClientError as e:
+            # the request was refused, the backend itself is fine
+            if not negative_cache.is_rejection(e.status_code):
+                raise
+            negative_cache.NEGATIVE_CACHE.reject(node_id, e.status_code)
+            logging.warning(
+                "backend rejected node %s with status %d, skipping its samples for %ds",
+                node_id,
+                e.status_code,
+                negative_cache.NEGATIVE_CACHE.ttl,
+            )
+            raise negative_cache.NodeRejectedException(node_id)
+        except Exception:
+            health.HEALTH.mark_backend_error()
+            raise
+        finally:
+            latency = time.perf_counter() - t_start
+            self.metrics.ingest_post.observe(latency)
+            self.metrics.inflight_requests.dec()
+        health.HEALTH.mark_backend_success(latency)
         logging.debug("Response: {}".format(response))
 
 
+def _sample_attributes(sample):
+    sample_attributes = {
+        "timestamp_s": sample.timestamp.value,
+        "co2_ppm": sample.co2.value,
+    }
+    if sample.temperature:
+        sample_attributes["temperature_celsius"] = sample.temperature.value
+    if sample.relative_humidity:
+        sample_attributes["rel_humidity_percent"] = sample.relative_humidity.value
+    return sample_attributes
+
+
 class ClairchenForwardingHandler(_SampleForwardingHandler):
     """A handler for Clairchen devices which forwards samples to the backend API"""
 
+    mode = "clairchen-forward"
+    protocol = "clairchen"
+
     def _get_uuid_class(self):
         return clairchen.ClairchenDeviceUUID
 
+    def _get_payload_specification(self):
+        return clairchen.PROTOCOL_PAYLOAD_SPECIFICATION
+
     def _decode_payload(self, rx_message):
         return clairchen.decode_payload(
             rx_message.raw_data, rx_message.rx_datetime, rx_message.mcs
@@ -88,9 +284,15 @@ class ClairchenForwardingHandler(_SampleForwardingHandler):
 class ErsForwardingHandler(_SampleForwardingHandler):
     """A handler for Elsys ERS devices which forwards samples to the backend API"""
 
+    mode = "ers-forward"
+    protocol = "ers"
+
     def _get_uuid_class(self):
         return ers.ErsDeviceUUID
 
+    def _get_payload_specification(self):
+        return ers.PROTOCOL_PAYLOAD_SPECIFICATION
+
     def _decode_payload(self, rx_message):
         return ers.decode_payload(rx_message.raw_data, rx_message.rx_datetime)
 
@@ -98,6 +300,9 @@ class ErsForwardingHandler(_SampleForwardingHandler):
 class Oy1012ForwardingHandler(_SampleForwardingHandler):
     """A handler for Talkpool OY1012 devices which forwards samples to the backend API"""
 
+    mode = "oy1012-forward"
+    protocol = "oy1012"
+
     def _get_uuid_class(self):
         return oy1012.Oy1012DeviceUUID
 
@@ -105,11 +310,73 @@ class Oy1012ForwardingHandler(_SampleForwardingHandler):
         return oy1012.decode_payload(rx_message.raw_data, rx_message.rx_datetime)
 
 
+class _RegisteredRxMessage(ttn_handler.RxMessage):
+    """An uplink message with the registered device, as looked up on its reception"""
+
+    def __init__(self, rx_message, device):
+        super().__init__(
+            rx_message.raw_data,
+            rx_message.device_id,
+            rx_message.device_eui,
+            rx_message.rx_datetime,
+            rx_message.rx_port,
+            rx_message.mcs,
+            rx_message.f_cnt,
+        )
+        self.device = device
+
+
+class RegistryForwardingHandler(_SampleForwardingHandler):
+    """A handler for the devices of a device registry, which forwards samples to the backend API
+
+    The registry supplies the protocol of each device, which selects the
+    payload decoder, and its precomputed managair node id. The device is
+    looked up once per uplink, so that a reload of the registry cannot change
+    or remove it halfway through.
+    """
+
+    mode = "registry-forward"
+
+    def __init__(self, ttn_client, api_root, device_registry, sample_archive=None):
+        super().__init__(ttn_client, api_root, sample_archive)
+        self._device_registry = device_registry
+
+    def _receive(self, rx_message):
+        device = self._device_registry.get(rx_message.device_id)
+        if device is None:
+            self.metrics.dropped_messages.inc()
+            logging.warning("Skipping message of unregistered device %s", rx_message.device_id)
+            return
+        super()._receive(_RegisteredRxMessage(rx_message, device))
+
+    def _get_protocol(self, rx_message):
+        return protocols.PROTOCOLS[rx_message.device.protocol]
+
+    def _get_protocol_name(self, rx_message):
+        return rx_message.device.protocol
+
+    def _expected_send_interval(self, rx_message):
+        return device_index.expected_send_interval(
+            self._get_protocol(rx_message).payload_specification, rx_message.mcs
+        )
+
+    def _get_device_uuid(self, rx_message):
+        return rx_message.device.node_id
+
+    def _decode_payload(self, rx_message):
+        return self._get_protocol(rx_message).decode_payload(
+            rx_message.raw_data, rx_message.rx_datetime, rx_message.mcs
+        )
+
+
 class ErsConfigurationHandler(_NodeHandler):
     """A handler for Elsys ERS devices which sends parameter downlink messages"""
 
-    def _is_conforming(self, raw_data, mcs):
-        measurement_count = len(ers.decode_payload(raw_data, dt.datetime.now()))
+    mode = "ers-configure"
+    protocol = "ers"
+
+    def _is_conforming(self, samples, mcs):
+        measurement_count = len(samples)
         logging.debug("Measurement count: %d", measurement_count)
         logging.debug("MCS: {}".format(mcs))
 
@@ -118,8 +385,19 @@ class ErsConfigurationHandler(_NodeHandler):
 
         return measurement_count == expected_measurement_count
 
+    def _get_payload_specification(self):
+        return ers.PROTOCOL_PAYLOAD_SPECIFICATION
+
+    def _decode_payload(self, rx_message):
+        return ers.decode_payload(rx_message.raw_data, rx_message.rx_datetime)
+
     def _handle_message(self, rx_message):
-        if not self._is_conforming(raw_data=rx_message.raw_data, mcs=rx_message.mcs):
+        samples = self._decode(rx_message)
+        self._configure_device(rx_message, samples)
+
+    def _configure_device(self, rx_message, samples):
+        mcs = rx_message.mcs
+        if not self._is_conforming(samples, mcs):
             logging.debug("Message is not conforming to protocol payload specification")
 
             parameter_set = ers.PARAMETER_SETS[mcs]
@@ -129,7 +407,7 @@ class ErsConfigurationHandler(_NodeHandler):
             payload = ers.encode_parameter_set(parameter_set)
             b64_payload = str(base64.b64encode(payload), "ascii")
             # ERS downlink payloads are sent on the configured port + 1
-            tx_port = self.rx_port + 1
+            tx_port = rx_message.rx_port + 1
 
             logging.debug(
                 "sending downlink payload %s (%s) to port %d",
@@ -140,3 +418,17 @@ class ErsConfigurationHandler(_NodeHandler):
             self.ttn_client.send(device_id, tx_port, b64_payload)
         else:
             logging.debug("No change in uplink transmission parameters needed.")
+
+
+class ErsForwardingAndConfigurationHandler(ErsForwardingHandler, ErsConfigurationHandler):
+    """A handler for Elsys ERS devices which forwards samples to the backend API
+    and sends parameter downlink messages, decoding each uplink only once"""
+
+    mode = "ers-forward-configure"
+
+    def _handle_message(self, rx_message):
+        samples = self._decode(rx_message)
+        # Check the configuration first: forwarding rounds the humidity values
+        # of the samples in place, but only their number matters here.
+        self._configure_device(rx_message, samples)
+        self._forward_samples(rx_message, samples)
@@ -0,0 +1,283 @@
+import time
+import queue
+import signal
+import logging
+import threading
+import itertools
+import traceback
+import collections
+import multiprocessing
+import clairttn.metrics as metrics
+
+
+_STOP = None
+# a call of a handler method, answered with (call_id, result) on the reply pipe
+_Call = collections.namedtuple("_Call", ["call_id", "method", "args"])
+
+
+class ProcessPool:
+    """Worker processes which decode and forward uplinks, to use more than one core
+
+    The MQTT threads only extract the uplinks from the TTN messages and hand
+    them to a process chosen by the device EUI, so that the uplinks of a
+    device are handled in order. Uplinks are pickled in batches of up to
+    batch_size, or whatever arrived within flush_interval seconds, and sent
+    through a pipe per process by a writer thread; once a few batches are
+    pending, submit() blocks, like the queues of the WorkerPool. A process
+    which dies is restarted, the uplinks it had received are lost.
+
+    handler_factory must be picklable. It is called once in each process and
+    returns an object with the methods handle(app_id, rx_message,
+    trace_context) and close(), where trace_context is the context() of the
+    span of the uplink in this process.
+    Other methods of the handlers can be called with call(), to query the
+    state kept in the processes.
+    """
+
+    QUEUE_NAME = "processes"
+    # batches waiting for the writer thread of a process
+    PENDING_BATCHES = 2
+    # how often a blocked send checks whether the pool stops
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, handler_factory, processes=2, batch_size=64, flush_interval=0.02):
+        self._handler_factory = handler_factory
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        # spawned, not forked, as the MQTT client threads are running already
+        self._context = multiprocessing.get_context("spawn")
+        self._buffers = [[] for __ in range(processes)]
+        self._locks = [threading.Lock() for __ in range(processes)]
+        self._pending = [None] * processes
+        self._writers = [None] * processes
+        self._connections = [None] * processes
+        self._replies = [None] * processes
+        # one call at a time per process, so that replies are not mixed up
+        self._call_locks = [threading.Lock() for __ in range(processes)]
+        self._call_ids = itertools.count()
+        self._processes = [None] * processes
+        self._stop = threading.Event()
+        # the monotonic time at which stop() gives up on sending
+        self._deadline = None
+        self._flusher = None
+        metrics.QUEUE_DEPTH.labels(self.QUEUE_NAME).set_function(self.depth)
+
+    def depth(self):
+        return sum(len(buffer) for buffer in self._buffers)
+
+    def start(self):
+        self._deadline = None
+        for index in range(len(self._processes)):
+            self._start_process(index)
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._run, name="process-pool", daemon=True)
+        self._flusher.start()
+
+    def _start_process(self, index):
+        receiver, sender = self._context.Pipe(duplex=False)
+        reply_receiver, reply_sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_run_worker,
+            args=(self._handler_factory, receiver, reply_sender),
+            name="clair-worker-{}".format(index),
+            daemon=True,
+        )
+        process.start()
+        receiver.close()
+        reply_sender.close()
+        pending = queue.Queue(self.PENDING_BATCHES)
+        writer = threading.Thread(
+            target=_write, args=(index, pending, sender), name="clair-writer-{}".format(index), daemon=True
+        )
+        writer.start()
+        self._pending[index] = pending
+        self._writers[index] = writer
+        self._connections[index] = sender
+        self._replies[index] = reply_receiver
+        self._processes[index] = process
+
+    def submit(self, app_id, rx_message, trace_context=None):
+        index = int.from_bytes(rx_message.device_eui, "big") % len(self._buffers)
+        with self._locks[index]:
+            self._buffers[index].append((app_id, rx_message, trace_context))
+            if len(self._buffers[index]) >= self._batch_size:
+                self._send(index)
+
+    def _send(self, index):
+        """Send the buffered uplinks of the process; the caller holds its lock."""
+        batch = self._buffers[index]
+        self._buffers[index] = []
+        if not self._put(index, batch):
+            logging.error("worker process %d is stuck, %d uplinks lost", index, len(batch))
+
+    def _put(self, index, message, deadline=None):
+        """Hand the message to the writer thread of the process; False if the
+        deadline, or that of stop(), passed first."""
+        while True:
+            now = time.monotonic()
+            expired = any(d is not None and now >= d for d in (deadline, self._deadline))
+            try:
+                self._pending[index].put(message, block=not expired, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if expired:
+                    return False
+
+    def call(self, method, *args, timeout=5.0):
+        """Call method(*args) on the handler of each process, after the uplinks
+        submitted so far; the results of the processes which answered within
+        timeout seconds."""
+        deadline = time.monotonic() + timeout
+        results = []
+        for index in range(len(self._processes)):
+            with self._call_locks[index]:
+                call = _Call(next(self._call_ids), method, args)
+                with self._locks[index]:
+                    if self._buffers[index]:
+                        self._send(index)
+                    sent = self._put(index, call, deadline)
+                if not sent:
+                    logging.warning("worker process %d did not answer in time", index)
+                    continue
+                result = self._receive_reply(index, call.call_id, deadline)
+            if result is not None:
+                results.append(result)
+        return results
+
+    def _receive_reply(self, index, call_id, deadline):
+        """The result of the call, or None; the caller holds the call lock of the process."""
+        replies = self._replies[index]
+        while True:
+            try:
+                if not replies.poll(max(0.0, deadline - time.monotonic())):
+                    logging.warning("worker process %d did not answer in time", index)
+                    return None
+                reply_id, result = replies.recv()
+            except (EOFError, OSError):
+                return None
+            # skip the late replies to earlier calls
+            if reply_id == call_id:
+                return result
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            for index in range(len(self._processes)):
+                with self._locks[index]:
+                    if self._buffers[index]:
+                        self._send(index)
+                    process = self._processes[index]
+                    # stop() kills the processes which do not finish in time
+                    if not process.is_alive() and not self._stop.is_set():
+                        logging.error(
+                            "worker process %d exited with code %s, restarting", index, process.exitcode
+                        )
+                        # the old reply pipe is closed once garbage collected, after a
+                        # pending call saw its end
+                        self._connections[index].close()
+                        self._stop_writer(index)
+                        self._start_process(index)
+
+    def stop(self, timeout=None):
+        """Handle all submitted uplinks and stop the processes; False if they did
+        not finish within timeout seconds, in which case they are killed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        # a send blocked on a stuck process gives up once the deadline passes
+        self._deadline = deadline
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join(remaining())
+        for index in range(len(self._processes)):
+            if not self._locks[index].acquire(timeout=-1 if deadline is None else remaining()):
+                continue
+            try:
+                if self._buffers[index]:
+                    self._send(index)
+                self._put(index, _STOP)
+            finally:
+                self._locks[index].release()
+        for process in self._processes:
+            process.join(remaining())
+        alive = [process for process in self._processes if process.is_alive()]
+        if alive:
+            logging.warning(
+                "worker processes %s did not finish in time, killing them",
+                ", ".join(process.name for process in alive),
+            )
+            # they ignore SIGTERM, see _run_worker()
+            for process in alive:
+                process.kill()
+            for process in alive:
+                process.join()
+        for writer in self._writers:
+            writer.join(remaining())
+        for connection in self._connections + self._replies:
+            connection.close()
+        for index in range(len(self._writers)):
+            self._stop_writer(index)
+        return not alive
+
+    def _stop_writer(self, index):
+        """Make the writer thread of the process exit, once its pipe is closed"""
+        try:
+            self._pending[index].put_nowait(_STOP)
+        except queue.Full:
+            # it fails on the closed pipe and exits
+            pass
+
+
+def _write(index, pending, connection):
+    """Send the messages of the queue through the pipe to a worker process, until _STOP"""
+    while True:
+        message = pending.get()
+        try:
+            connection.send(message)
+        except (OSError, ValueError) as e:
+            if isinstance(message, list):
+                logging.error("worker process %d is gone, %d uplinks lost: %s", index, len(message), e)
+            if connection.closed:
+                return
+        if message is _STOP:
+            return
+
+
+def _run_worker(handler_factory, connection, replies):
+    # the parent process coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    handler = handler_factory()
+    try:
+        while True:
+            try:
+                batch = connection.recv()
+            except EOFError:
+                break
+            if batch is _STOP:
+                break
+            if isinstance(batch, _Call):
+                _answer(handler, batch, replies)
+                continue
+            for app_id, rx_message, trace_context in batch:
+                try:
+                    handler.handle(app_id, rx_message, trace_context)
+                except Exception as e:
+                    logging.error("exception in worker process: %s", e)
+                    logging.error(traceback.format_exc())
+    finally:
+        handler.close()
+
+
+def _answer(handler, call, replies):
+    result = None
+    try:
+        result = getattr(handler, call.method)(*call.args)
+    except Exception as e:
+        logging.error("exception in worker process calling %s: %s", call.method, e)
+        logging.error(traceback.format_exc())
+    try:
+        replies.send((call.call_id, result))
+    except (OSError, ValueError):
+        pass
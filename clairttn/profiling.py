@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import logging
+import pstats
+import cProfile
+import tempfile
+import threading
+import tracemalloc
+
+
+PROFILE_KINDS = ["cprofile", "tracemalloc"]
+# the longest capture, as the profilers slow down the process
+MAX_PROFILE_SECONDS = 3600
+
+
+class ProfilerBusyException(Exception):
+    """Exception which is thrown if a profile is requested while another one is running"""
+
+    pass
+
+
+class Profiler:
+    """Captures cProfile or tracemalloc snapshots of the running process on demand
+
+    The cProfile profiler only sees the thread which runs under it, so the
+    MQTT and worker threads run their work through runcall(), which uses one
+    profile per thread while a capture is active. The profiles are merged and
+    written to the output directory once the requested number of seconds has
+    passed.
+    """
+
+    # how long to wait for calls still running under a profile at the end of a capture
+    FINISH_TIMEOUT = 10.0
+
+    def __init__(self, output_dir=None, default_seconds=30):
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.default_seconds = default_seconds
+        # the cProfile.Profile per thread ident while a capture is active, else None
+        self._profiles = None
+        # the idents of the threads currently running under their profile
+        self._running = set()
+        self._calls = threading.Condition()
+        self._lock = threading.Lock()
+        self._busy = False
+
+    def runcall(self, function, *args):
+        """Call function(*args), under the current thread's profile during a cProfile capture."""
+        if self._profiles is None:
+            return function(*args)
+        ident = threading.get_ident()
+        with self._calls:
+            if self._profiles is None:
+                profile = None
+            else:
+                profile = self._profiles.get(ident)
+                if profile is None:
+                    profile = self._profiles[ident] = cProfile.Profile()
+                self._running.add(ident)
+        if profile is None:
+            return function(*args)
+        try:
+            try:
+                profile.enable()
+            except ValueError:
+                # since Python 3.12 only one profile can be active at a time,
+                # and it sees all threads
+                return function(*args)
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+        finally:
+            with self._calls:
+                self._running.discard(ident)
+                self._calls.notify_all()
+
+    def start(self, kind, seconds=None):
+        """Start a capture in the background and return the path of the output file."""
+        if kind not in PROFILE_KINDS:
+            raise ValueError("unsupported profile kind: {}".format(kind))
+        seconds = self.default_seconds if seconds is None else seconds
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError(
+                "profile seconds must be greater than 0 and at most {}".format(MAX_PROFILE_SECONDS)
+            )
+        with self._lock:
+            if self._busy:
+                raise ProfilerBusyException("a profile is already being captured")
+            self._busy = True
+
+        try:
+            path = os.path.join(
+                self.output_dir,
+                "clair-ttn-{}-{}.{}".format(
+                    os.getpid(),
+                    time.strftime("%Y%m%dT%H%M%S"),
+                    "prof" if kind == "cprofile" else "tracemalloc",
+                ),
+            )
+            if kind == "cprofile":
+                with self._calls:
+                    self._profiles = {}
+                finish = self._finish_cprofile
+            else:
+                tracemalloc.start(25)
+                finish = self._finish_tracemalloc
+            logging.info("capturing %s profile for %.1f seconds", kind, seconds)
+            timer = threading.Timer(seconds, self._finish, args=(finish, path))
+            timer.daemon = True
+            timer.start()
+        except BaseException:
+            with self._calls:
+                self._profiles = None
+            tracemalloc.stop()
+            with self._lock:
+                self._busy = False
+            raise
+        return path
+
+    def _finish(self, finish, path):
+        try:
+            # write to a temporary file first so that the output appears atomically
+            finish(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            logging.info("profile written to %s", path)
+        except Exception as e:
+            logging.error("failed to write profile %s: %s", path, e)
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def _finish_cprofile(self, path):
+        with self._calls:
+            profiles, self._profiles = self._profiles, None
+            # a profile must not be read while its thread runs under it
+            self._calls.wait_for(lambda: not self._running, timeout=self.FINISH_TIMEOUT)
+            finished = [p for ident, p in profiles.items() if ident not in self._running]
+        if len(finished) < len(profiles):
+            logging.warning("%d threads left out of the profile, still busy",
+                            len(profiles) - len(finished))
+        stats = pstats.Stats(*finished) if finished else pstats.Stats()
+        stats.dump_stats(path)
+
+    def _finish_tracemalloc(self, path):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(path)
+
+
+PROFILER = Profiler()
+
+
+def handle_signal(signal_number, _stack_frame, kind="cprofile"):
+    try:
+        PROFILER.start(kind)
+    except ProfilerBusyException as e:
+        logging.warning("ignoring signal %d: %s", signal_number, e)
+
+
+def profile_route(query):
+    kind = query.get("kind", "cprofile")
+    try:
+        seconds = float(query["seconds"]) if "seconds" in query else None
+        path = PROFILER.start(kind, seconds)
+    except ValueError as e:
+        return 400, "text/plain; charset=utf-8", "{}\n".format(e)
+    except ProfilerBusyException as e:
+        return 409, "text/plain; charset=utf-8", "{}\n".format(e)
+    return 202, "application/json", json.dumps({"kind": kind, "path": path})
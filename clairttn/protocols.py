@@ -0,0 +1,43 @@
+from collections import namedtuple
+import clairttn.clairchen as clairchen
+import clairttn.ers as ers
+import clairttn.oy1012 as oy1012
+
+
+Protocol = namedtuple('Protocol', [
+    'name',
+    'uuid_class',
+    'decode_payload',
+    'payload_specification'])
+Protocol.__doc__ = """The device UUID, payload decoder and payload specification of a node protocol
+
+decode_payload takes the raw payload, the reception time and the MCS of an
+uplink for all protocols, whether they need the MCS or not.
+"""
+
+
+def _decode_ers_payload(raw_data, rx_datetime, _mcs):
+    return ers.decode_payload(raw_data, rx_datetime)
+
+
+def _decode_oy1012_payload(raw_data, rx_datetime, _mcs):
+    return oy1012.decode_payload(raw_data, rx_datetime)
+
+
+PROTOCOLS = {
+    'clairchen': Protocol(
+        name='clairchen',
+        uuid_class=clairchen.ClairchenDeviceUUID,
+        decode_payload=clairchen.decode_payload,
+        payload_specification=clairchen.PROTOCOL_PAYLOAD_SPECIFICATION),
+    'ers': Protocol(
+        name='ers',
+        uuid_class=ers.ErsDeviceUUID,
+        decode_payload=_decode_ers_payload,
+        payload_specification=ers.PROTOCOL_PAYLOAD_SPECIFICATION),
+    'oy1012': Protocol(
+        name='oy1012',
+        uuid_class=oy1012.Oy1012DeviceUUID,
+        decode_payload=_decode_oy1012_payload,
+        payload_specification=None),
+}
@@ -0,0 +1,119 @@
+import os
+import csv
+import logging
+import threading
+from collections import namedtuple
+import clairttn.protocols as protocols
+
+
+Device = namedtuple('Device', [
+    'device_id',
+    'device_eui',
+    'protocol',
+    'node_id',
+    'enabled'])
+Device.__doc__ = """A registered device: its TTN device id and EUI, its protocol name, its
+managair node id and whether its uplinks are processed"""
+
+
+class RegistryException(Exception):
+    """Raised for an invalid device registry file"""
+
+
+def load_devices(path):
+    """Load the devices from a CSV file with a header line.
+
+    The columns device_id, dev_eui and protocol are required. node_id defaults
+    to the device UUID derived from the EUI, and enabled to true.
+    """
+    devices = []
+    with open(path, newline='') as fd:
+        reader = csv.DictReader(fd)
+        try:
+            missing = {'device_id', 'dev_eui', 'protocol'} - set(reader.fieldnames or ())
+            if missing:
+                raise RegistryException("{} lacks the columns {}".format(path, ", ".join(sorted(missing))))
+            for row in reader:
+                if not row['device_id'] or row['device_id'].startswith('#'):
+                    continue
+                try:
+                    device_eui = bytes.fromhex(row['dev_eui'])
+                    protocol = protocols.PROTOCOLS[row['protocol']]
+                except (ValueError, KeyError, TypeError) as e:
+                    # a short row lacks values, which DictReader sets to None
+                    raise RegistryException("invalid device {} in line {}: {}".format(
+                        row['device_id'], reader.line_num, e))
+                node_id = row.get('node_id') or str(protocol.uuid_class(device_eui))
+                enabled = (row.get('enabled') or 'true').strip().lower() not in ('false', 'no', '0')
+                devices.append(Device(row['device_id'], device_eui, protocol.name, node_id, enabled))
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise RegistryException("{} in line {}: {}".format(path, reader.line_num, e))
+    return devices
+
+
+class DeviceRegistry:
+    """The registered devices, indexed by device id and EUI, reloaded when the file changes
+
+    Lookups are plain dictionary accesses. A reload builds new indexes and
+    swaps them in at once, so lookups never see a partially loaded registry;
+    if the changed file is invalid, the previous registry stays in effect.
+    """
+
+    def __init__(self, path, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._by_device_id = {}
+        self._by_device_eui = {}
+        self._mtime = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.reload_if_changed()
+        if self._mtime is None:
+            raise RegistryException("cannot load the device registry {}".format(path))
+
+    def __len__(self):
+        return len(self._by_device_id)
+
+    def get(self, device_id):
+        """The registered device of the device id, None if unknown."""
+        return self._by_device_id.get(device_id)
+
+    def get_by_eui(self, device_eui):
+        return self._by_device_eui.get(device_eui)
+
+    def is_enabled(self, device_id):
+        device = self._by_device_id.get(device_id)
+        return device is not None and device.enabled
+
+    def reload_if_changed(self):
+        """Reload the registry if the file was modified; return whether it was reloaded."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return False
+            devices = load_devices(self.path)
+        except (OSError, RegistryException) as e:
+            logging.error("keeping the previous device registry: %s", e)
+            return False
+        self._by_device_id, self._by_device_eui = (
+            {d.device_id: d for d in devices},
+            {d.device_eui: d for d in devices},
+        )
+        self._mtime = mtime
+        logging.info("loaded %d devices from %s", len(devices), self.path)
+        return True
+
+    def start(self):
+        """Watch the file for changes in a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="device-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.reload_interval):
+            self.reload_if_changed()
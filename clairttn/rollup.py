@@ -0,0 +1,177 @@
+import time
+import logging
+import threading
+import traceback
+import clairttn.metrics as metrics
+import clairttn.sinks as sinks
+
+
+FIELDS = ["co2_ppm", "temperature_celsius", "rel_humidity_percent"]
+
+
+class _Bucket:
+    __slots__ = ("device_id", "count", "counts", "sums", "minima", "maxima")
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.count = 0
+        self.counts = [0] * len(FIELDS)
+        self.sums = [0.0] * len(FIELDS)
+        self.minima = [None] * len(FIELDS)
+        self.maxima = [None] * len(FIELDS)
+
+    def add(self, attributes):
+        self.count += 1
+        for i, field in enumerate(FIELDS):
+            value = attributes.get(field)
+            if value is None:
+                continue
+            self.counts[i] += 1
+            self.sums[i] += value
+            if self.minima[i] is None or value < self.minima[i]:
+                self.minima[i] = value
+            if self.maxima[i] is None or value > self.maxima[i]:
+                self.maxima[i] = value
+
+    def attributes(self, start, interval):
+        attributes = {"timestamp_s": start, "interval_s": interval, "sample_count": self.count}
+        for i, field in enumerate(FIELDS):
+            if self.counts[i]:
+                attributes[field] = self.sums[i] / self.counts[i]
+                attributes[field + "_min"] = self.minima[i]
+                attributes[field + "_max"] = self.maxima[i]
+        return attributes
+
+
+def ingest_attributes(rollup_attributes):
+    """The sample attributes of the ingest endpoint for a rollup: its mean values at the start of the bucket"""
+    sample_attributes = {
+        "timestamp_s": rollup_attributes["timestamp_s"],
+        "co2_ppm": round(rollup_attributes["co2_ppm"], 1),
+    }
+    if "temperature_celsius" in rollup_attributes:
+        sample_attributes["temperature_celsius"] = round(rollup_attributes["temperature_celsius"], 1)
+    if "rel_humidity_percent" in rollup_attributes:
+        # the ingest enpdoint expects the rel. humidity to be an integer
+        sample_attributes["rel_humidity_percent"] = round(rollup_attributes["rel_humidity_percent"])
+    return sample_attributes
+
+
+class RollupStage:
+    """Aggregates the samples of each node into buckets of fixed intervals, fed like an output sink
+
+    A bucket keeps the count and the minimum, maximum and mean of each
+    measurement. It is closed once the node has sent a sample lateness
+    seconds past its end: the samples of a node arrive in order, also those
+    of the multi-sample ERS and Clairchen uplinks, which are timestamped
+    back from their reception. If the node falls silent, the bucket is closed
+    silence_timeout seconds after its end, which exceeds the longest span of
+    a multi-sample uplink. Samples for a closed bucket are counted as late and
+    left out of the rollups.
+
+    Closed buckets are written to the sinks as SampleRecords of the rollup
+    attributes, and those of the shortest interval are passed to forward(node
+    id, sample attributes) to be posted to the ingest endpoint. The buckets
+    still open on shutdown are written to the sinks only: the rest of their
+    samples may arrive after a restart, and the ingest endpoint takes one
+    sample per node and timestamp.
+    """
+
+    def __init__(self, intervals=(300,), lateness=60, silence_timeout=7200, forward=None,
+                 flush_interval=5):
+        self.name = "rollup"
+        self.intervals = sorted(intervals)
+        self.lateness = lateness
+        self.silence_timeout = silence_timeout
+        self.forward = forward
+        self.flush_interval = flush_interval
+        self.sinks = []
+        # (node id, interval, bucket start) -> _Bucket
+        self._buckets = {}
+        # node id -> the latest sample timestamp of the node
+        self._watermarks = {}
+        # (node id, interval) -> the start of the last closed bucket
+        self._closed = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, record):
+        timestamp = record.attributes["timestamp_s"]
+        with self._lock:
+            for interval in self.intervals:
+                start = timestamp - timestamp % interval
+                if start <= self._closed.get((record.node_id, interval), -1):
+                    metrics.LATE_SAMPLES.labels(str(interval)).inc()
+                    continue
+                key = (record.node_id, interval, start)
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = _Bucket(record.device_id)
+                bucket.add(record.attributes)
+            watermark = self._watermarks.get(record.node_id)
+            if watermark is None or timestamp > watermark:
+                self._watermarks[record.node_id] = timestamp
+
+    def _take_closed_buckets(self, now, force):
+        """The closed buckets, or all buckets if forced, as (key, bucket, whether it was closed)"""
+        with self._lock:
+            taken = []
+            for key in sorted(self._buckets):
+                node_id, interval, start = key
+                closed = (
+                    self._watermarks[node_id] >= start + interval + self.lateness
+                    or now >= start + interval + self.silence_timeout
+                )
+                if not (closed or force):
+                    continue
+                taken.append((key, self._buckets.pop(key), closed))
+                self._closed[(node_id, interval)] = max(start, self._closed.get((node_id, interval), -1))
+            return taken
+
+    def flush(self, now=None, force=False, deadline=None):
+        """Write the closed buckets, or all buckets if forced, see stop(); False if
+        rollups were not forwarded as the monotonic deadline had passed."""
+        now = time.time() if now is None else now
+        unforwarded = 0
+        for (node_id, interval, start), bucket, closed in self._take_closed_buckets(now, force):
+            attributes = bucket.attributes(start, interval)
+            metrics.ROLLUPS.labels(str(interval)).inc()
+            record = sinks.SampleRecord(node_id, bucket.device_id, attributes)
+            for sink in self.sinks:
+                sink.submit(record)
+            if not (self.forward and closed and interval == self.intervals[0]):
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                unforwarded += 1
+                continue
+            try:
+                self.forward(node_id, ingest_attributes(attributes))
+            except Exception as e:
+                logging.error("forwarding the rollup of node %s failed: %s", node_id, e)
+                logging.debug(traceback.format_exc())
+        if unforwarded:
+            logging.warning("%d rollups not forwarded in time", unforwarded)
+        return not unforwarded
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rollup", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self, timeout=None):
+        """Write all buckets, also those which are still open, whose rollups only
+        cover the samples received so far and are not forwarded; False if the
+        closed buckets could not be forwarded within timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.warning("the rollup flush did not finish in time")
+        flushed = self.flush(force=True, deadline=deadline)
+        return flushed and not (self._thread and self._thread.is_alive())
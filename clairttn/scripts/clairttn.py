@@ -8,24 +8,283 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
 import click
+import json
 import signal
 import time
+import collections
+import threading
+import functools
 import clairttn.node_handler as clhandler
 import clairttn.ttn_handler as ttnhandler
+import clairttn.admin as admin
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.tracing as tracing
+import clairttn.profiling as profiling
+import clairttn.archive as archive
+import clairttn.storage as storage
+import clairttn.config as config
+import clairttn.workers as workers
+import clairttn.process_pool as process_pool
+import clairttn.registry as registry
+import clairttn.negative_cache as negative_cache
+import clairttn.dead_letter as dead_letter
+import clairttn.sinks as sinks
+import clairttn.analytics as analytics
+import clairttn.rollup as rollup
 
-signal_received = False
+shutdown_requested = threading.Event()
 
 
 def handle_signal(signal_number, _stack_frame):
-    logging.debug("signal {} received".format(signal_number))
-    global signal_received
-    signal_received = True
+    logging.info("signal %d received, shutting down", signal_number)
+    shutdown_requested.set()
 
 
-HANDLERS = ["clairchen-forward", "ers-forward", "ers-configure", "oy1012-forward"]
+HANDLERS = [
+    "clairchen-forward",
+    "ers-forward",
+    "ers-configure",
+    "ers-forward-configure",
+    "oy1012-forward",
+    "registry-forward",
+]
+
+# the modes which can run in worker processes, as they send no downlinks
+FORWARDING_MODES = [
+    "clairchen-forward",
+    "ers-forward",
+    "oy1012-forward",
+    "registry-forward",
+]
 
 STACKS = ["ttn-v2", "ttn-v3"]
 
+FORWARD = ["raw", "rollups", "both"]
+
+# worker threads shared by several applications, unless set with --workers
+DEFAULT_WORKERS = 4
+
+
+class _ForwardingProcess:
+    """The node handlers of all applications in a worker process"""
+
+    def __init__(self, app_configs, device_registry_file):
+        self._device_registry = None
+        if device_registry_file:
+            self._device_registry = registry.DeviceRegistry(device_registry_file)
+            self._device_registry.start()
+        self._ttn_handlers = {}
+        for app_config in app_configs:
+            # never connected, it only handles the uplinks received by the parent
+            ttn_handler = _create_ttn_handler(app_config, "Clair-Berlin-worker")
+            _create_node_handler(app_config, ttn_handler, None, self._device_registry)
+            self._ttn_handlers[app_config.app_id] = ttn_handler
+
+    def handle(self, app_id, rx_message, trace_context):
+        # continues the receive span of the main process
+        with tracing.TRACER.continue_trace("handle", trace_context) as span:
+            self._ttn_handlers[app_id]._call_handler(rx_message, span)
+
+    def admin_route(self, route, query):
+        return route(query)
+
+    def metrics_snapshot(self):
+        return metrics.REGISTRY.snapshot()
+
+    def backend_state(self):
+        return health.HEALTH.backend_state()
+
+    def close(self):
+        if self._device_registry:
+            self._device_registry.stop()
+        dead_letter.DEAD_LETTERS.close()
+        tracing.TRACER.shutdown()
+
+
+class _ForwardingProcessFactory:
+    """Sets up a worker process like the parent process, see process_pool.ProcessPool"""
+
+    def __init__(self, app_configs, device_registry_file, reject_ttl, reject_spool_dir,
+                 dead_letter_file, dead_letter_log_interval, trace_file=None,
+                 trace_endpoint=None, trace_sample_ratio=1.0):
+        self.app_configs = app_configs
+        self.device_registry_file = device_registry_file
+        self.reject_ttl = reject_ttl
+        self.reject_spool_dir = reject_spool_dir
+        self.dead_letter_file = dead_letter_file
+        self.dead_letter_log_interval = dead_letter_log_interval
+        self.trace_file = trace_file
+        self.trace_endpoint = trace_endpoint
+        self.trace_sample_ratio = trace_sample_ratio
+
+    def __call__(self):
+        _configure_tracing(self.trace_file, self.trace_endpoint, self.trace_sample_ratio)
+        negative_cache.NEGATIVE_CACHE.ttl = self.reject_ttl
+        if self.reject_spool_dir:
+            negative_cache.NEGATIVE_CACHE.set_spool_dir(self.reject_spool_dir)
+        dead_letter.DEAD_LETTERS.log_interval = self.dead_letter_log_interval
+        if self.dead_letter_file:
+            dead_letter.DEAD_LETTERS.open(self.dead_letter_file)
+        return _ForwardingProcess(self.app_configs, self.device_registry_file)
+
+
+def _configure_tracing(trace_file, trace_endpoint, trace_sample_ratio):
+    if trace_file:
+        tracing.TRACER.configure(tracing.FileExporter(trace_file), trace_sample_ratio)
+    elif trace_endpoint:
+        tracing.TRACER.configure(
+            tracing.OtlpHttpExporter(trace_endpoint), trace_sample_ratio
+        )
+
+
+# seconds to wait for the worker processes to answer an admin request
+RELAY_TIMEOUT = 1.0
+
+
+def _merge_lists(responses):
+    merged = []
+    for __, __, body in responses:
+        merged.extend(json.loads(body))
+    return 200, "application/json", json.dumps(merged)
+
+
+def _merge_invalidated(responses):
+    count = sum(json.loads(body)["invalidated"] for __, __, body in responses)
+    return 200, "application/json", json.dumps({"invalidated": count})
+
+
+def _merge_dead_letters(responses):
+    by_device = collections.Counter()
+    by_error = collections.Counter()
+    for __, __, body in responses:
+        counts = json.loads(body)
+        by_device.update(counts["by_device"])
+        by_error.update(counts["by_error"])
+    return 200, "application/json", json.dumps(
+        {"by_device": dict(by_device.most_common()), "by_error": dict(by_error.most_common())}
+    )
+
+
+def _merge_last_seen(responses):
+    # a device is handled by one process only; the others do not know it
+    for response in responses:
+        if response[0] != 404:
+            return response
+    return responses[0]
+
+
+_RELAYED_ROUTES = [
+    ("GET", "/devices/silent", _merge_lists),
+    ("GET", "/devices/last-seen", _merge_last_seen),
+    ("GET", "/nodes/rejected", _merge_lists),
+    ("POST", "/nodes/invalidate", _merge_invalidated),
+    ("GET", "/dead-letters", _merge_dead_letters),
+]
+
+
+def _relayed_route(worker_pool, route, merge, query):
+    responses = [route(query)]
+    responses.extend(worker_pool.call("admin_route", route, query, timeout=RELAY_TIMEOUT))
+    return merge(responses)
+
+
+def _relayed_metrics_route(worker_pool, route, query):
+    snapshots = worker_pool.call("metrics_snapshot", timeout=RELAY_TIMEOUT)
+    return route(query, snapshots)
+
+
+def _relay_to_processes(admin_server, worker_pool):
+    """Answer the admin requests for the state kept per process with that of all processes"""
+    for method, path, merge in _RELAYED_ROUTES:
+        # the routes are module functions, which the worker processes call on their own state
+        route = admin_server.get_route(method, path)
+        admin_server.add_route(
+            path, functools.partial(_relayed_route, worker_pool, route, merge), methods=(method,)
+        )
+    # the metrics of the processes are added up
+    for path in ("/metrics", "/latency"):
+        route = admin_server.get_route("GET", path)
+        admin_server.add_route(path, functools.partial(_relayed_metrics_route, worker_pool, route))
+    health.HEALTH.backend_sources.append(
+        functools.partial(worker_pool.call, "backend_state", timeout=RELAY_TIMEOUT)
+    )
+
+
+def _drain(node_handlers, worker_pool, output_sinks, timeout):
+    """Stop receiving uplinks, hand those received so far to the backend and the sinks, and disconnect.
+
+    Returns False if that took longer than timeout seconds, in which case the
+    remaining uplinks and samples are lost.
+    """
+    deadline = time.monotonic() + timeout
+
+    def remaining():
+        return max(0.0, deadline - time.monotonic())
+
+    health.HEALTH.draining = True
+    for node_handler in node_handlers:
+        node_handler.stop_receiving()
+    drained = True
+    if worker_pool:
+        drained = worker_pool.stop(remaining())
+    else:
+        for node_handler in node_handlers:
+            drained = node_handler.drain(remaining()) and drained
+    for output_sink in output_sinks:
+        drained = output_sink.stop(remaining()) and drained
+    for node_handler in node_handlers:
+        drained = node_handler.disconnect_and_close(remaining()) and drained
+    if not drained:
+        logging.warning("shutdown timeout of %gs exceeded", timeout)
+    return drained
+
+
+def _create_sinks(specs, param_hint):
+    try:
+        return [sinks.BufferedSink(sinks.create_sink(spec)) for spec in specs]
+    except (OSError, sinks.SinkException) as e:
+        raise click.BadParameter(str(e), param_hint=param_hint)
+    except ImportError as e:
+        raise click.BadParameter(
+            "{}: pip install clairttn[compact]".format(e), param_hint=param_hint
+        )
+
+
+def _create_ttn_handler(app_config, client_id):
+    if app_config.stack == "ttn-v2":
+        return ttnhandler.TtnV2Handler(app_config.app_id, app_config.access_key, client_id)
+    elif app_config.stack == "ttn-v3":
+        return ttnhandler.TtnV3Handler(app_config.app_id, app_config.access_key, client_id)
+    raise click.BadParameter(
+        "invalid TTN stack {} of {}".format(app_config.stack, app_config.app_id)
+    )
+
+
+def _create_node_handler(app_config, ttn_handler, sample_archive, device_registry):
+    """Select the appropriate payload handler for the configured type of node."""
+    mode = app_config.mode
+    api_root = app_config.api_root
+    if mode == "clairchen-forward":
+        return clhandler.ClairchenForwardingHandler(ttn_handler, api_root, sample_archive)
+    elif mode == "ers-forward":
+        return clhandler.ErsForwardingHandler(ttn_handler, api_root, sample_archive)
+    elif mode == "ers-configure":
+        return clhandler.ErsConfigurationHandler(ttn_handler)
+    elif mode == "ers-forward-configure":
+        return clhandler.ErsForwardingAndConfigurationHandler(
+            ttn_handler, api_root, sample_archive
+        )
+    elif mode == "oy1012-forward":
+        return clhandler.Oy1012ForwardingHandler(ttn_handler, api_root, sample_archive)
+    elif mode == "registry-forward":
+        if device_registry is None:
+            raise click.UsageError("the registry-forward mode requires --device-registry")
+        return clhandler.RegistryForwardingHandler(
+            ttn_handler, api_root, device_registry, sample_archive
+        )
+    raise click.BadParameter("invalid mode {} of {}".format(mode, app_config.app_id))
+
 
 @click.command()
 @click.option(
@@ -39,11 +298,15 @@ STACKS = ["ttn-v2", "ttn-v3"]
     "-k",
     "--access-key-file",
     envvar="CLAIR_TTN_ACCESS_KEY_FILE",
-    required=True,
     type=click.File(),
+    help="Required unless the applications are configured with --config.",
 )
 @click.option(
-    "-m", "--mode", type=click.Choice(HANDLERS), envvar="CLAIR_MODE", required=True
+    "-m",
+    "--mode",
+    type=click.Choice(HANDLERS),
+    envvar="CLAIR_MODE",
+    help="Required unless set for each application with --config.",
 )
 @click.option(
     "-r",
@@ -58,45 +321,437 @@ STACKS = ["ttn-v2", "ttn-v3"]
     type=click.Choice(STACKS),
     envvar="CLAIR_TTN_STACK",
     default="ttn-v2",
+    show_default=True,
+)
+@click.option(
+    "-c",
+    "--config",
+    "config_file",
+    type=click.Path(exists=True, dir_okay=False),
+    envvar="CLAIR_CONFIG",
+    help="INI file with a section per TTN application, instead of --app-id and --access-key-file.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    "worker_count",
+    type=click.IntRange(min=0),
+    envvar="CLAIR_WORKERS",
+    show_default="{} with several applications, else 0".format(DEFAULT_WORKERS),
+    help="Threads decoding and forwarding uplinks of all applications; 0 uses the MQTT threads.",
+)
+@click.option(
+    "-p",
+    "--processes",
+    type=click.IntRange(min=0),
+    envvar="CLAIR_PROCESSES",
+    default=0,
+    show_default=True,
+    help="Processes decoding and forwarding uplinks, instead of --workers threads; forwarding modes only.",
+)
+@click.option(
+    "--device-registry",
+    type=click.Path(exists=True, dir_okay=False),
+    envvar="CLAIR_DEVICE_REGISTRY",
+    help="CSV file of the devices to process; reloaded when changed.",
+)
+@click.option(
+    "--sink",
+    "sink_specs",
+    multiple=True,
+    envvar="CLAIR_SINKS",
+    help="Also write the forwarded samples to this sink, e.g. ndjson:samples.ndjson; repeatable.",
+)
+@click.option(
+    "--alert-sink",
+    "alert_sink_specs",
+    multiple=True,
+    envvar="CLAIR_ALERT_SINKS",
+    help="Send ventilation alerts to this webhook or mqtt:// URL; repeatable.",
+)
+@click.option(
+    "--alert-threshold",
+    "alert_thresholds",
+    type=click.IntRange(min=1),
+    multiple=True,
+    envvar="CLAIR_ALERT_THRESHOLDS",
+    default=(1000, 1400),
+    show_default=True,
+    help="CO2 concentration in ppm which raises an alert; repeatable.",
+)
+@click.option(
+    "--alert-hysteresis",
+    type=click.IntRange(min=0),
+    envvar="CLAIR_ALERT_HYSTERESIS",
+    default=100,
+    show_default=True,
+    help="ppm below a threshold at which its alert is cleared.",
+)
+@click.option(
+    "--statistics-window",
+    type=click.FloatRange(min=1),
+    envvar="CLAIR_STATISTICS_WINDOW",
+    default=3600,
+    show_default=True,
+    help="Seconds of samples covered by the rolling statistics of a node.",
+)
+@click.option(
+    "--rollup-interval",
+    "rollup_intervals",
+    type=click.IntRange(min=1),
+    multiple=True,
+    envvar="CLAIR_ROLLUP_INTERVALS",
+    help="Aggregate the samples of each node over this many seconds, e.g. 300; repeatable.",
+)
+@click.option(
+    "--rollup-lateness",
+    type=click.FloatRange(min=0),
+    envvar="CLAIR_ROLLUP_LATENESS",
+    default=60,
+    show_default=True,
+    help="Seconds past its end to wait for late samples of a rollup.",
+)
+@click.option(
+    "--rollup-sink",
+    "rollup_sink_specs",
+    multiple=True,
+    envvar="CLAIR_ROLLUP_SINKS",
+    help="Write the rollups to this sink, e.g. influx:<write URL>; repeatable.",
+)
+@click.option(
+    "--forward",
+    type=click.Choice(FORWARD),
+    envvar="CLAIR_FORWARD",
+    default="raw",
+    show_default=True,
+    help="Post the raw samples, the rollups of the shortest interval, or both to the ingest endpoint.",
+)
+@click.option(
+    "--admin-host",
+    envvar="CLAIR_ADMIN_HOST",
+    default="127.0.0.1",
+    show_default=True,
+)
+@click.option(
+    "--admin-port",
+    type=int,
+    envvar="CLAIR_ADMIN_PORT",
+    default=8090,
+    show_default=True,
+)
+@click.option(
+    "--max-uplink-silence",
+    type=float,
+    envvar="CLAIR_MAX_UPLINK_SILENCE",
+    help="Seconds without uplinks after which the service is reported unready.",
+)
+@click.option(
+    "--trace-file",
+    envvar="CLAIR_TRACE_FILE",
+    help="Append OTLP/JSON trace spans to this file.",
+)
+@click.option(
+    "--trace-endpoint",
+    envvar="CLAIR_TRACE_ENDPOINT",
+    help="Send trace spans to this OTLP/HTTP endpoint, e.g. http://localhost:4318/v1/traces",
+)
+@click.option(
+    "--trace-sample-ratio",
+    type=click.FloatRange(0.0, 1.0),
+    envvar="CLAIR_TRACE_SAMPLE_RATIO",
+    default=1.0,
+    show_default=True,
+)
+@click.option(
+    "--profile-dir",
+    type=click.Path(file_okay=False, writable=True),
+    envvar="CLAIR_PROFILE_DIR",
+    help="Directory for profiles captured on SIGUSR1 (cProfile) or SIGUSR2 (tracemalloc).",
+)
+@click.option(
+    "--profile-seconds",
+    type=click.FloatRange(min=0, min_open=True, max=profiling.MAX_PROFILE_SECONDS),
+    envvar="CLAIR_PROFILE_SECONDS",
+    default=30,
+    show_default=True,
+)
+@click.option(
+    "--archive-file",
+    type=click.Path(dir_okay=False, writable=True),
+    envvar="CLAIR_ARCHIVE_FILE",
+    help="Keep a local SQLite archive of all forwarded samples in this file.",
+)
+@click.option(
+    "--archive-retention",
+    envvar="CLAIR_ARCHIVE_RETENTION",
+    default="30d",
+    show_default=True,
+    help="Archived samples older than this are deleted, e.g. 7d or 12h.",
+)
+@click.option(
+    "--backfill/--no-backfill",
+    envvar="CLAIR_BACKFILL",
+    default=False,
+    show_default=True,
+    help="Recover lost uplinks from the TTN Storage Integration (ttn-v3 only).",
+)
+@click.option(
+    "--storage-url",
+    envvar="CLAIR_STORAGE_URL",
+    default="https://eu1.cloud.thethings.network/",
+    show_default=True,
 )
-def main(app_id, access_key_file, mode, api_root, stack):
+@click.option(
+    "--backfill-delay",
+    type=float,
+    envvar="CLAIR_BACKFILL_DELAY",
+    default=60,
+    show_default=True,
+    help="Seconds to wait for lost uplinks to reach the Storage Integration.",
+)
+@click.option(
+    "--reject-ttl",
+    type=click.FloatRange(min=0),
+    envvar="CLAIR_REJECT_TTL",
+    default=600,
+    show_default=True,
+    help="Seconds to skip the samples of a node after the backend rejected it.",
+)
+@click.option(
+    "--reject-spool-dir",
+    type=click.Path(file_okay=False, writable=True),
+    envvar="CLAIR_REJECT_SPOOL_DIR",
+    help="Spool the skipped samples here and post them once the node is accepted.",
+)
+@click.option(
+    "--dead-letter-file",
+    type=click.Path(dir_okay=False, writable=True),
+    envvar="CLAIR_DEAD_LETTER_FILE",
+    help="Append the uplinks which cannot be decoded to this file, see clair-replay-dead-letters.",
+)
+@click.option(
+    "--dead-letter-log-interval",
+    type=click.FloatRange(min=0),
+    envvar="CLAIR_DEAD_LETTER_LOG_INTERVAL",
+    default=60,
+    show_default=True,
+    help="Seconds between log lines for undecodable uplinks of the same device and error.",
+)
+@click.option(
+    "--shutdown-timeout",
+    type=click.FloatRange(min=0),
+    envvar="CLAIR_SHUTDOWN_TIMEOUT",
+    default=8,
+    show_default=True,
+    help="Seconds to finish handling the received uplinks on SIGTERM or SIGINT.",
+)
+def main(
+    app_id,
+    access_key_file,
+    mode,
+    api_root,
+    stack,
+    config_file,
+    worker_count,
+    processes,
+    device_registry,
+    sink_specs,
+    alert_sink_specs,
+    alert_thresholds,
+    alert_hysteresis,
+    statistics_window,
+    rollup_intervals,
+    rollup_lateness,
+    rollup_sink_specs,
+    forward,
+    admin_host,
+    admin_port,
+    max_uplink_silence,
+    trace_file,
+    trace_endpoint,
+    trace_sample_ratio,
+    profile_dir,
+    profile_seconds,
+    archive_file,
+    archive_retention,
+    backfill,
+    storage_url,
+    backfill_delay,
+    reject_ttl,
+    reject_spool_dir,
+    dead_letter_file,
+    dead_letter_log_interval,
+    shutdown_timeout,
+):
     """Clair TTN application that can be run in one of the following modes:
 
     \b
     * Clairchen forwarding
     * ERS forwarding
     * ERS configuration
+    * ERS forwarding and configuration
     * OY1012 forwarding
+    * Forwarding for the devices of a device registry, of any protocol
+
+    Several TTN applications, each with its own mode, can be served by a
+    single process with --config; their uplinks are handled by a shared pool
+    of worker threads.
     """
     signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    profiling.PROFILER.output_dir = profile_dir or profiling.PROFILER.output_dir
+    profiling.PROFILER.default_seconds = profile_seconds
+    signal.signal(signal.SIGUSR1, profiling.handle_signal)
+    signal.signal(
+        signal.SIGUSR2, functools.partial(profiling.handle_signal, kind="tracemalloc")
+    )
+
+    _configure_tracing(trace_file, trace_endpoint, trace_sample_ratio)
 
-    access_key = access_key_file.read().rstrip("\n")
-    if stack == "ttn-v2":
-        ttn_handler = ttnhandler.TtnV2Handler(app_id, access_key)
-    elif stack == "ttn-v3":
-        ttn_handler = ttnhandler.TtnV3Handler(app_id, access_key)
+    if config_file:
+        try:
+            app_configs = config.load_app_configs(
+                config_file, {"mode": mode, "stack": stack, "api_root": api_root}
+            )
+        except (OSError, config.ConfigException) as e:
+            raise click.BadParameter(str(e), param_hint="--config")
+    elif access_key_file and mode:
+        access_key = access_key_file.read().rstrip("\n")
+        app_configs = [config.AppConfig(app_id, access_key, mode, stack, api_root)]
     else:
-        # never reached thanks to click's option parsing
-        click.echo("invalid TTN stack: {}".format(stack))
-        return
+        raise click.UsageError("either --config or --access-key-file and --mode are required")
 
-    # Select the appropriate payload handler for the configured type of node.
-    if mode == "clairchen-forward":
-        node_handler = clhandler.ClairchenForwardingHandler(ttn_handler, api_root)
-    elif mode == "ers-forward":
-        node_handler = clhandler.ErsForwardingHandler(ttn_handler, api_root)
-    elif mode == "ers-configure":
-        node_handler = clhandler.ErsConfigurationHandler(ttn_handler)
-    elif mode == "oy1012-forward":
-        node_handler = clhandler.Oy1012ForwardingHandler(ttn_handler, api_root)
+    negative_cache.NEGATIVE_CACHE.ttl = reject_ttl
+    if reject_spool_dir:
+        negative_cache.NEGATIVE_CACHE.set_spool_dir(reject_spool_dir)
+
+    dead_letter.DEAD_LETTERS.log_interval = dead_letter_log_interval
+    if dead_letter_file:
+        dead_letter.DEAD_LETTERS.open(dead_letter_file)
+
+    sample_archive = None
+    if archive_file:
+        try:
+            retention = storage.parse_duration(archive_retention).total_seconds()
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--archive-retention")
+        sample_archive = archive.SampleArchive(archive_file, retention)
+
+    if processes:
+        if any(app_config.mode not in FORWARDING_MODES for app_config in app_configs):
+            raise click.UsageError(
+                "--processes supports the modes {} only".format(", ".join(FORWARDING_MODES))
+            )
+        if archive_file or sink_specs or alert_sink_specs or rollup_intervals:
+            raise click.UsageError(
+                "--processes cannot be combined with --archive-file, --sink, --alert-sink or --rollup-interval"
+            )
+
+    if rollup_intervals and forward == "raw" and not rollup_sink_specs:
+        raise click.UsageError("--rollup-interval requires --rollup-sink or --forward rollups or both")
+    if not rollup_intervals and (forward != "raw" or rollup_sink_specs):
+        raise click.UsageError("--forward {} and --rollup-sink require --rollup-interval".format(forward))
+
+    device_registry_file = device_registry
+    if device_registry:
+        try:
+            device_registry = registry.DeviceRegistry(device_registry)
+        except registry.RegistryException as e:
+            raise click.BadParameter(str(e), param_hint="--device-registry")
+
+    output_sinks = _create_sinks(sink_specs, "--sink")
+    rollup_sinks = _create_sinks(rollup_sink_specs, "--rollup-sink")
+
+    sample_analytics = None
+    if alert_sink_specs:
+        sample_analytics = analytics.Analytics(statistics_window, alert_thresholds, alert_hysteresis)
+        try:
+            sample_analytics.event_sinks = [
+                analytics.create_event_sink(spec) for spec in alert_sink_specs
+            ]
+        except sinks.SinkException as e:
+            raise click.BadParameter(str(e), param_hint="--alert-sink")
+        # fed with the samples like a sink, and drained with them
+        output_sinks.append(sample_analytics)
+
+    if processes:
+        worker_pool = process_pool.ProcessPool(
+            _ForwardingProcessFactory(
+                app_configs,
+                device_registry_file,
+                reject_ttl,
+                reject_spool_dir,
+                dead_letter_file,
+                dead_letter_log_interval,
+                trace_file,
+                trace_endpoint,
+                trace_sample_ratio,
+            ),
+            processes,
+        )
+    elif worker_count or (worker_count is None and len(app_configs) > 1):
+        worker_pool = workers.WorkerPool(worker_count or DEFAULT_WORKERS)
     else:
-        # never reached thanks to click's option parsing
-        click.echo("invalid mode: {}".format(mode))
-        return
+        worker_pool = None
+    node_handlers = []
+    rollup_stages = []
+    for app_config in app_configs:
+        # each application has a persistent MQTT session of its own
+        client_id = "Clair-Berlin" if len(app_configs) == 1 else "Clair-Berlin-" + app_config.app_id
+        ttn_handler = _create_ttn_handler(app_config, client_id)
+        if backfill and isinstance(ttn_handler, ttnhandler.TtnV3Handler):
+            ttn_handler.enable_backfill(storage_url, app_config.access_key, backfill_delay)
+        if processes:
+            ttn_handler.process_pool = worker_pool
+        else:
+            ttn_handler.worker_pool = worker_pool
+        ttn_handler.device_registry = device_registry
+        node_handler = _create_node_handler(
+            app_config, ttn_handler, sample_archive, device_registry
+        )
+        node_handler.sinks = output_sinks
+        if rollup_intervals:
+            rollup_stage = rollup.RollupStage(rollup_intervals, rollup_lateness)
+            rollup_stage.sinks = rollup_sinks
+            if forward != "raw":
+                rollup_stage.forward = node_handler.forward_rollup
+            node_handler.forward_raw = forward != "rollups"
+            node_handler.sinks = output_sinks + [rollup_stage]
+            rollup_stages.append(rollup_stage)
+        node_handlers.append(node_handler)
+    # in the order of draining, the rollup stages write to the rollup sinks
+    output_sinks = output_sinks + rollup_stages + rollup_sinks
+
+    health.HEALTH.max_uplink_silence = max_uplink_silence
+    admin_server = None
+    if admin_port:
+        admin_server = admin.AdminServer(admin_host, admin_port)
+        if sample_archive:
+            admin_server.add_route("/archive/samples", sample_archive.query_route)
+        if sample_analytics:
+            admin_server.add_route("/nodes/statistics", sample_analytics.statistics_route)
+        if processes:
+            _relay_to_processes(admin_server, worker_pool)
+        admin_server.start()
 
-    node_handler.connect()
+    if device_registry:
+        device_registry.start()
+    for output_sink in output_sinks:
+        output_sink.start()
+    if worker_pool:
+        worker_pool.start()
+    for node_handler in node_handlers:
+        node_handler.connect()
 
-    while not signal_received:
-        time.sleep(1)
+    shutdown_requested.wait()
 
-    node_handler.disconnect_and_close()
+    _drain(node_handlers, worker_pool, output_sinks, shutdown_timeout)
+    if device_registry:
+        device_registry.stop()
+    if sample_archive:
+        sample_archive.close()
+    dead_letter.DEAD_LETTERS.close()
+    tracing.TRACER.shutdown()
+    if admin_server:
+        admin_server.stop()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import importlib
+import click
+
+
+# Subcommands are imported on first use only, so that a short-lived command
+# like get-device-id does not pay for the MQTT and HTTP client libraries.
+SUBCOMMANDS = {
+    "ttn": "clairttn.scripts.clairttn:main",
+    "get-device-id": "clairttn.scripts.get_clair_id:get_device_id",
+    "generate-fixtures": "clairttn.scripts.generate_fixtures:generate_fixtures",
+    "register-device": "clairttn.scripts.register_device:register_device_in_managair",
+    "nfc-config": "clairttn.scripts.nfc_config:generate_nfc_config",
+    "query-archive": "clairttn.scripts.query_archive:query_archive",
+    "replay-dead-letters": "clairttn.scripts.replay_dead_letters:replay_dead_letters",
+}
+
+
+class _LazyGroup(click.Group):
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self._lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self._lazy_subcommands:
+            return self._load(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load(self, cmd_name):
+        module_name, attribute = self._lazy_subcommands[cmd_name].split(":")
+        module = importlib.import_module(module_name)
+        return getattr(module, attribute)
+
+
+@click.group(cls=_LazyGroup, lazy_subcommands=SUBCOMMANDS)
+def cli():
+    """Clair TTN application and device management tools."""
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 import click
-import requests
-import base64
-import json
+import logging
+import tempfile
+import datetime as dt
+import dateutil.parser as dtparser
 import clairttn.ers as ers
-import clairttn.clairchen as clairchen
 import clairttn.types as types
-import dateutil.parser as dtparser
+import clairttn.protocols as protocols
+import clairttn.storage as storage
+import clairttn.fixtures as fixtures
+import clairttn.ttn_handler as ttnhandler
 
 
 UUID_MAP = {
@@ -24,63 +27,148 @@ UUID_MAP = {
 }
 
 
+def _node_id(rx_message, protocol, derive_uuid):
+    if rx_message.device_id in UUID_MAP:
+        return UUID_MAP[rx_message.device_id]
+    if derive_uuid:
+        # the bulk-load formats go straight into the node column, which needs a UUID
+        return str(protocol.uuid_class(rx_message.device_eui))
+    return rx_message.device_id
+
+
+def _decode_fixtures(uplinks, protocol, derive_uuid=False):
+    for uplink in uplinks:
+        rx_message = ttnhandler.extract_v3_rx_message(uplink)
+        if not rx_message:
+            continue
+        try:
+            samples = protocol.decode_payload(
+                rx_message.raw_data, rx_message.rx_datetime, rx_message.mcs)
+        except (types.PayloadContentException, types.PayloadFormatException) as e:
+            logging.warning("skipping uplink of %s: %s", rx_message.device_id, e)
+            continue
+        node = _node_id(rx_message, protocol, derive_uuid)
+        for sample in samples:
+            yield {
+                'model': 'core.sample',
+                'fields': fixtures.sample_fields(node, sample)
+            }
+
+
+def _fixture_timestamp(fixture):
+    return fixture['fields']['timestamp_s']
+
+
+OUTPUT_FORMATS = ['fixtures', 'csv', 'tsv'] + fixtures.COLUMNAR_FORMATS
+
+
+def _create_row_writer(output_format, output):
+    if output_format in fixtures.COLUMNAR_FORMATS:
+        if output == '-':
+            raise click.UsageError("--output is required for the {} format".format(output_format))
+        try:
+            return fixtures.ColumnarWriter(output, output_format)
+        except ImportError:
+            raise click.UsageError(
+                "the {} format requires pyarrow: pip install clairttn[columnar]".format(output_format))
+    fd = click.open_file(output, 'w', encoding='utf8')
+    if output_format == 'csv':
+        return fixtures.CopyCsvWriter(fd)
+    return fixtures.CopyTextWriter(fd)
+
+
+def _parse_time(value):
+    timestamp = dtparser.parse(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+    return timestamp
+
+
+def _iter_spooled_uplinks(spool_paths):
+    for spool_path in spool_paths:
+        with open(spool_path, 'rb') as fd:
+            yield from storage.iter_uplinks(fd)
+
+
 @click.command()
 @click.option('-b', '--base-url', default='https://eu1.cloud.thethings.network/', show_default=True)
-@click.option('-d', '--duration', default='24h', show_default=True)
+@click.option('-d', '--duration', default='24h', show_default=True,
+              help='Length of the time range, ending at --before.')
+@click.option('--after', help='Start of the time range (ISO 8601), instead of --duration.')
+@click.option('--before', help='End of the time range (ISO 8601).  [default: now]')
+@click.option('-w', '--window', default='1h', show_default=True,
+              help='The time range is fetched in windows of this length.')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=4, show_default=True,
+              help='Number of windows fetched concurrently.')
+@click.option('--work-dir', type=click.Path(file_okay=False, writable=True),
+              help='Directory for fetched windows and the cursor to resume an interrupted export.')
+@click.option('-p', '--protocol', type=click.Choice(sorted(protocols.PROTOCOLS)), default='ers', show_default=True)
+@click.option('-f', '--format', 'output_format', type=click.Choice(OUTPUT_FORMATS),
+              default='fixtures', show_default=True,
+              help='Django fixtures, PostgreSQL COPY input (csv, tsv), Parquet or Arrow IPC.')
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+              default='-', show_default=True)
+@click.option('--sort-run-size', type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Number of fixtures sorted in memory before spilling to a temporary file.')
 @click.argument('application-id')
 @click.argument('access-key-file', type=click.File())
-def generate_fixtures(application_id, access_key_file, base_url, duration):
+def generate_fixtures(application_id, access_key_file, base_url, duration, after, before,
+                      window, jobs, work_dir, protocol, output_format, output, sort_run_size):
     """Generate fixtures from the TTN's Storage integration (v3).
 
     \b
     APPLICATIION_ID is the id of the TTN app.
     ACCESS_KEY_FILE is the file containing the TTN app's access key.
-    """
-
-    access_key = access_key_file.read().rstrip('\n')
-
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': "Bearer {}".format(access_key)
-    }
-
-    base_url = base_url.rstrip('/ ')
-
-    url = "{}/api/v3/as/applications/{}/packages/storage/uplink_message".format(base_url, application_id)
-
-    params = { 'last': duration }
 
-    response = requests.get(url, headers=headers, params=params)
+    The time range is split into windows which are fetched concurrently and
+    merged in order. If --work-dir is given, an interrupted export continues
+    with the missing windows when run again with the same arguments; without
+    --before, it ends at the time the interrupted export was started. The
+    uplinks are decoded one by one, and the fixtures are sorted by timestamp
+    with an external merge sort, so that memory usage stays bounded for long
+    storage windows.
 
-    pdus = list(map(lambda l: json.loads(l), response.text.splitlines()))
-
-    fixtures = []
-    for pdu in pdus:
-        payload = base64.b64decode(pdu['result']['uplink_message']['frm_payload'])
-        rx_datetime = dtparser.parse(pdu['result']['uplink_message']['received_at'])
-        device_id = pdu['result']['end_device_ids']['device_id']
-        try:
-            samples = ers.decode_payload(payload, rx_datetime)
-        except types.PayloadContentException:
-            continue
-        for sample in samples:
-            fields = {
-                'node': UUID_MAP.get(device_id, device_id),
-                'timestamp_s': sample.timestamp.value,
-                'co2_ppm': sample.co2.value,
-                'measurement_status': 'M'
-            }
-            if sample.temperature:
-                fields['temperature_celsius'] = sample.temperature.value
-            if sample.relative_humidity:
-                fields['rel_humidity_percent'] = sample.relative_humidity.value
-
-            fixture = {
-                'model': 'core.sample',
-                'fields': fields
-            }
+    The bulk-load formats are written unsorted, row by row as the samples are
+    decoded.
+    """
 
-            fixtures.append(fixture)
+    access_key = access_key_file.read().rstrip('\n')
 
-    fixtures.sort(key=lambda f: f['fields']['timestamp_s'])
-    print(json.dumps(fixtures, indent=4))
+    url = storage.uplink_url(base_url, application_id)
+    headers = storage.request_headers(access_key)
+    session = storage.create_session(pool_size=jobs)
+
+    try:
+        if before:
+            before = _parse_time(before)
+        elif work_dir:
+            # continue an interrupted export up to the time it was started at
+            before = storage.WindowedFetcher(session, url, headers, work_dir).stored_before()
+        before = before or dt.datetime.now(dt.timezone.utc)
+        after = _parse_time(after) if after else before - storage.parse_duration(duration)
+        windows = storage.split_windows(after, before, storage.parse_duration(window))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if output_format == 'fixtures':
+        sorter = fixtures.ExternalSorter(key=_fixture_timestamp, run_size=sort_run_size)
+    else:
+        row_writer = _create_row_writer(output_format, output)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fetcher = storage.WindowedFetcher(session, url, headers, work_dir or tmp_dir, jobs=jobs)
+        uplinks = _iter_spooled_uplinks(fetcher.fetch(windows))
+        for fixture in _decode_fixtures(uplinks, protocols.PROTOCOLS[protocol],
+                                        derive_uuid=output_format != 'fixtures'):
+            if output_format == 'fixtures':
+                sorter.add(fixture)
+            else:
+                row_writer.write(fixture['fields'])
+
+    if output_format == 'fixtures':
+        writer = fixtures.FixtureWriter(click.open_file(output, 'w', encoding='utf8'))
+        for fixture in sorter.sorted():
+            writer.write(fixture)
+        writer.close()
+    else:
+        row_writer.close()
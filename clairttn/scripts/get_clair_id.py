@@ -1,16 +1,142 @@
 #!/usr/bin/env python3
 
+import csv
+import json
+import sys
 import click
-import clairttn.ers as ers
+import clairttn.protocols as protocols
+
+
+# EUIs are hashed in chunks so that a process pool is fed with a few large
+# tasks rather than with one task per EUI.
+CHUNK_SIZE = 10000
+
+
+def _derive(dev_eui, protocol):
+    return str(protocols.PROTOCOLS[protocol].uuid_class(bytes.fromhex(dev_eui)))
+
+
+def _derive_chunk(chunk):
+    results = []
+    for dev_eui, protocol in chunk:
+        try:
+            device_id = _derive(dev_eui, protocol)
+        except (ValueError, KeyError):
+            device_id = None
+        results.append((dev_eui, protocol, device_id))
+    return results
+
+
+def _read_chunks(fd, default_protocol):
+    """Read (EUI, protocol) pairs from CSV lines, with an optional protocol column."""
+    chunk = []
+    for row in csv.reader(fd):
+        if not row or not row[0].strip() or row[0].startswith("#"):
+            continue
+        dev_eui = row[0].strip()
+        if dev_eui.lower() in ("dev_eui", "eui", "device_eui"):
+            continue
+        protocol = row[1].strip() if len(row) > 1 and row[1].strip() else default_protocol
+        chunk.append((dev_eui, protocol))
+        if len(chunk) >= CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _derive_chunks(chunks, jobs):
+    if jobs == 1:
+        yield from map(_derive_chunk, chunks)
+        return
+    import collections
+    import concurrent.futures
+    # keep a bounded number of chunks in flight and emit results in input order
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_derive_chunk, chunk))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _CsvOutput:
+    def __init__(self, fd):
+        self._writer = csv.writer(fd, lineterminator="\n")
+        self._writer.writerow(["dev_eui", "protocol", "device_id"])
+
+    def write(self, dev_eui, protocol, device_id):
+        self._writer.writerow([dev_eui, protocol, device_id])
+
+
+class _JsonOutput:
+    def __init__(self, fd):
+        self._fd = fd
+
+    def write(self, dev_eui, protocol, device_id):
+        self._fd.write(json.dumps({"dev_eui": dev_eui, "protocol": protocol, "device_id": device_id}))
+        self._fd.write("\n")
+
+
+OUTPUT_FORMATS = {"csv": _CsvOutput, "json": _JsonOutput}
 
 
 @click.command()
-@click.argument("dev-eui")
-def get_device_id(dev_eui):
-    """Convert a device EUI of an Elsys ERS sensor node to the corresponding managair device id.
+@click.argument("dev-eui", required=False)
+@click.option(
+    "-p",
+    "--protocol",
+    type=click.Choice(sorted(protocols.PROTOCOLS)),
+    default="ers",
+    show_default=True,
+    help="Device protocol, unless given per line in batch mode.",
+)
+@click.option(
+    "-f",
+    "--eui-file",
+    type=click.File("r"),
+    help="Batch mode: read EUIs from this CSV file, or - for stdin.",
+)
+@click.option(
+    "-o", "--output-format", type=click.Choice(sorted(OUTPUT_FORMATS)), default="csv", show_default=True
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of processes hashing EUIs in batch mode.",
+)
+def get_device_id(dev_eui, protocol, eui_file, output_format, jobs):
+    """Convert a LoRaWAN device EUI to the corresponding managair device id.
 
     \b
     DEV_EUI is the LoraWAN device EUI.
+
+    Without DEV_EUI, EUIs are read in batch mode from the --eui-file, or from
+    stdin. Each line holds an EUI and, optionally, the device protocol in a
+    second column. A CSV or JSON line is written per EUI; the device id of an
+    invalid EUI is empty (or null), and the exit status is 1.
     """
 
-    print(ers.ErsDeviceUUID(bytes.fromhex(dev_eui)))
+    if dev_eui is not None:
+        if eui_file is not None:
+            raise click.UsageError("DEV_EUI and --eui-file are mutually exclusive")
+        print(_derive(dev_eui, protocol))
+        return
+
+    output = OUTPUT_FORMATS[output_format](sys.stdout)
+    chunks = _read_chunks(eui_file or sys.stdin, protocol)
+    failed = 0
+    for results in _derive_chunks(chunks, jobs):
+        for dev_eui, device_protocol, device_id in results:
+            output.write(dev_eui, device_protocol, device_id)
+            if device_id is None:
+                failed += 1
+    sys.stdout.flush()
+    if failed:
+        click.echo("{} EUIs could not be converted".format(failed), err=True)
+        sys.exit(1)
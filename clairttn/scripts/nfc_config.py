@@ -1,24 +1,36 @@
 #!/usr/bin/env python3
 
+import csv
+import io
+import zipfile
 import click
 import pyqrcode
+import clairttn.ers as ers
+import clairttn.types as t
 
 
-def _generate_nfc_config(join_eui, app_key):
+DEFAULT_MCS = t.LoRaWanMcs.SF10BW125
+
+
+def _generate_nfc_config(join_eui, app_key, parameter_set=ers.PARAMETER_SETS[DEFAULT_MCS]):
     nfc_config = """\
 AppEui:{}
 AppKey:{}
 Ota:true
 Ack:false
-SplPer:356
+SplPer:{}
 Co2Per:1
-TempPer:0
-SendPer:3
+TempPer:{}
+SendPer:{}
 VddPer:0
 QSize:5
 QOffset:false
 QPurge:true""".format(
-        join_eui, app_key
+        join_eui,
+        app_key,
+        parameter_set.sampling_period,
+        parameter_set.temperature_period,
+        parameter_set.send_period,
     )
 
     return nfc_config
@@ -29,20 +41,117 @@ def _generate_qr_png(nfc_config, fila_name):
     config_code.png(fila_name, scale=4)
 
 
+def _render_device(device, parameter_set):
+    """Render the config and the QR code PNG of a (dev_eui, join_eui, app_key) tuple."""
+    dev_eui, join_eui, app_key = device
+    nfc_config = _generate_nfc_config(join_eui, app_key, parameter_set)
+    png = io.BytesIO()
+    _generate_qr_png(nfc_config, png)
+    return dev_eui, nfc_config, png.getvalue()
+
+
+def _read_devices(fd):
+    """Read (dev_eui, join_eui, app_key) tuples from CSV lines, skipping a header."""
+    for row in csv.reader(fd):
+        row = [column.strip() for column in row]
+        if not row or not row[0] or row[0].startswith("#"):
+            continue
+        if row[0].lower() == "dev_eui":
+            continue
+        if len(row) < 3:
+            raise click.BadParameter("expected dev_eui,join_eui,app_key, got: {}".format(",".join(row)))
+        yield tuple(row[:3])
+
+
+def _render_devices(devices, parameter_set, jobs):
+    if jobs == 1:
+        for device in devices:
+            yield _render_device(device, parameter_set)
+        return
+    import concurrent.futures
+    import functools
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        render = functools.partial(_render_device, parameter_set=parameter_set)
+        yield from executor.map(render, devices, chunksize=8)
+
+
+def _write_archive(fd, rendered_devices):
+    """Write the rendered configs to a zip archive as they become available.
+
+    fd need not be seekable, so that the archive can be streamed to stdout.
+    """
+    count = 0
+    with zipfile.ZipFile(fd, "w") as archive:
+        for dev_eui, nfc_config, png in rendered_devices:
+            archive.writestr(
+                "{}-nfc-config.txt".format(dev_eui), nfc_config, compress_type=zipfile.ZIP_DEFLATED
+            )
+            # PNGs are compressed already
+            archive.writestr("{}-nfc-config.png".format(dev_eui), png, compress_type=zipfile.ZIP_STORED)
+            count += 1
+    return count
+
+
 @click.command()
-@click.argument("join-eui")
-@click.argument("dev-eui")
-@click.argument("app-key")
-def generate_nfc_config(join_eui, dev_eui, app_key):
+@click.argument("join-eui", required=False)
+@click.argument("dev-eui", required=False)
+@click.argument("app-key", required=False)
+@click.option(
+    "-m",
+    "--mcs",
+    type=click.Choice([mcs.name for mcs in t.LoRaWanMcs]),
+    default=DEFAULT_MCS.name,
+    show_default=True,
+    help="Expected modulation and coding scheme, which determines the sampling and send periods.",
+)
+@click.option(
+    "-b",
+    "--batch-file",
+    type=click.File("r"),
+    help="Batch mode: read dev_eui,join_eui,app_key lines from this CSV file, or - for stdin.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("wb", lazy=True),
+    default="nfc-configs.zip",
+    show_default=True,
+    help="Zip archive written in batch mode, or - for stdout.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of processes rendering QR codes in batch mode.",
+)
+def generate_nfc_config(join_eui, dev_eui, app_key, mcs, batch_file, output, jobs):
     """Create NFC config files for Elsys ERS CO2 sensors..
 
     \b
     JOIN_EUI to join a specific TTN application.
     DEV_EUI is the TTN device EUI.
     APP_KEY is the TTN's app_key root key.
+
+    In batch mode, the configs and QR codes of all devices in the --batch-file
+    are written to a single zip archive instead.
     """
 
-    nfc_config = _generate_nfc_config(join_eui, app_key)
+    parameter_set = ers.PARAMETER_SETS[t.LoRaWanMcs[mcs]]
+
+    if batch_file is not None:
+        if join_eui is not None:
+            raise click.UsageError("the device arguments and --batch-file are mutually exclusive")
+        rendered_devices = _render_devices(_read_devices(batch_file), parameter_set, jobs)
+        count = _write_archive(output, rendered_devices)
+        click.echo("wrote NFC configs of {} devices".format(count), err=True)
+        return
+
+    if app_key is None:
+        raise click.UsageError("JOIN_EUI, DEV_EUI and APP_KEY are required without --batch-file")
+
+    nfc_config = _generate_nfc_config(join_eui, app_key, parameter_set)
 
     with open("{}-nfc-config.txt".format(dev_eui), "w") as fd:
         fd.write(nfc_config)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import sys
+import click
+import datetime as dt
+import dateutil.parser as dtparser
+import clairttn.archive as archive
+
+
+def _parse_time(value):
+    timestamp = dtparser.parse(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+    return timestamp
+
+
+@click.command()
+@click.argument('archive-file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('node')
+@click.option('--after', help='Start of the time range (ISO 8601).  [default: 24 hours before --before]')
+@click.option('--before', help='End of the time range (ISO 8601).  [default: now]')
+@click.option('-f', '--format', 'output_format', type=click.Choice(['csv', 'json']),
+              default='csv', show_default=True)
+def query_archive(archive_file, node, after, before, output_format):
+    """Print the archived samples of a node in a time range.
+
+    \b
+    ARCHIVE_FILE is the sample archive written by clair-ttn --archive-file.
+    NODE is the managair node id, see clair-get-device-id.
+    """
+
+    try:
+        before = _parse_time(before) if before else dt.datetime.now(dt.timezone.utc)
+        after = _parse_time(after) if after else before - dt.timedelta(days=1)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    samples = archive.query_samples(archive_file, node, after.timestamp(), before.timestamp())
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, archive.COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(samples)
+    else:
+        for sample in samples:
+            print(json.dumps(sample))
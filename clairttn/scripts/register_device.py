@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 import click
-import clairttn.ers as ers
+import clairttn.protocols as protocols
 import sys
+import csv
 import requests
+import requests.adapters
 import jsonapi_requests as jarequests
 import json
 import getpass
+import urllib.parse
+import concurrent.futures
 
 
 class _TokenAuth(requests.auth.AuthBase):
@@ -18,13 +22,54 @@ class _TokenAuth(requests.auth.AuthBase):
         return r
 
 
-def _login(api_root):
-    login_endpoint = jarequests.Api.config({"API_ROOT": api_root}).endpoint(
+JSONAPI_HEADERS = {
+    "Content-Type": "application/vnd.api+json",
+    "Accept": "application/vnd.api+json",
+}
+
+
+class _NodesEndpoint:
+    """The nodes endpoint of the managair, requested through one pooled requests
+    session instead of opening a connection per request"""
+
+    def __init__(self, api_root, session, auth, timeout=10):
+        self._url = urllib.parse.urljoin(api_root, "nodes/")
+        self._session = session
+        self._auth = auth
+        self._timeout = timeout
+
+    def get(self, params):
+        return self._request("GET", params=params)
+
+    def post(self, node_object):
+        return self._request("POST", json={"data": node_object.as_data()})
+
+    def _request(self, method, **kwargs):
+        response = self._session.request(
+            method, self._url, headers=JSONAPI_HEADERS, auth=self._auth,
+            timeout=self._timeout, **kwargs
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def _create_session(pool_size):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _login(api_root, username=None, password=None):
+    login_endpoint = jarequests.Api.config({"API_ROOT": api_root, "TIMEOUT": 10}).endpoint(
         "auth/login"
     )
 
-    username = input("Username: ")
-    password = getpass.getpass()
+    username = username or input("Username: ")
+    password = password or getpass.getpass()
 
     login_object = jarequests.JsonApiObject(
         type="LoginView", attributes={"username": username, "password": password}
@@ -40,21 +85,28 @@ def _login(api_root):
     return r.data.attributes["key"]
 
 
-def _create_node(
-    api_root, key, device_eui, alias_prefix, protocol_id, model_id, owner_id
-):
-    api = jarequests.Api.config({"API_ROOT": api_root, "AUTH": _TokenAuth(key)})
-
-    nodes_endpoint = api.endpoint("nodes")
+def _fetch_existing_node_ids(nodes_endpoint, page_size=500):
+    node_ids = set()
+    page_number = 1
+    while True:
+        payload = nodes_endpoint.get(
+            params={"page[number]": page_number, "page[size]": page_size}
+        )
+        node_ids.update(node["id"] for node in payload.get("data", []))
+        if not (payload.get("links") or {}).get("next"):
+            return node_ids
+        page_number += 1
 
-    device_id = str(ers.ErsDeviceUUID(bytes.fromhex(device_eui)))
 
+def _create_node(
+    nodes_endpoint, device_id, device_eui, alias_prefix, protocol_id, model_id, owner_id
+):
     node_object = jarequests.JsonApiObject(
         type="Node",
         id=device_id,
         attributes={
             "eui64": device_eui,
-            "alias": "{}{}".format(alias_prefix, device_eui),
+            "alias": "{}{}".format(alias_prefix or "", device_eui),
         },
         relationships={
             "protocol": {"data": {"type": "Protocol", "id": protocol_id}},
@@ -63,7 +115,57 @@ def _create_node(
         },
     )
 
-    return nodes_endpoint.post(object=node_object)
+    return nodes_endpoint.post(node_object)
+
+
+def _register(nodes_endpoint, device_id, device_eui, *args):
+    result = {"dev_eui": device_eui, "node_id": device_id}
+    try:
+        _create_node(nodes_endpoint, device_id, device_eui, *args)
+    except requests.HTTPError as e:
+        result["status"] = "failed"
+        result["error"] = "HTTP {}: {}".format(
+            e.response.status_code, e.response.content.decode("utf8", errors="replace")
+        )
+    except (requests.RequestException, ValueError) as e:
+        result["status"] = "failed"
+        result["error"] = repr(e)
+    else:
+        result["status"] = "created"
+    return result
+
+
+def _is_eui(eui):
+    """Whether eui is the hex representation of an 8 byte device EUI"""
+    try:
+        return len(bytes.fromhex(eui)) == 8
+    except ValueError:
+        return False
+
+
+def _validate_euis(_context, param, device_euis):
+    for eui in device_euis:
+        if not _is_eui(eui):
+            raise click.BadParameter("not an 8 byte hex EUI: {}".format(eui), param=param)
+    return device_euis
+
+
+def _read_euis(eui_file):
+    """Read device EUIs from the first column of a CSV file or a plain list."""
+    for line_number, row in enumerate(csv.reader(eui_file), 1):
+        if not row or not row[0].strip() or row[0].lstrip().startswith("#"):
+            continue
+        eui = row[0].strip()
+        try:
+            bytes.fromhex(eui)
+        except ValueError:
+            # skip a header line
+            continue
+        if not _is_eui(eui):
+            raise click.BadParameter(
+                "not an 8 byte hex EUI in line {}: {}".format(line_number, eui), param_hint="--eui-file"
+            )
+        yield eui
 
 
 @click.command()
@@ -71,12 +173,46 @@ def _create_node(
     "-r", "--api-root", default="http://localhost:8888/api/v1/", show_default=True
 )
 @click.option("-a", "--alias-prefix")
+@click.option(
+    "-f",
+    "--eui-file",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="Read device EUIs from the first column of this CSV file, or - for stdin.",
+)
+@click.option(
+    "-p",
+    "--device-protocol",
+    type=click.Choice(sorted(protocols.PROTOCOLS)),
+    default="ers",
+    show_default=True,
+    help="Device protocol from which the node id is derived.",
+)
+@click.option("-u", "--username", envvar="CLAIR_MANAGAIR_USERNAME")
+@click.option("--password", envvar="CLAIR_MANAGAIR_PASSWORD", hidden=True)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Number of nodes created concurrently.",
+)
 @click.argument("protocol-id")
 @click.argument("model-id")
 @click.argument("owner-id")
-@click.argument("device-eui", nargs=-1)
+@click.argument("device-eui", nargs=-1, callback=_validate_euis)
 def register_device_in_managair(
-    api_root, alias_prefix, protocol_id, model_id, owner_id, device_eui
+    api_root,
+    alias_prefix,
+    eui_file,
+    device_protocol,
+    username,
+    password,
+    jobs,
+    protocol_id,
+    model_id,
+    owner_id,
+    device_eui,
 ):
     """Register Clair TTN nodes in the managair.
 
@@ -87,14 +223,60 @@ def register_device_in_managair(
     DEVICE_EUI is the TTN device EUI.
 
     You will be prompted to enter usename and password of an account which
-    needs to be a member of the owner organization. The account needs to have
-    the right to create a node.
-    """
+    needs to be a member of the owner organization, unless they are given
+    with -u and the CLAIR_MANAGAIR_PASSWORD environment variable; this is
+    required when the EUIs are read from stdin. The account needs to have the
+    right to create a node.
 
-    key = _login(api_root)
+    Nodes which already exist in the managair are skipped, the others are
+    created concurrently. A JSON result line is printed per device, with the
+    status created, exists or failed.
+    """
 
-    for dev_eui in device_eui:
-        response = _create_node(
-            api_root, key, dev_eui, alias_prefix, protocol_id, model_id, owner_id
+    if eui_file == "-" and not (username and password):
+        raise click.UsageError(
+            "-u and CLAIR_MANAGAIR_PASSWORD are required when the EUIs are read from stdin"
         )
-        print(response)
+
+    device_euis = list(device_eui)
+    if eui_file:
+        with click.open_file(eui_file) as fd:
+            device_euis.extend(_read_euis(fd))
+    uuid_class = protocols.PROTOCOLS[device_protocol].uuid_class
+    device_ids = {eui: str(uuid_class(bytes.fromhex(eui))) for eui in device_euis}
+
+    session = _create_session(jobs)
+    key = _login(api_root, username, password)
+    nodes_endpoint = _NodesEndpoint(api_root, session, _TokenAuth(key))
+
+    existing_node_ids = _fetch_existing_node_ids(nodes_endpoint)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for dev_eui, device_id in device_ids.items():
+            if device_id in existing_node_ids:
+                results[dev_eui] = {
+                    "dev_eui": dev_eui,
+                    "node_id": device_id,
+                    "status": "exists",
+                }
+            else:
+                futures[dev_eui] = executor.submit(
+                    _register,
+                    nodes_endpoint,
+                    device_id,
+                    dev_eui,
+                    alias_prefix,
+                    protocol_id,
+                    model_id,
+                    owner_id,
+                )
+        for dev_eui, future in futures.items():
+            results[dev_eui] = future.result()
+
+    for dev_eui in device_ids:
+        print(json.dumps(results[dev_eui]))
+
+    if any(r["status"] == "failed" for r in results.values()):
+        sys.exit(1)
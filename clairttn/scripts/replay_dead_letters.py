@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import json
+import collections
+import click
+import datetime as dt
+import dateutil.parser as dtparser
+import clairttn.dead_letter as dead_letter
+import clairttn.protocols as protocols
+import clairttn.types as types
+
+
+def _replay(letter, protocol_name):
+    """Decode the payload of a dead letter; return the samples."""
+    protocol = protocols.PROTOCOLS[protocol_name]
+    if letter.rx_datetime:
+        rx_datetime = dtparser.parse(letter.rx_datetime)
+    else:
+        rx_datetime = dt.datetime.fromtimestamp(letter.recorded_at, dt.timezone.utc)
+    mcs = types.LoRaWanMcs[letter.mcs] if letter.mcs else types.LoRaWanMcs.SF9BW125
+    return protocol.decode_payload(bytes.fromhex(letter.payload), rx_datetime, mcs)
+
+
+def _sample_record(letter, sample):
+    return {
+        "device_id": letter.device_id,
+        "timestamp_s": sample.timestamp.value,
+        "co2_ppm": sample.co2.value,
+        "temperature_celsius": sample.temperature.value if sample.temperature else None,
+        "rel_humidity_percent": sample.relative_humidity.value if sample.relative_humidity else None,
+    }
+
+
+@click.command()
+@click.argument('dead-letter-file', type=click.Path(exists=True, dir_okay=False))
+@click.option('-d', '--device', 'device_ids', multiple=True, help='Replay the dead letters of this device id only.')
+@click.option('-e', '--error', 'errors', multiple=True,
+              help='Replay the dead letters of this exception class only, e.g. PayloadContentException.')
+@click.option('-p', '--protocol', type=click.Choice(list(protocols.PROTOCOLS)),
+              help='Decode with this protocol instead of the recorded one.')
+@click.option('-r', '--remaining', type=click.Path(dir_okay=False, writable=True),
+              help='Write the dead letters which still fail, or were not replayed, to this file.')
+def replay_dead_letters(dead_letter_file, device_ids, errors, protocol, remaining):
+    """Re-run the payloads quarantined by clair-ttn --dead-letter-file through the decoders.
+
+    The samples of the payloads which can be decoded now are printed as JSON
+    lines, and a summary of the results is printed to stderr.
+    """
+
+    counts = collections.Counter()
+    remaining_letters = []
+    for letter in dead_letter.read_dead_letters(dead_letter_file):
+        protocol_name = protocol or letter.protocol
+        if (device_ids and letter.device_id not in device_ids) or (errors and letter.error not in errors):
+            remaining_letters.append(letter)
+            continue
+        if protocol_name is None or letter.payload is None:
+            counts['no protocol or payload'] += 1
+            remaining_letters.append(letter)
+            continue
+        try:
+            samples = _replay(letter, protocol_name)
+        except Exception as e:
+            counts[type(e).__name__] += 1
+            remaining_letters.append(letter)
+            continue
+        counts['decoded'] += 1
+        for sample in samples:
+            click.echo(json.dumps(_sample_record(letter, sample)))
+
+    for result, count in sorted(counts.items()):
+        click.echo("{}: {}".format(result, count), err=True)
+    if remaining:
+        dead_letter.write_dead_letters(remaining, remaining_letters)
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import urllib.parse
+from collections import namedtuple
+import requests
+import jsonapi_requests as jarequests
+import paho.mqtt.client as mqtt
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.encoding as encoding
+
+
+SampleRecord = namedtuple('SampleRecord', [
+    'node_id',
+    'device_id',
+    'attributes'])
+SampleRecord.__doc__ = """A decoded sample as handed to the sinks: the managair node id, the TTN
+device id and the sample attributes of the ingest endpoint (timestamp_s,
+co2_ppm and optionally temperature_celsius and rel_humidity_percent)"""
+
+
+# put into a BatchQueue to stop waiting for more items
+_WAKEUP = object()
+
+
+class SinkException(Exception):
+    """Raised for an invalid sink specification"""
+
+
+class JsonApiSink:
+    """Posts samples to a JSON:API ingest endpoint, one request per sample"""
+
+    def __init__(self, api_root):
+        self.name = "jsonapi:" + api_root
+        api = jarequests.Api.config({"API_ROOT": api_root, "TIMEOUT": 5, "RETRIES": 0})
+        self._endpoint = api.endpoint("ingest")
+
+    def write(self, records):
+        for record in records:
+            self._endpoint.post(object=jarequests.JsonApiObject(
+                type="Sample",
+                attributes=record.attributes,
+                relationships={"node": {"data": {"type": "Node", "id": record.node_id}}},
+            ))
+
+    def close(self):
+        pass
+
+
+class CompactIngestSink:
+    """Posts sample batches to the ingest endpoint in the compact encoding, one request per batch
+
+    The encoding is negotiated via the content type: if the endpoint responds
+    415 Unsupported Media Type, the sink falls back to JSON:API for good.
+    """
+
+    def __init__(self, api_root, body_encoding="cbor", compression="gzip"):
+        self.name = "{}{}:{}".format(
+            body_encoding, "" if compression == "identity" else "+" + compression, api_root
+        )
+        self._url = urllib.parse.urljoin(api_root, "ingest/")
+        self._body_encoding = body_encoding
+        self._compression = compression
+        self._session = requests.Session()
+        self._fallback = None
+        self._api_root = api_root
+        # fail early if the optional dependencies of the encoding are missing
+        encoding.encode_batch([], body_encoding, compression)
+
+    def write(self, records):
+        if self._fallback:
+            self._fallback.write(records)
+            return
+        body, headers = encoding.encode_batch(records, self._body_encoding, self._compression)
+        headers["Accept"] = "application/vnd.api+json"
+        response = self._session.post(self._url, data=body, headers=headers, timeout=10)
+        if response.status_code == 415:
+            logging.warning(
+                "%s does not accept %s, falling back to JSON:API", self._url, headers["Content-Type"]
+            )
+            self._fallback = JsonApiSink(self._api_root)
+            self._fallback.write(records)
+            return
+        response.raise_for_status()
+
+    def close(self):
+        self._session.close()
+
+
+class LineProtocolSink:
+    """Writes samples to InfluxDB or VictoriaMetrics in the line protocol, one request per batch
+
+    The URL is the write endpoint including its query, e.g.
+    http://localhost:8086/write?db=clair; timestamps are sent in seconds.
+    """
+
+    MEASUREMENT = "clair_sample"
+    FIELDS = ["co2_ppm", "temperature_celsius", "rel_humidity_percent"]
+
+    def __init__(self, url):
+        self.name = "influx:" + url
+        url_parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qsl(url_parts.query) + [("precision", "s")]
+        self._url = urllib.parse.urlunsplit(url_parts._replace(query=urllib.parse.urlencode(query)))
+        self._session = requests.Session()
+
+    # rollups, see rollup.RollupStage, with all their attributes as fields
+    ROLLUP_MEASUREMENT = "clair_rollup"
+
+    @classmethod
+    def format_line(cls, record):
+        if "interval_s" in record.attributes:
+            measurement = cls.ROLLUP_MEASUREMENT
+            tags = ",interval={}".format(record.attributes["interval_s"])
+            field_names = [name for name in record.attributes if name not in ("timestamp_s", "interval_s")]
+        else:
+            measurement = cls.MEASUREMENT
+            tags = ""
+            field_names = cls.FIELDS
+        fields = ",".join(
+            "{}={}".format(field, float(record.attributes[field]))
+            for field in field_names
+            if record.attributes.get(field) is not None
+        )
+        return "{},node={},device={}{} {} {}".format(
+            measurement,
+            record.node_id,
+            _escape_tag(record.device_id),
+            tags,
+            fields,
+            record.attributes["timestamp_s"],
+        )
+
+    def write(self, records):
+        body = "\n".join(self.format_line(record) for record in records)
+        response = self._session.post(self._url, data=body.encode("utf8"), timeout=10)
+        response.raise_for_status()
+
+    def close(self):
+        self._session.close()
+
+
+def _escape_tag(value):
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+class NdjsonSink:
+    """Appends samples as JSON lines to a file which is rotated at max_bytes
+
+    The rotated files are named <path>.1 (the most recent) to <path>.<backup_count>.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backup_count=5):
+        self.name = "ndjson:" + path
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._fd = open(path, "a")
+
+    def write(self, records):
+        for record in records:
+            self._fd.write(json.dumps(dict(record.attributes, node=record.node_id, device=record.device_id)))
+            self._fd.write("\n")
+        self._fd.flush()
+        if self._fd.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._fd.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, i)):
+                os.replace("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+        if self.backup_count:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._fd = open(self.path, "a")
+
+    def close(self):
+        self._fd.close()
+
+
+class MqttSink:
+    """Republishes samples as JSON to <topic>/<device id> on an MQTT broker, e.g. a local one"""
+
+    def __init__(self, host, port=1883, topic="clair/samples"):
+        self.name = "mqtt://{}:{}/{}".format(host, port, topic)
+        self._topic = topic
+        self._client = mqtt.Client()
+        self._client.connect_async(host, port)
+        self._client.loop_start()
+
+    def write(self, records):
+        for record in records:
+            payload = json.dumps(dict(record.attributes, node=record.node_id))
+            message = self._client.publish(
+                "{}/{}".format(self._topic, record.device_id), payload, qos=1
+            )
+            if message.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError("cannot publish to {}: {}".format(self.name, mqtt.error_string(message.rc)))
+
+    def close(self):
+        self._client.loop_stop()
+        self._client.disconnect()
+
+
+def create_sink(spec):
+    """Create a sink from a specification of the form <kind>:<target>:
+
+    jsonapi:<API root>      the JSON:API ingest endpoint of a managair
+    <encoding>[+<compression>]:<API root>
+                            the ingest endpoint of a managair, in the compact
+                            cbor or msgpack encoding, compressed with gzip or zstd
+    influx:<write URL>      InfluxDB or VictoriaMetrics, in the line protocol
+    ndjson:<path>           a rotating file of JSON lines
+    mqtt://<host>[:<port>]/<topic>   an MQTT broker
+    """
+    kind, _sep, target = spec.partition(":")
+    if not target:
+        raise SinkException("invalid sink {}, expected <kind>:<target>".format(spec))
+    if kind == "jsonapi":
+        return JsonApiSink(target)
+    elif kind.partition("+")[0] in encoding.CONTENT_TYPES:
+        body_encoding, _sep, compression = kind.partition("+")
+        if compression and compression not in encoding.COMPRESSIONS:
+            raise SinkException("unknown compression {} in {}".format(compression, spec))
+        return CompactIngestSink(target, body_encoding, compression or "identity")
+    elif kind == "influx":
+        return LineProtocolSink(target)
+    elif kind == "ndjson":
+        return NdjsonSink(target)
+    elif kind == "mqtt":
+        url_parts = urllib.parse.urlsplit(spec)
+        if not url_parts.hostname:
+            raise SinkException("invalid sink {}, expected mqtt://<host>[:<port>]/<topic>".format(spec))
+        return MqttSink(url_parts.hostname, url_parts.port or 1883, url_parts.path.strip("/") or "clair/samples")
+    raise SinkException("unknown sink kind {} in {}".format(kind, spec))
+
+
+class BatchQueue(queue.Queue):
+    """A queue whose items are taken in batches by a writer thread"""
+
+    def next_batch(self, batch_size, flush_interval, stopping):
+        """Wait for up to batch_size items, for at most flush_interval seconds
+        after the first; once the stopping event is set, only take what is queued."""
+        batch = []
+        try:
+            item = self.get(timeout=flush_interval)
+            deadline = time.monotonic() + flush_interval
+            while True:
+                if item is not _WAKEUP:
+                    batch.append(item)
+                if len(batch) >= batch_size:
+                    break
+                if stopping.is_set():
+                    # write what is queued right away
+                    item = self.get_nowait()
+                else:
+                    item = self.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            pass
+        return batch
+
+    def wake_up(self):
+        """End the wait for a full batch, e.g. after setting the stopping event"""
+        try:
+            self.put_nowait(_WAKEUP)
+        except queue.Full:
+            pass
+
+
+class BufferedSink:
+    """Hands the samples over to a sink in batches, from a thread of its own
+
+    submit() never blocks: if the queue is full because the sink is slow or
+    down, the sample is dropped for this sink only. A batch is written when
+    batch_size samples are queued or flush_interval seconds have passed; a
+    failed batch is retried up to retries times with exponential backoff and
+    then dropped. Batches are retried as a whole, so a sink may receive a
+    sample more than once.
+    """
+
+    def __init__(self, sink, batch_size=100, flush_interval=1.0, queue_size=10000,
+                 retries=5, backoff=1.0):
+        self.sink = sink
+        self.name = sink.name
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._retries = retries
+        self._backoff = backoff
+        self._queue = BatchQueue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._written = metrics.SINK_SAMPLES.labels(self.name)
+        self._dropped = metrics.SINK_DROPPED_SAMPLES.labels(self.name)
+        queue_name = "sink " + self.name
+        metrics.QUEUE_DEPTH.labels(queue_name).set_function(self._queue.qsize)
+        health.HEALTH.register_queue(queue_name, self._queue.qsize, queue_size)
+
+    def submit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._dropped.inc()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sink", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Write the queued samples, without retries, and close the sink; False if
+        they were not written within timeout seconds."""
+        self._stop.set()
+        self._queue.wake_up()
+        if self._thread:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.warning("%s stopped with %d samples left unwritten", self.name, self._queue.qsize())
+                return False
+        self.sink.close()
+        return True
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._queue.next_batch(self._batch_size, self._flush_interval, self._stop)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        for attempt in range(self._retries + 1):
+            try:
+                self.sink.write(batch)
+            except Exception as e:
+                logging.warning("writing %d samples to %s failed: %s", len(batch), self.name, e)
+                # retry with backoff, but give up right away while stopping
+                if self._stop.wait(self._backoff * 2 ** attempt):
+                    break
+            else:
+                self._written.inc(len(batch))
+                return
+        logging.error("dropping %d samples for %s", len(batch), self.name)
+        self._dropped.inc(len(batch))
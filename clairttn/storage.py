@@ -0,0 +1,212 @@
+import os
+import json
+import logging
+import threading
+import concurrent.futures
+import datetime as dt
+import requests
+import requests.adapters
+
+
+def uplink_url(base_url, application_id):
+    """URL of the uplink messages of a TTN v3 application in the Storage Integration."""
+    base_url = base_url.rstrip('/ ')
+    return "{}/api/v3/as/applications/{}/packages/storage/uplink_message".format(
+        base_url, application_id)
+
+
+def request_headers(access_key):
+    return {
+        'Accept': 'application/json',
+        'Authorization': "Bearer {}".format(access_key)
+    }
+
+
+def iter_uplinks(lines):
+    """Parse the Storage Integration's NDJSON response line by line.
+
+    lines may be any iterable of (byte) strings, such as the iter_lines() of a
+    streamed response. Yields the TTN v3 uplink messages.
+    """
+    for line in lines:
+        if not line or not line.strip():
+            continue
+        try:
+            pdu = json.loads(line)
+        except ValueError as e:
+            logging.warning("skipping malformed storage line: %s", e)
+            continue
+        if 'result' in pdu:
+            yield pdu['result']
+        elif 'error' in pdu:
+            logging.error("storage integration error: %s", pdu['error'])
+
+
+_DURATION_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+
+def parse_duration(duration):
+    """Parse a duration like '24h', '1h30m' or '7d' into a timedelta."""
+    seconds = 0
+    number = ''
+    for c in duration.strip():
+        if c.isdigit() or c == '.':
+            number += c
+        elif c in _DURATION_UNITS and number:
+            seconds += float(number) * _DURATION_UNITS[c]
+            number = ''
+        else:
+            raise ValueError("invalid duration: {}".format(duration))
+    if number or not seconds:
+        raise ValueError("invalid duration: {}".format(duration))
+    return dt.timedelta(seconds=seconds)
+
+
+def split_windows(after, before, window):
+    """Split the time range [after, before) into consecutive windows of the given length."""
+    windows = []
+    start = after
+    while start < before:
+        end = min(start + window, before)
+        windows.append((start, end))
+        start = end
+    return windows
+
+
+def create_session(pool_size=8, retries=5):
+    """A requests session with a connection pool and retries on transient errors."""
+    session = requests.Session()
+    retry = requests.adapters.Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET',))
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _format_time(timestamp):
+    return timestamp.astimezone(dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _parse_formatted_time(text):
+    return dt.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=dt.timezone.utc)
+
+
+def _window_params(after, before):
+    return {
+        'after': _format_time(after),
+        'before': _format_time(before),
+        'order': 'received_at',
+    }
+
+
+def fetch_uplinks(session, url, headers, after, before, timeout=60):
+    """Fetch the uplinks received in [after, before) in a single request.
+
+    Yields the TTN v3 uplink messages while the response is streamed.
+    """
+    with session.get(url, headers=headers, params=_window_params(after, before),
+                     stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        yield from iter_uplinks(response.iter_lines())
+
+
+class WindowedFetcher:
+    """Fetches a time range from the Storage Integration in concurrent windows
+
+    Each window is spooled to a file in work_dir. A cursor file records which
+    windows are complete, so that an interrupted export can be resumed with
+    the same work_dir and time range, fetching only the missing windows.
+    """
+
+    CURSOR_FILE = 'cursor.json'
+
+    def __init__(self, session, url, headers, work_dir, jobs=4, timeout=60):
+        self._session = session
+        self._url = url
+        self._headers = headers
+        self._work_dir = work_dir
+        self._jobs = jobs
+        self._timeout = timeout
+        self._lock = threading.Lock()
+
+    def fetch(self, windows):
+        """Fetch all windows and yield their spool files in chronological order."""
+        cursor = self._load_cursor(windows)
+        pending = [i for i in range(len(windows)) if i not in cursor['completed']]
+        logging.info("fetching %d of %d windows", len(pending), len(windows))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = {
+                i: executor.submit(self._fetch_window, i, windows[i], cursor)
+                for i in pending
+            }
+            for i in range(len(windows)):
+                if i in futures:
+                    futures[i].result()
+                yield self._spool_path(i)
+
+    def _fetch_window(self, index, window, cursor):
+        params = _window_params(*window)
+        spool_path = self._spool_path(index)
+        with self._session.get(self._url, headers=self._headers, params=params,
+                               stream=True, timeout=self._timeout) as response:
+            response.raise_for_status()
+            with open(spool_path + '.tmp', 'wb') as fd:
+                for chunk in response.iter_content(chunk_size=65536):
+                    fd.write(chunk)
+        os.replace(spool_path + '.tmp', spool_path)
+        with self._lock:
+            cursor['completed'].add(index)
+            self._save_cursor(cursor)
+        logging.debug("fetched window %s - %s", params['after'], params['before'])
+
+    def stored_before(self):
+        """The end of the range of an interrupted export of the same url, or None.
+
+        Resuming needs the same windows, so a range ending at "now" has to
+        reuse the end stored in the cursor.
+        """
+        stored = self._read_cursor()
+        if not stored or stored['url'] != self._url or not stored['windows']:
+            return None
+        if len(stored['completed']) == len(stored['windows']):
+            # the export finished, a new one starts at the current time
+            return None
+        return _parse_formatted_time(stored['windows'][-1][1])
+
+    def _spool_path(self, index):
+        return os.path.join(self._work_dir, 'window-{:06d}.ndjson'.format(index))
+
+    def _load_cursor(self, windows):
+        key = {
+            'url': self._url,
+            'windows': [[_format_time(a), _format_time(b)] for a, b in windows],
+        }
+        stored = self._read_cursor()
+        completed = set()
+        if stored and stored['url'] == key['url'] and stored['windows'] == key['windows']:
+            completed = {
+                i for i in stored['completed'] if os.path.exists(self._spool_path(i))
+            }
+            logging.info("resuming export, %d windows already fetched", len(completed))
+        elif stored:
+            logging.warning("cursor in %s does not match the requested range, starting over",
+                            self._work_dir)
+        return dict(key, completed=completed)
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self._work_dir, self.CURSOR_FILE)) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def _save_cursor(self, cursor):
+        path = os.path.join(self._work_dir, self.CURSOR_FILE)
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(dict(cursor, completed=sorted(cursor['completed'])), fd)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+import queue
+import requests
+
+
+class Span:
+    """A timed operation within the processing of an uplink message"""
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+        "_tracer",
+        "_token",
+    )
+
+    def __init__(self, tracer, name, trace_id, parent_span_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.start_ns = None
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+        self._tracer = tracer
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def context(self):
+        """The trace and span id, to continue the trace in another process"""
+        return self.trace_id, self.span_id
+
+    def __enter__(self):
+        self._token = _CURRENT_SPAN.set(self)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        self.end_ns = time.time_ns()
+        if exc_type is not None:
+            self.error = "{}: {}".format(exc_type.__name__, exc_value)
+        _CURRENT_SPAN.reset(self._token)
+        self._tracer._export(self)
+        return False
+
+    def to_otlp(self):
+        """Convert the span to the OTLP/JSON representation."""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_to_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+class _NullSpan:
+    """Stands in for a span if tracing is disabled or the trace is not sampled"""
+
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def context(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Creates per-message traces and hands finished spans to an exporter"""
+
+    def __init__(self):
+        self._exporter = None
+        self._sample_ratio = 1.0
+
+    def configure(self, exporter, sample_ratio=1.0):
+        self._exporter = exporter
+        self._sample_ratio = sample_ratio
+
+    @property
+    def enabled(self):
+        return self._exporter is not None
+
+    def start_trace(self, name, **attributes):
+        """Start the root span of a new trace, to be used as context manager."""
+        if self._exporter is None or (
+            self._sample_ratio < 1.0 and random.random() >= self._sample_ratio
+        ):
+            return NULL_SPAN
+        return Span(self, name, os.urandom(16).hex(), None, attributes)
+
+    def continue_trace(self, name, context, **attributes):
+        """Start a child span of the span with the context() of another process."""
+        if self._exporter is None or context is None:
+            return NULL_SPAN
+        trace_id, parent_span_id = context
+        return Span(self, name, trace_id, parent_span_id, attributes)
+
+    def span(self, name, **attributes):
+        """Start a child span of the current span, to be used as context manager."""
+        parent = _CURRENT_SPAN.get()
+        if parent is None:
+            return NULL_SPAN
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def shutdown(self):
+        if self._exporter:
+            self._exporter.shutdown()
+            self._exporter = None
+
+    def _export(self, span):
+        exporter = self._exporter
+        if exporter:
+            exporter.export(span)
+
+
+class _BatchingExporter:
+    """Collects finished spans and exports them in batches from a background thread"""
+
+    def __init__(self, batch_size=256, flush_interval=5.0, max_queue_size=8192):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="trace-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            logging.debug("trace export queue full, dropping span %s", span.name)
+
+    def shutdown(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not (self._stopped.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or (self._stopped.is_set() and self._queue.empty()):
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=min(timeout, 0.5)))
+                except queue.Empty:
+                    continue
+            if batch:
+                try:
+                    self._write(_to_otlp_request(batch))
+                except Exception as e:
+                    logging.error("failed to export %d spans: %s", len(batch), e)
+
+    def _write(self, otlp_request):
+        raise NotImplementedError("needs to be implemented by subclass")
+
+
+class FileExporter(_BatchingExporter):
+    """Appends batches of spans as OTLP/JSON export requests, one per line"""
+
+    def __init__(self, path, **kwargs):
+        self._path = path
+        super().__init__(**kwargs)
+
+    def _write(self, otlp_request):
+        with open(self._path, "a") as fd:
+            # in a single write, as worker processes append to the same file
+            fd.write(json.dumps(otlp_request, separators=(",", ":")) + "\n")
+
+
+class OtlpHttpExporter(_BatchingExporter):
+    """Sends batches of spans to an OpenTelemetry collector via OTLP/HTTP with JSON encoding"""
+
+    def __init__(self, endpoint, **kwargs):
+        self._endpoint = endpoint
+        self._session = requests.Session()
+        super().__init__(**kwargs)
+
+    def _write(self, otlp_request):
+        response = self._session.post(self._endpoint, json=otlp_request, timeout=5)
+        response.raise_for_status()
+
+
+def _to_otlp_request(spans):
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [_to_otlp_attribute("service.name", "clair-ttn")]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "clairttn"},
+                        "spans": [span.to_otlp() for span in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def _to_otlp_attribute(key, value):
+    return {"key": key, "value": _to_otlp_value(value)}
+
+
+def _to_otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_to_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+TRACER = Tracer()
@@ -1,22 +1,33 @@
 import logging
 import paho.mqtt.client as mqtt
 import json
+import time
+import threading
 import traceback
 import base64
 import dateutil.parser as dtparser
 import clairttn.types as types
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.tracing as tracing
+import clairttn.profiling as profiling
+import clairttn.storage as storage
+import clairttn.backfill as backfill
+import clairttn.dead_letter as dead_letter
 
 
 class RxMessage:
     """Core parts of the TTN message received from a node"""
 
-    def __init__(self, raw_data, device_id, device_eui, rx_datetime, rx_port, mcs):
+    def __init__(self, raw_data, device_id, device_eui, rx_datetime, rx_port, mcs, f_cnt=None):
         self.raw_data = raw_data
         self.device_id = device_id
         self.device_eui = device_eui
         self.rx_datetime = rx_datetime
         self.rx_port = rx_port
         self.mcs = mcs
+        # the uplink frame counter, None if unknown
+        self.f_cnt = f_cnt
 
 
 class _TtnHandler:
@@ -30,27 +41,93 @@ class _TtnHandler:
             logging.debug("Subscribed to topic %s", self._sub_topics)
         else:
             logging.error("Failed to connect, return code %d", rc)
+        health.HEALTH.set_mqtt_connected(self._app_id, rc == 0)
+
+    def _on_disconnect(self, _client, _userdata, rc):
+        if rc != 0:
+            logging.warning("Unexpected disconnect, return code %d", rc)
+        health.HEALTH.set_mqtt_connected(self._app_id, False)
 
     def _on_message(self, _client, _userdata, message):
-        # Decode UTF-8 bytes to Unicode,
-        mqtt_payload = message.payload.decode("utf8")
-        # Parse the string into a JSON object.
-        ttn_rxmsg = json.loads(mqtt_payload)
-        topic = message.topic
-        logging.debug("Uplink message received on topic %s", topic)
-        logging.debug("Message payload: %s", ttn_rxmsg)
-
-        rx_message = self._extract_rx_message(ttn_rxmsg)
-        if not rx_message:
-            logging.warning("Skipping message...")
-            return
+        profiling.PROFILER.runcall(self._process_message, message)
+
+    def _process_message(self, message):
+        pipeline_metrics = self.metrics
+        pipeline_metrics.messages.inc()
+        health.HEALTH.mark_uplink()
+        registry = self.device_registry
+        if registry is not None:
+            # The device id is part of the topic .../devices/<device id>/up, so
+            # unregistered devices can be dropped without parsing the message.
+            device_id = message.topic.rsplit("/", 2)[-2]
+            if not registry.is_enabled(device_id):
+                pipeline_metrics.dropped_messages.inc()
+                logging.debug("Skipping message of unregistered device %s", device_id)
+                return
+        with tracing.TRACER.start_trace("receive", topic=message.topic) as span:
+            t_start = time.perf_counter()
+            # Decode UTF-8 bytes to Unicode,
+            mqtt_payload = message.payload.decode("utf8")
+            # Parse the string into a JSON object.
+            ttn_rxmsg = json.loads(mqtt_payload)
+            t_parsed = time.perf_counter()
+            pipeline_metrics.json_parse.observe(t_parsed - t_start)
+            topic = message.topic
+            logging.debug("Uplink message received on topic %s", topic)
+            logging.debug("Message payload: %s", ttn_rxmsg)
+            if "correlation_ids" in ttn_rxmsg:
+                span.set_attribute("ttn.correlation_ids", ttn_rxmsg["correlation_ids"])
+
+            with tracing.TRACER.span("extract"):
+                rx_message = self._extract_rx_message(ttn_rxmsg)
+            pipeline_metrics.extract.observe(time.perf_counter() - t_parsed)
+            if not rx_message:
+                pipeline_metrics.dropped_messages.inc()
+                logging.debug("Skipping message...")
+                return
+            span.set_attribute("device.id", rx_message.device_id)
+            span.set_attribute("device.eui", rx_message.device_eui.hex())
+            self._handle_rx_message(rx_message, span)
+
+    def _handle_rx_message(self, rx_message, span):
+        if not self._is_new(rx_message):
+            self.metrics.duplicate_messages.inc()
+            logging.info(
+                "Skipping duplicate uplink %s of %s", rx_message.f_cnt, rx_message.device_id
+            )
+            return False
+        if self.process_pool is not None:
+            self.process_pool.submit(self._app_id, rx_message, span.context())
+        elif self.worker_pool is None:
+            # uplinks may also be handled by the backfill thread
+            with self._handle_lock:
+                self._call_handler(rx_message, span)
+        else:
+            self.worker_pool.submit(rx_message.device_id, self._handle_in_worker, rx_message)
+        return True
+
+    def _handle_in_worker(self, rx_message):
+        # the receive span may be exported by the time the worker runs, so
+        # errors go to a child span which the worker's context carries over
+        with tracing.TRACER.span("handle") as span:
+            self._call_handler(rx_message, span)
+
+    def _call_handler(self, rx_message, span):
         try:
             self.handle_message(rx_message)
+        except dead_letter.PayloadQuarantinedException as e:
+            # logged by the dead letter store
+            span.set_attribute("error", str(e))
         except Exception as e2:
             logging.error("exception during message handling: %s", e2)
             logging.error(traceback.format_exc())
+            span.set_attribute("error", str(e2))
 
-    def __init__(self, app_id, access_key, broker_host, sub_topics):
+    def _is_new(self, rx_message):
+        """Whether the uplink has not been handled before."""
+        return True
+
+    def __init__(self, app_id, access_key, broker_host, sub_topics, client_id="Clair-Berlin"):
         logging.debug("Application ID: %s", app_id)
 
         self._app_id = app_id
@@ -58,7 +135,7 @@ class _TtnHandler:
         self._broker_host = broker_host
         self._sub_topics = sub_topics
         self._mqtt_client = mqtt.Client(
-            client_id="Clair-Berlin",
+            client_id=client_id,
             clean_session=False,
             userdata=None,
             protocol=mqtt.MQTTv311,  # TTN supports MQTT v 3.1.1 only
@@ -70,8 +147,22 @@ class _TtnHandler:
         # Attach callbacks to client.
         self._mqtt_client.on_message = self._on_message
         self._mqtt_client.on_connect = self._on_connect
+        self._mqtt_client.on_disconnect = self._on_disconnect
         # Fake callback. Must be provided by appplication-layer node handler
         self.handle_message = self._handle_message
+        self._handle_lock = threading.Lock()
+        # Set to hand uplinks over to a shared pool of worker threads
+        self.worker_pool = None
+        # Set to hand uplinks over to worker processes instead, see process_pool
+        self.process_pool = None
+        # Set to process the uplinks of registered devices only
+        self.device_registry = None
+        # Replaced by the node handler with metrics labelled with its mode
+        self.metrics = metrics.PipelineMetrics(app_id)
+
+    @property
+    def app_id(self):
+        return self._app_id
 
     def _extract_rx_message(self, ttn_rxmsg):
         raise NotImplementedError("needs to be implemented by subclass")
@@ -82,6 +173,7 @@ class _TtnHandler:
     def connect(self):
         if self._broker_host:
             logging.debug("Connecting to the TTN MQTT broker at %s", self._broker_host)
+            health.HEALTH.set_mqtt_connected(self._app_id, False)
             self._mqtt_client.connect_async(
                 host=self._broker_host, port=self._broker_port
             )
@@ -91,21 +183,46 @@ class _TtnHandler:
         else:
             raise NotImplementedError("must be called from concrete subclass")
 
-    def disconnect_and_close(self):
-        self._mqtt_client.loop_stop()
-        logging.debug("Message handling loop stopped.")
+    def stop_receiving(self):
+        """Unsubscribe from uplinks; the connection stays up for pending downlinks."""
+        self._mqtt_client.unsubscribe(self._sub_topics)
+        logging.debug("Unsubscribed from topic %s", self._sub_topics)
+
+    def drain(self, timeout=None):
+        """Wait for the uplink handled on the MQTT thread, if any; False on timeout.
+
+        Uplinks handed over to the worker pool are drained by stopping the pool.
+        """
+        if not self._handle_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        self._handle_lock.release()
+        return True
+
+    def disconnect_and_close(self, timeout=None):
+        """Stop the MQTT client thread and disconnect; False if the thread did
+        not stop within timeout seconds, e.g. in the middle of an uplink."""
+        # paho's loop_stop() waits for the thread without a timeout
+        stopper = threading.Thread(target=self._mqtt_client.loop_stop, daemon=True)
+        stopper.start()
+        stopper.join(timeout)
+        stopped = not stopper.is_alive()
+        if stopped:
+            logging.debug("Message handling loop stopped.")
+        else:
+            logging.warning("MQTT client of %s did not stop in time", self._app_id)
         self._mqtt_client.disconnect()
         logging.debug("Disconnected from %s", self._broker_host)
+        return stopped
 
     def send(self, dev_id, port, payload):
         raise NotImplementedError("Must be implemented by subclass")
 
 
 class TtnV2Handler(_TtnHandler):
-    def __init__(self, app_id, access_key):
+    def __init__(self, app_id, access_key, client_id="Clair-Berlin"):
         logging.info("Configuring TTN Stack V2")
         sub_topics = app_id + "/devices/+/up"
-        super().__init__(app_id, access_key, "eu.thethings.network", sub_topics)
+        super().__init__(app_id, access_key, "eu.thethings.network", sub_topics, client_id)
 
     def _extract_rx_message(self, ttn_rxmsg):
         if "payload_raw" not in ttn_rxmsg:
@@ -128,10 +245,11 @@ class TtnV2Handler(_TtnHandler):
 
             rx_port = ttn_rxmsg.get("port", 5)  # Default Elsys ERS uplink port is 5.
             lora_rate = metadata["data_rate"]
+            f_cnt = ttn_rxmsg.get("counter")
 
         except Exception as e1:
-            logging.error(
-                "Exception decoding the MQTT message: %s \n error %s", ttn_rxmsg, e1
+            _quarantine_ttn_message(
+                e1, ttn_rxmsg.get("app_id"), ttn_rxmsg.get("dev_id"), ttn_rxmsg["payload_raw"]
             )
             return None
         try:
@@ -140,7 +258,7 @@ class TtnV2Handler(_TtnHandler):
             logging.warning("message without data rate, assuming simulated uplink")
             mcs = types.LoRaWanMcs.SF9BW125
         logging.info("MCS: %s", mcs)
-        return RxMessage(raw_data, device_id, device_eui, rx_datetime, rx_port, mcs)
+        return RxMessage(raw_data, device_id, device_eui, rx_datetime, rx_port, mcs, f_cnt)
 
     def _create_tx_message(self, port, payload):
         """Message format: https://www.thethingsnetwork.org/docs/applications/mqtt/api/#downlink-messages"""
@@ -155,46 +273,66 @@ class TtnV2Handler(_TtnHandler):
 
 
 class TtnV3Handler(_TtnHandler):
-    def __init__(self, app_id, access_key):
+    def __init__(self, app_id, access_key, client_id="Clair-Berlin"):
         logging.info("Configuring TTN Stack V3")
         sub_topics = "v3/" + app_id + "@ttn/devices/+/up"
-        super().__init__(app_id, access_key, "eu1.cloud.thethings.network", sub_topics)
-
-    def _extract_rx_message(self, ttn_rxmsg):
-        if "frm_payload" not in ttn_rxmsg["uplink_message"]:
-            logging.warning("Message without payload.")
-            return None
-        try:
-            device_ids = ttn_rxmsg["end_device_ids"]
-            device_eui = bytes.fromhex(device_ids["dev_eui"])
-            logging.info("device eui: %s", device_eui.hex())
-
-            device_id = device_ids["device_id"]
-            logging.info("device name: %s", device_id)
+        super().__init__(
+            app_id, access_key, "eu1.cloud.thethings.network", sub_topics, client_id
+        )
+        self._frame_counters = backfill.FrameCounterTracker()
+        self._backfiller = None
+
+    def enable_backfill(self, storage_base_url, access_key, delay=60.0):
+        """Recover uplinks lost according to their frame counters from the Storage Integration."""
+        self._backfiller = backfill.Backfiller(
+            storage.create_session(pool_size=1),
+            storage.uplink_url(storage_base_url, self._app_id),
+            storage.request_headers(access_key),
+            self._process_backfilled_uplink,
+            delay,
+        )
 
-            uplink_message = ttn_rxmsg["uplink_message"]
-            raw_payload = uplink_message["frm_payload"]
-            raw_data = base64.b64decode(raw_payload)
-            logging.debug("raw data: %s", raw_data.hex("-").upper())
+    def connect(self):
+        super().connect()
+        if self._backfiller:
+            self._backfiller.start()
+
+    def stop_receiving(self):
+        super().stop_receiving()
+        if self._backfiller:
+            # no new backfills, a running one is waited for on disconnect
+            self._backfiller.stop(timeout=0)
+
+    def disconnect_and_close(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stopped = True
+        if self._backfiller:
+            stopped = self._backfiller.stop(timeout)
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        return super().disconnect_and_close(remaining) and stopped
 
-            rx_datetime = dtparser.parse(uplink_message["received_at"])
-            logging.debug("received at: %s", rx_datetime.isoformat())
+    def _extract_rx_message(self, ttn_rxmsg):
+        return extract_v3_rx_message(ttn_rxmsg)
 
-            # Default Elsys ERS uplink port is 5.
-            rx_port = uplink_message.get("f_port", 5)
-            lora_rate = uplink_message["settings"].get("data_rate_index")
-            if lora_rate is None:
-                logging.warning("message without data rate, assuming simulated uplink")
-                mcs = types.LoRaWanMcs.SF9BW125
-            else:
-                mcs = types.DATA_RATE_INDEX[lora_rate]    
-        except Exception as e1:
-            logging.error(
-                "Exception decoding the MQTT message: %s \n error %s", ttn_rxmsg, e1
-            )
-            return None
-        logging.info("MCS: %s", mcs)
-        return RxMessage(raw_data, device_id, device_eui, rx_datetime, rx_port, mcs)
+    def _is_new(self, rx_message):
+        if rx_message.f_cnt is None:
+            return True
+        duplicate, gap = self._frame_counters.observe(
+            rx_message.device_id, rx_message.f_cnt, rx_message.rx_datetime
+        )
+        if gap and self._backfiller:
+            self._backfiller.add_gap(gap)
+        return not duplicate
+
+    def _process_backfilled_uplink(self, ttn_rxmsg):
+        with tracing.TRACER.start_trace("backfill") as span:
+            rx_message = extract_v3_rx_message(ttn_rxmsg)
+            if not rx_message:
+                self.metrics.dropped_messages.inc()
+                return
+            span.set_attribute("device.id", rx_message.device_id)
+            if self._handle_rx_message(rx_message, span):
+                self.metrics.backfilled_messages.inc()
 
     def _create_tx_message(self, port, payload):
         """Message format: https://www.thethingsindustries.com/docs/reference/data-formats/#downlink-messages"""
@@ -207,3 +345,59 @@ class TtnV3Handler(_TtnHandler):
         topic = "v3/" + self._app_id + "@ttn/devices/" + dev_id + "/down/push"
         message = self._create_tx_message(port, payload)
         self._mqtt_client.publish(topic, message)
+
+
+def extract_v3_rx_message(ttn_rxmsg):
+    """Extract the core parts of a TTN v3 uplink message, as received via MQTT
+    or from the Storage Integration; None if the message cannot be used."""
+    if "frm_payload" not in ttn_rxmsg["uplink_message"]:
+        logging.warning("Message without payload.")
+        return None
+    try:
+        device_ids = ttn_rxmsg["end_device_ids"]
+        device_eui = bytes.fromhex(device_ids["dev_eui"])
+        logging.info("device eui: %s", device_eui.hex())
+
+        device_id = device_ids["device_id"]
+        logging.info("device name: %s", device_id)
+
+        uplink_message = ttn_rxmsg["uplink_message"]
+        raw_payload = uplink_message["frm_payload"]
+        raw_data = base64.b64decode(raw_payload)
+        logging.debug("raw data: %s", raw_data.hex("-").upper())
+
+        rx_datetime = dtparser.parse(uplink_message["received_at"])
+        logging.debug("received at: %s", rx_datetime.isoformat())
+
+        # Default Elsys ERS uplink port is 5.
+        rx_port = uplink_message.get("f_port", 5)
+        lora_rate = uplink_message["settings"].get("data_rate_index")
+        if lora_rate is None:
+            logging.warning("message without data rate, assuming simulated uplink")
+            mcs = types.LoRaWanMcs.SF9BW125
+        else:
+            mcs = types.DATA_RATE_INDEX[lora_rate]
+        # TTN v3 omits a frame counter of 0; simulated uplinks have none
+        f_cnt = None if ttn_rxmsg.get("simulated") else uplink_message.get("f_cnt", 0)
+    except Exception as e1:
+        device_ids = ttn_rxmsg.get("end_device_ids", {})
+        _quarantine_ttn_message(
+            e1,
+            device_ids.get("application_ids", {}).get("application_id"),
+            device_ids.get("device_id"),
+            ttn_rxmsg["uplink_message"]["frm_payload"],
+        )
+        return None
+    logging.info("MCS: %s", mcs)
+    return RxMessage(raw_data, device_id, device_eui, rx_datetime, rx_port, mcs, f_cnt)
+
+
+def _quarantine_ttn_message(exception, app_id, device_id, raw_payload):
+    """Put a TTN message whose core parts could not be extracted into the dead letter store."""
+    try:
+        raw_data = base64.b64decode(raw_payload)
+    except Exception:
+        raw_data = str(raw_payload).encode("utf8", "replace")
+    dead_letter.DEAD_LETTERS.quarantine(
+        dead_letter.from_exception(exception, app_id, device_id, raw_data=raw_data)
+    )
@@ -0,0 +1,102 @@
+import time
+import queue
+import logging
+import threading
+import traceback
+import contextvars
+import clairttn.metrics as metrics
+import clairttn.health as health
+import clairttn.profiling as profiling
+
+
+_STOP = object()
+# how often a submit() blocked by a full queue checks whether the pool is stopping
+_STOPPING_POLL_INTERVAL = 0.1
+
+
+class WorkerPool:
+    """Worker threads which decode and forward uplinks, shared by all TTN applications
+
+    Each worker has its own bounded queue. Tasks are assigned to a worker by a
+    shard key, the device id, so that the uplinks of a device are handled in
+    order while those of different devices are handled in parallel. A full
+    queue blocks submit(), which slows down the MQTT client instead of
+    buffering without bounds, until the pool is stopped.
+    """
+
+    QUEUE_NAME = "workers"
+
+    def __init__(self, workers=4, queue_size=1000):
+        self._queues = [queue.Queue(maxsize=queue_size) for __ in range(workers)]
+        self._threads = []
+        self._stopping = threading.Event()
+        metrics.QUEUE_DEPTH.labels(self.QUEUE_NAME).set_function(self.depth)
+        health.HEALTH.register_queue(self.QUEUE_NAME, self._max_depth, queue_size)
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _max_depth(self):
+        # the pool is saturated as soon as a single worker is
+        return max(q.qsize() for q in self._queues)
+
+    def start(self):
+        self._stopping.clear()
+        for i, task_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run, args=(task_queue,), name="worker-{}".format(i), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Handle all queued tasks and stop the workers; False if they did not finish within timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._stopping.set()
+        try:
+            for task_queue in self._queues:
+                task_queue.put(_STOP, timeout=_remaining(deadline))
+            for thread in self._threads:
+                thread.join(_remaining(deadline))
+        except queue.Full:
+            pass
+        if any(thread.is_alive() for thread in self._threads):
+            logging.warning("workers stopped with %d uplinks left unhandled", self.depth())
+            return False
+        self._threads = []
+        return True
+
+    def submit(self, key, function, *args):
+        """Call function(*args) on the worker for the key, in the caller's context.
+
+        Returns False if the task was dropped because the worker's queue was
+        full while the pool is stopping, so that the caller cannot get stuck.
+        """
+        task_queue = self._queues[hash(key) % len(self._queues)]
+        # the context carries the current trace span into the worker
+        task = (contextvars.copy_context(), function, args)
+        while True:
+            try:
+                task_queue.put(task, timeout=_STOPPING_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if self._stopping.is_set():
+                    logging.warning("dropping a task, the workers are stopping")
+                    return False
+
+    @staticmethod
+    def _run(task_queue):
+        while True:
+            task = task_queue.get()
+            if task is _STOP:
+                return
+            context, function, args = task
+            try:
+                profiling.PROFILER.runcall(context.run, function, *args)
+            except Exception as e:
+                logging.error("exception in worker: %s", e)
+                logging.error(traceback.format_exc())
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
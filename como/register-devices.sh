@@ -20,9 +20,9 @@ register_device() {
 	test -n "$dev_eui" || fail_usage "DEV_EUI not specified"
 	
 	# register in managair
-	clair-register-device-in-managair -r https://clair-berlin.de/api/v1/ -a como- $protocol_id $model_id $org_id $dev_eui
+	clair register-device -r https://clair-berlin.de/api/v1/ -a como- $protocol_id $model_id $org_id $dev_eui
 	
-	dev_id=`clair-get-device-id $dev_eui`
+	dev_id=`clair get-device-id $dev_eui`
 	
 	# register in TTN
 	ttn-lw-cli end-devices create $app_id $dev_id --dev-eui $dev_eui --join-eui $join_eui --frequency-plan-id EU_863_870 --with-root-keys --lorawan-version 1.0.3 --lorawan-phy-version 1.0.3-a
@@ -30,7 +30,7 @@ register_device() {
 	# get app_key 
 	app_key=`ttn-lw-cli end-devices get $app_id $dev_id --root-keys | python3 -c "import sys, json; print(json.load(sys.stdin)['root_keys']['app_key']['key'])"`
 	
-	clair-generate-nfc-config $join_eui $dev_eui $app_key
+	clair nfc-config $join_eui $dev_eui $app_key
 }
 
 join_eui="$1"
@@ -1,15 +1,23 @@
-#!/bin/sh
+#!/bin/bash
 
-# exit in case pidof exits with a non-zero status
+# Query the liveness endpoint of the clair-ttn admin server with a single
+# HTTP request, using bash's /dev/tcp as the slim image comes without curl.
+
+# exit in case the admin endpoint is not reachable
 set -e
 
-PIDOF_PYTHON=`pidof python`
-NROF_PYTHON_THREADS=`ls -1 /proc/$PIDOF_PYTHON/task | wc -l`
+ADMIN_PORT="${CLAIR_ADMIN_PORT:-8090}"
+
+exec 3<>"/dev/tcp/127.0.0.1/$ADMIN_PORT"
+printf 'GET /livez HTTP/1.0\r\nHost: localhost\r\n\r\n' >&3
+read -r _ HTTP_STATUS _ <&3
+# print the report, skipping the remaining response headers
+sed '1,/^\r\{0,1\}$/d' <&3
+echo
 
-if [ "$NROF_PYTHON_THREADS" = 2 ]; then
-    echo "Background thread was alive."
+if [ "$HTTP_STATUS" = 200 ]; then
     exit 0
 else
-    echo "Background thread seems to be dead."
+    echo "Liveness check failed with HTTP status $HTTP_STATUS."
     exit 1
 fi
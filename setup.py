@@ -18,14 +18,25 @@ setup(
         # See https://github.com/socialwifi/jsonapi-requests/issues/53
         'tenacity==7.0' 
     ],
+    extras_require={
+        # Parquet and Arrow IPC output of clair-generate-fixtures-from-storage
+        'columnar': ['pyarrow'],
+        # MessagePack and zstd for the compact ingest encoding
+        'compact': ['msgpack', 'zstandard'],
+        # the timings of the benchmarks in benchmarks/
+        'benchmark': ['pytest-benchmark'],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     entry_points='''
     [console_scripts]
+    clair=clairttn.scripts.cli:cli
     clair-ttn=clairttn.scripts.clairttn:main
     clair-get-device-id=clairttn.scripts.get_clair_id:get_device_id
     clair-generate-fixtures-from-storage=clairttn.scripts.generate_fixtures:generate_fixtures
     clair-register-device-in-managair=clairttn.scripts.register_device:register_device_in_managair
     clair-generate-nfc-config=clairttn.scripts.nfc_config:generate_nfc_config
+    clair-query-archive=clairttn.scripts.query_archive:query_archive
+    clair-replay-dead-letters=clairttn.scripts.replay_dead_letters:replay_dead_letters
     ''',
 )
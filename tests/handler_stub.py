@@ -0,0 +1,38 @@
+import datetime as dt
+import clairttn.ttn_handler as ttn_handler
+import clairttn.types as types
+
+
+RX_DATETIME = dt.datetime(2021, 9, 21, 10, 35, 57, tzinfo=dt.timezone.utc)
+
+
+class FakeTtnClient:
+    """Stands in for the TTN client of a node handler, recording the downlinks sent"""
+
+    app_id = "dummy"
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, dev_id, port, payload):
+        self.sent.append((dev_id, port, payload))
+
+
+def rx_message(
+    payload,
+    device_id="ers-co2-sample1",
+    device_eui="a81758fffe052b0f",
+    rx_datetime=RX_DATETIME,
+    mcs=types.LoRaWanMcs.SF9BW125,
+    f_cnt=None,
+):
+    """An uplink message with the hex payload, of an ERS device unless given otherwise"""
+    return ttn_handler.RxMessage(
+        raw_data=bytes.fromhex(payload),
+        device_id=device_id,
+        device_eui=bytes.fromhex(device_eui),
+        rx_datetime=rx_datetime,
+        rx_port=5,
+        mcs=mcs,
+        f_cnt=f_cnt,
+    )
@@ -0,0 +1,85 @@
+import base64
+import http.server
+import json
+import threading
+import urllib.parse
+import dateutil.parser as dtparser
+
+
+def uplink(device_id, dev_eui, payload_hex, received_at, data_rate_index=3, f_cnt=1):
+    """A TTN v3 uplink message as returned by the Storage Integration"""
+    return {
+        "end_device_ids": {
+            "device_id": device_id,
+            "application_ids": {"application_id": "test-app"},
+            "dev_eui": dev_eui,
+        },
+        "received_at": received_at,
+        "uplink_message": {
+            "f_port": 5,
+            "f_cnt": f_cnt,
+            "frm_payload": base64.b64encode(bytes.fromhex(payload_hex)).decode("ascii"),
+            "settings": {"data_rate_index": data_rate_index},
+            "received_at": received_at,
+        },
+    }
+
+
+class StorageStub:
+    """A local stand-in for the TTN Storage Integration's uplink API
+
+    Serves the given uplinks as NDJSON, filtered by the after and before
+    query parameters, and records the query of every request.
+    """
+
+    def __init__(self, uplinks):
+        self.uplinks = uplinks
+        self.requests = []
+        stub = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                stub.requests.append((url.path, query))
+                lines = [
+                    json.dumps({"result": u}) + "\n"
+                    for u in stub.uplinks
+                    if stub._matches(u, url.path, query)
+                ]
+                body = "".join(lines).encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}/".format(self._server.server_address[1])
+
+    def _matches(self, uplink, path, query):
+        received_at = dtparser.parse(uplink["received_at"])
+        if "/devices/" in path:
+            device_id = path.split("/devices/")[1].split("/")[0]
+            if uplink["end_device_ids"]["device_id"] != device_id:
+                return False
+        if "after" in query and received_at < dtparser.parse(query["after"]):
+            return False
+        if "before" in query and received_at >= dtparser.parse(query["before"]):
+            return False
+        return True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
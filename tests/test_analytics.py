@@ -0,0 +1,95 @@
+import json
+import pytest
+import clairttn.analytics as analytics
+import clairttn.sinks as sinks
+
+
+NODE_ID = "9d02faee-4260-1377-22ec-936428b572ee"
+
+
+class _EventList:
+    def __init__(self):
+        self.events = []
+
+    def submit(self, event):
+        self.events.append(event)
+
+
+def _record(timestamp_s, co2, node_id=NODE_ID):
+    return sinks.SampleRecord(node_id, "ers-co2-sample1", {"timestamp_s": timestamp_s, "co2_ppm": co2})
+
+
+def test_rolling_window():
+    window = analytics.RollingWindow(600, (1000, 1400))
+    for timestamp, co2 in [(0, 800), (300, 1200), (600, 1000), (900, 700)]:
+        assert window.add(timestamp, co2)
+    # the sample at 0 left the window
+    assert len(window) == 3
+    assert window.mean == pytest.approx((1200 + 1000 + 700) / 3)
+    assert window.max == 1200
+    assert window.seconds_above == {1000: 600, 1400: 0}
+    assert window.trend == pytest.approx(-250 / 300 * 3600)
+
+
+def test_rolling_window_maximum_expires():
+    window = analytics.RollingWindow(600, (1000,))
+    for timestamp, co2 in [(0, 1500), (300, 900), (600, 1100), (900, 800)]:
+        window.add(timestamp, co2)
+    assert window.max == 1100
+
+
+def test_rolling_window_ignores_older_samples():
+    window = analytics.RollingWindow(600, (1000,))
+    window.add(300, 800)
+    assert not window.add(0, 2000)
+    assert window.max == 800
+    assert window.trend is None
+
+
+def test_alerts_with_hysteresis():
+    sample_analytics = analytics.Analytics(3600, (1000, 1400), hysteresis=100)
+    event_list = _EventList()
+    sample_analytics.event_sinks = [event_list]
+    for i, co2 in enumerate([900, 1000, 950, 1050, 1500, 1350, 1250, 920, 850]):
+        sample_analytics.submit(_record(i * 300, co2))
+    assert [(e.co2_ppm, e.previous_level, e.level, e.threshold_ppm) for e in event_list.events] == [
+        (1000, 0, 1, 1000),
+        (1500, 1, 2, 1400),
+        (1250, 2, 1, 1400),
+        (850, 1, 0, 1000),
+    ]
+
+
+def test_alert_skips_level():
+    sample_analytics = analytics.Analytics(3600, (1000, 1400))
+    event_list = _EventList()
+    sample_analytics.event_sinks = [event_list]
+    sample_analytics.submit(_record(0, 1600))
+    [event] = event_list.events
+    assert (event.previous_level, event.level, event.threshold_ppm) == (0, 2, 1400)
+
+
+def test_statistics_route():
+    sample_analytics = analytics.Analytics(3600, (1000,), capacity=1)
+    sample_analytics.submit(_record(0, 1200, "evicted"))
+    sample_analytics.submit(_record(0, 1200))
+    sample_analytics.submit(_record(600, 800))
+    sample_analytics.submit(sinks.SampleRecord(NODE_ID, "ers-co2-sample1", {"timestamp_s": 900}))
+
+    status, _content_type, body = sample_analytics.statistics_route({})
+    assert status == 200
+    statistics = json.loads(body)
+    assert list(statistics) == [NODE_ID]
+    assert statistics[NODE_ID]["samples"] == 2
+    assert statistics[NODE_ID]["seconds_above"] == {"1000": 600}
+    assert statistics[NODE_ID]["alert_level"] == 0
+
+    status, _content_type, _body = sample_analytics.statistics_route({"node": "evicted"})
+    assert status == 404
+
+
+def test_create_event_sink():
+    event_sink = analytics.create_event_sink("https://example.com/hooks/co2")
+    assert event_sink.name == "webhook:https://example.com/hooks/co2"
+    with pytest.raises(sinks.SinkException):
+        analytics.create_event_sink("ndjson:alerts.ndjson")
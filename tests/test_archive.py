@@ -0,0 +1,74 @@
+import time
+import sqlite3
+import clairttn.archive as archive
+import clairttn.types as types
+
+
+NODE = "9d02faee-4260-1377-22ec-936428b572ee"
+OTHER_NODE = "6fbb3d55-c86b-e021-3ec3-b45425d5b1ba"
+
+
+def _sample(timestamp, co2, temperature=None):
+    return types.Sample(
+        types.Timestamp(timestamp),
+        types.CO2(co2),
+        types.Temperature(temperature) if temperature is not None else None,
+        None,
+    )
+
+
+def test_range_query(tmp_path):
+    sample_archive = archive.SampleArchive(str(tmp_path / "archive.db"), flush_interval=0.01)
+    for i in range(100):
+        sample_archive.add(NODE, _sample(1600000000 + 60 * i, 400 + i, 21.5))
+        sample_archive.add(OTHER_NODE, _sample(1600000000 + 60 * i, 800))
+    # archiving a sample again, e.g. after a backfill, replaces it
+    sample_archive.add(NODE, _sample(1600000000, 410))
+    sample_archive.close()
+
+    samples = sample_archive.query(NODE, 1600000000, 1600000000 + 600)
+    assert [s["co2_ppm"] for s in samples] == [410, 401, 402, 403, 404, 405, 406, 407, 408, 409]
+    assert samples[1] == {
+        "node": NODE,
+        "timestamp_s": 1600000060,
+        "co2_ppm": 401,
+        "temperature_celsius": 21.5,
+        "rel_humidity_percent": None,
+    }
+
+
+def test_retention(tmp_path):
+    path = str(tmp_path / "archive.db")
+    sample_archive = archive.SampleArchive(
+        path, retention=3600, flush_interval=0.01, compaction_interval=0.01
+    )
+    now = int(time.time())
+    sample_archive.add(NODE, _sample(now - 7200, 500))
+    sample_archive.add(NODE, _sample(now - 60, 600))
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and len(sample_archive.query(NODE, 0, now)) != 1:
+        time.sleep(0.01)
+    sample_archive.close()
+
+    assert [s["co2_ppm"] for s in sample_archive.query(NODE, 0, now)] == [600]
+    assert sqlite3.connect(path).execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+def test_failed_batch_is_dropped(tmp_path):
+    path = str(tmp_path / "archive.db")
+    sample_archive = archive.SampleArchive(path, flush_interval=0.01)
+    # a value sqlite cannot bind fails the whole batch on every attempt
+    sample_archive.add(NODE, _sample(1600000000, [400]))
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not sample_archive._dropped:
+        time.sleep(0.01)
+    # the writer keeps running
+    sample_archive.add(NODE, _sample(1600000060, 410))
+    sample_archive.close()
+
+    assert sample_archive._dropped == 1
+    assert [s["co2_ppm"] for s in sample_archive.query(NODE, 0, 1600000100)] == [410]
+    indexes = sqlite3.connect(path).execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'sample'"
+    ).fetchall()
+    assert ("sample_timestamp",) in indexes
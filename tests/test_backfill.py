@@ -0,0 +1,107 @@
+import json
+import datetime as dt
+import dateutil.parser as dtparser
+import clairttn.backfill as backfill
+import clairttn.ttn_handler as ttn_handler
+from tests.storage_stub import StorageStub, uplink
+
+
+PAYLOAD = "0602C7"
+
+
+def _time(minute):
+    return dt.datetime(2021, 9, 21, 10, minute, tzinfo=dt.timezone.utc)
+
+
+class TestFrameCounterTracker:
+    def test_gap(self):
+        tracker = backfill.FrameCounterTracker()
+        assert tracker.observe("dev", 10, _time(0)) == (False, None)
+        assert tracker.observe("dev", 11, _time(1)) == (False, None)
+        assert tracker.observe("dev", 15, _time(5)) == (
+            False,
+            backfill.Gap("dev", 12, 14, _time(1), _time(5)),
+        )
+
+    def test_duplicates_and_backfilled_uplinks(self):
+        tracker = backfill.FrameCounterTracker()
+        tracker.observe("dev", 10, _time(0))
+        tracker.observe("dev", 13, _time(3))
+        assert tracker.observe("dev", 13, _time(3)) == (True, None)
+        # a recovered uplink fills the gap, once
+        assert tracker.observe("dev", 11, _time(1)) == (False, None)
+        assert tracker.observe("dev", 11, _time(1)) == (True, None)
+        assert tracker.observe("dev", 14, _time(4)) == (False, None)
+
+    def test_reset(self):
+        tracker = backfill.FrameCounterTracker(max_gap=100)
+        tracker.observe("dev", 500, _time(0))
+        assert tracker.observe("dev", 0, _time(1)) == (False, None)
+        assert tracker.observe("dev", 1, _time(2)) == (False, None)
+        # jumps beyond max_gap are not worth a backfill
+        assert tracker.observe("dev", 1000, _time(3)) == (False, None)
+
+    def test_reset_within_history(self):
+        tracker = backfill.FrameCounterTracker()
+        for f_cnt in range(10):
+            tracker.observe("dev", f_cnt, _time(f_cnt))
+        # the device rejoined, its counters start over within the history
+        assert tracker.observe("dev", 0, _time(20)) == (False, None)
+        assert tracker.observe("dev", 1, _time(21)) == (False, None)
+        assert tracker.observe("dev", 1, _time(21)) == (True, None)
+        assert tracker.observe("dev", 4, _time(24)) == (
+            False,
+            backfill.Gap("dev", 2, 3, _time(21), _time(24)),
+        )
+
+
+class _MqttMessage:
+    def __init__(self, ttn_rxmsg):
+        device_id = ttn_rxmsg["end_device_ids"]["device_id"]
+        self.topic = "v3/test-app@ttn/devices/{}/up".format(device_id)
+        self.payload = json.dumps(ttn_rxmsg).encode("utf8")
+
+
+def _uplinks():
+    return [
+        uplink(device_id, dev_eui, PAYLOAD, _time(minute).isoformat(), f_cnt=minute)
+        for minute in range(10)
+        for device_id, dev_eui in [("ers-1", "a81758fffe050001"), ("ers-2", "a81758fffe050002")]
+    ]
+
+
+def test_backfill_through_handler():
+    stored_uplinks = _uplinks()
+    # the MQTT connection was down from minute 3 to 7
+    live_uplinks = [u for u in stored_uplinks if not 3 <= u["uplink_message"]["f_cnt"] <= 7]
+
+    with StorageStub(stored_uplinks) as stub:
+        handler = ttn_handler.TtnV3Handler("test-app", "key")
+        handler.enable_backfill(stub.base_url, "key", delay=0)
+        handled = []
+        handler.handle_message = lambda rx_message: handled.append(
+            (rx_message.device_id, rx_message.f_cnt)
+        )
+        for ttn_rxmsg in live_uplinks:
+            handler._process_message(_MqttMessage(ttn_rxmsg))
+        # the broker redelivers an uplink after reconnecting
+        handler._process_message(_MqttMessage(live_uplinks[-1]))
+
+        gaps = handler._backfiller._take_due_gaps()
+        assert len(gaps) == 2
+        handler._backfiller.backfill(gaps)
+        # a second backfill of the same gaps finds only duplicates
+        handler._backfiller.backfill(gaps)
+
+    # each backfill fetched the gaps of both devices with a single request
+    assert len(stub.requests) == 2
+    path, query = stub.requests[0]
+    assert path == "/api/v3/as/applications/test-app/packages/storage/uplink_message"
+    assert dtparser.parse(query["after"]) == _time(2)
+    assert dtparser.parse(query["before"]) == _time(8)
+
+    for device_id in ["ers-1", "ers-2"]:
+        f_cnts = [f_cnt for d, f_cnt in handled if d == device_id]
+        assert sorted(f_cnts) == list(range(10))
+    assert handler.metrics.duplicate_messages.value >= 11
+    assert handler.metrics.backfilled_messages.value >= 10
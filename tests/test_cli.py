@@ -0,0 +1,92 @@
+import json
+import subprocess
+import sys
+from click.testing import CliRunner
+from clairttn.scripts.cli import cli
+
+
+# Startup budget for `clair get-device-id`, including the interpreter's own
+# imports of click and the clairttn package, but excluding interpreter startup.
+GET_DEVICE_ID_BUDGET_MS = 150
+
+HEAVY_MODULES = ["paho", "requests", "jsonapi_requests", "dateutil", "pyqrcode"]
+
+_STARTUP_PROBE = """
+import sys
+import time
+t_start = time.perf_counter()
+from clairttn.scripts.cli import cli
+cli(["get-device-id", "a81758fffe052b0f"], standalone_mode=False)
+elapsed_ms = (time.perf_counter() - t_start) * 1000
+heavy_modules = [m for m in {heavy_modules!r} if m in sys.modules]
+print(elapsed_ms, ",".join(heavy_modules), file=sys.stderr)
+"""
+
+
+def _run_startup_probe():
+    result = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE.format(heavy_modules=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed_ms, *heavy_modules = result.stderr.split()
+    return result.stdout.strip(), float(elapsed_ms), heavy_modules
+
+
+def test_list_subcommands():
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    for name in ["ttn", "get-device-id", "generate-fixtures", "register-device", "nfc-config"]:
+        assert name in result.output
+
+
+def test_get_device_id():
+    result = CliRunner().invoke(cli, ["get-device-id", "a81758fffe052b0f"])
+    assert result.exit_code == 0
+    assert result.output == "9d02faee-4260-1377-22ec-936428b572ee\n"
+
+
+def test_get_device_id_imports_no_heavy_modules():
+    output, __, heavy_modules = _run_startup_probe()
+    assert output == "9d02faee-4260-1377-22ec-936428b572ee"
+    assert heavy_modules == []
+
+
+def test_get_device_id_startup_budget():
+    # take the best of a few runs to keep the test robust on busy machines
+    elapsed_ms = min(_run_startup_probe()[1] for __ in range(3))
+    assert elapsed_ms < GET_DEVICE_ID_BUDGET_MS
+
+
+BATCH_INPUT = """dev_eui,protocol
+# a comment
+a81758fffe052b0f
+a81758fffe052b0f,clairchen
+not-an-eui
+"""
+
+
+def test_get_device_id_batch_csv():
+    result = CliRunner().invoke(cli, ["get-device-id", "-p", "ers"], input=BATCH_INPUT)
+    assert result.exit_code == 1
+    lines = result.stdout.splitlines()
+    assert lines[0] == "dev_eui,protocol,device_id"
+    assert lines[1] == "a81758fffe052b0f,ers,9d02faee-4260-1377-22ec-936428b572ee"
+    assert lines[2].startswith("a81758fffe052b0f,clairchen,")
+    assert lines[2] != lines[1].replace("ers", "clairchen")
+    assert lines[3] == "not-an-eui,ers,"
+
+
+def test_get_device_id_batch_json_process_pool(tmp_path, monkeypatch):
+    import clairttn.scripts.get_clair_id as get_clair_id
+    monkeypatch.setattr(get_clair_id, "CHUNK_SIZE", 2)
+    eui_file = tmp_path / "euis.csv"
+    eui_file.write_text("".join("a81758fffe05{:04x}\n".format(i) for i in range(7)))
+    result = CliRunner().invoke(
+        cli, ["get-device-id", "-f", str(eui_file), "-o", "json", "-j", "2"]
+    )
+    assert result.exit_code == 0
+    mappings = [json.loads(line) for line in result.output.splitlines()]
+    assert [m["dev_eui"] for m in mappings] == ["a81758fffe05{:04x}".format(i) for i in range(7)]
+    assert mappings[0]["device_id"] == get_clair_id._derive("a81758fffe050000", "ers")
@@ -0,0 +1,46 @@
+import pytest
+import clairttn.config as config
+
+
+DEFAULTS = {"mode": None, "stack": "ttn-v2", "api_root": "http://localhost:8888/ingest/v1/"}
+
+
+def test_load_app_configs(tmp_path):
+    (tmp_path / "ers.key").write_text("ers-secret\n")
+    config_file = tmp_path / "clair.ini"
+    config_file.write_text(
+        "[DEFAULT]\n"
+        "stack = ttn-v3\n"
+        "\n"
+        "[clairchen-test]\n"
+        "access_key = clairchen-secret\n"
+        "mode = clairchen-forward\n"
+        "\n"
+        "[elsys-ers-co2]\n"
+        "access_key_file = ers.key\n"
+        "mode = ers-forward-configure\n"
+        "api_root = http://managair:8888/ingest/v1/\n"
+    )
+
+    app_configs = config.load_app_configs(str(config_file), DEFAULTS)
+
+    assert app_configs == [
+        config.AppConfig(
+            "clairchen-test", "clairchen-secret", "clairchen-forward", "ttn-v3",
+            "http://localhost:8888/ingest/v1/",
+        ),
+        config.AppConfig(
+            "elsys-ers-co2", "ers-secret", "ers-forward-configure", "ttn-v3",
+            "http://managair:8888/ingest/v1/",
+        ),
+    ]
+
+
+def test_missing_mode(tmp_path):
+    config_file = tmp_path / "clair.ini"
+    config_file.write_text("[clairchen-test]\naccess_key = secret\n")
+    with pytest.raises(config.ConfigException):
+        config.load_app_configs(str(config_file), DEFAULTS)
+    # the mode may also be given on the command line
+    app_configs = config.load_app_configs(str(config_file), dict(DEFAULTS, mode="ers-forward"))
+    assert app_configs[0].mode == "ers-forward"
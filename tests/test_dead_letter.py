@@ -0,0 +1,103 @@
+import json
+import logging
+import pytest
+from click.testing import CliRunner
+import clairttn.dead_letter as dead_letter
+import clairttn.node_handler as node_handler
+import clairttn.ttn_handler as ttn_handler
+from clairttn.scripts.replay_dead_letters import replay_dead_letters
+from tests.handler_stub import FakeTtnClient, rx_message
+
+
+def _store(monkeypatch, tmp_path):
+    store = dead_letter.DeadLetterStore()
+    store.open(str(tmp_path / "dead-letters.ndjson"))
+    monkeypatch.setattr(dead_letter, "DEAD_LETTERS", store)
+    return store
+
+
+def test_undecodable_payload_is_quarantined(monkeypatch, tmp_path):
+    store = _store(monkeypatch, tmp_path)
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/"
+    )
+    with pytest.raises(dead_letter.PayloadQuarantinedException):
+        handler._handle_message(rx_message("0602C7"))
+    store.close()
+
+    [letter] = dead_letter.read_dead_letters(store.path)
+    assert letter.device_id == "ers-co2-sample1"
+    assert letter.device_eui == "a81758fffe052b0f"
+    assert letter.protocol == "ers"
+    assert letter.mcs == "SF9BW125"
+    assert letter.rx_port == 5
+    assert letter.error == "PayloadContentException"
+    assert letter.payload == "0602c7"
+    assert store.counts() == {
+        "by_device": {"ers-co2-sample1": 1},
+        "by_error": {"PayloadContentException": 1},
+    }
+
+
+def test_unextractable_message_is_quarantined(monkeypatch, tmp_path):
+    store = _store(monkeypatch, tmp_path)
+    ttn_rxmsg = {
+        "end_device_ids": {
+            "device_id": "ers-co2-sample1",
+            "application_ids": {"application_id": "clair-berlin-ers-co2"},
+            "dev_eui": "not hex",
+        },
+        "uplink_message": {"frm_payload": "BgLHBgKr"},
+    }
+    assert ttn_handler.extract_v3_rx_message(ttn_rxmsg) is None
+    store.close()
+
+    [letter] = dead_letter.read_dead_letters(store.path)
+    assert letter.app_id == "clair-berlin-ers-co2"
+    assert letter.error == "ValueError"
+    assert letter.payload == "0602c70602ab"
+    assert letter.protocol is None
+
+
+def test_logging_is_sampled(monkeypatch, caplog):
+    now = [1000.0]
+    monkeypatch.setattr(dead_letter.time, "monotonic", lambda: now[0])
+    store = dead_letter.DeadLetterStore(log_interval=60)
+    error = ValueError("bad payload")
+    with caplog.at_level(logging.WARNING):
+        for __ in range(5):
+            store.quarantine(dead_letter.from_exception(error, "app", "device-1"))
+        store.quarantine(dead_letter.from_exception(error, "app", "device-2"))
+        now[0] += 61
+        store.quarantine(dead_letter.from_exception(error, "app", "device-1"))
+    assert [r.getMessage() for r in caplog.records] == [
+        "quarantined uplink of device device-1: ValueError: bad payload (0 similar suppressed)",
+        "quarantined uplink of device device-2: ValueError: bad payload (0 similar suppressed)",
+        "quarantined uplink of device device-1: ValueError: bad payload (4 similar suppressed)",
+    ]
+    assert store.counts()["by_device"] == {"device-1": 6, "device-2": 1}
+
+
+def test_replay(tmp_path):
+    path = str(tmp_path / "dead-letters.ndjson")
+    error = ValueError("decoder bug")
+    dead_letter.write_dead_letters(path, [
+        dead_letter.from_rx_message(error, "app", rx_message("0602C70602AB"), "ers"),
+        dead_letter.from_rx_message(error, "app", rx_message("0602C7"), "ers"),
+        dead_letter.from_rx_message(error, "app", rx_message("0602C7", "other"), "ers"),
+    ])
+    remaining = str(tmp_path / "remaining.ndjson")
+
+    result = CliRunner().invoke(
+        replay_dead_letters, [path, "--device", "ers-co2-sample1", "--remaining", remaining]
+    )
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    samples = [json.loads(line) for line in lines if line.startswith("{")]
+    assert [s["co2_ppm"] for s in samples] == [683, 711]
+    assert "PayloadContentException: 1" in lines
+    assert "decoded: 1" in lines
+    assert [l.device_id for l in dead_letter.read_dead_letters(remaining)] == [
+        "ers-co2-sample1",
+        "other",
+    ]
@@ -0,0 +1,36 @@
+import clairttn.device_index as device_index
+import clairttn.ers as ers
+import clairttn.types as types
+
+
+class TestDeviceIndex:
+    def test_last_seen(self):
+        index = device_index.DeviceIndex()
+        eui = bytes.fromhex("a81758fffe052b0f")
+        index.record(eui, 1000.0, 600)
+        index.record(eui, 900.0, 600)  # late, out-of-order uplink
+        assert index.last_seen(eui) == 1000.0
+        assert index.last_seen(bytes.fromhex("a81758fffe052b10")) is None
+
+    def test_capacity(self):
+        index = device_index.DeviceIndex(capacity=2)
+        for i in range(3):
+            index.record(bytes([i]), 1000.0 + i)
+        assert len(index) == 2
+        assert index.last_seen(bytes([0])) is None
+        assert index.last_seen(bytes([2])) == 1002.0
+
+    def test_silent_devices(self):
+        index = device_index.DeviceIndex(silence_factor=2)
+        index.record(b"\x01", 1000.0, 100)
+        index.record(b"\x02", 1000.0, 1000)
+        silent = index.silent_devices(now=1250.0)
+        assert silent == [(b"\x01", 1000.0, 100)]
+
+
+def test_expected_send_interval():
+    interval = device_index.expected_send_interval(
+        ers.PROTOCOL_PAYLOAD_SPECIFICATION, types.LoRaWanMcs.SF12BW125
+    )
+    assert interval == 5 * 948
+    assert device_index.expected_send_interval(None, types.LoRaWanMcs.SF12BW125) is None
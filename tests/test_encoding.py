@@ -0,0 +1,108 @@
+import pytest
+import clairttn.encoding as encoding
+import clairttn.sinks as sinks
+
+
+NODE_ID = "9d02faee-4260-1377-22ec-936428b572ee"
+
+
+def _records():
+    return [
+        sinks.SampleRecord(NODE_ID, "ers-co2-sample1", {
+            "timestamp_s": 1632220557,
+            "co2_ppm": 683,
+            "temperature_celsius": 21.3,
+            "rel_humidity_percent": 40,
+        }),
+        sinks.SampleRecord(NODE_ID, "ers-co2-sample1", {"timestamp_s": 1632220857, "co2_ppm": 711}),
+        sinks.SampleRecord("registry-node", "clairchen-1", {"timestamp_s": 1632220857, "co2_ppm": 1200.5}),
+    ]
+
+
+@pytest.mark.parametrize("value, encoded", [
+    # examples of RFC 8949, appendix A
+    (0, "00"),
+    (23, "17"),
+    (24, "1818"),
+    (1000, "1903e8"),
+    (1000000, "1a000f4240"),
+    (1000000000000, "1b000000e8d4a51000"),
+    (-1000, "3903e7"),
+    (100000.0, "fa47c35000"),
+    (1.1, "fb3ff199999999999a"),
+    (None, "f6"),
+    (b"\x01\x02\x03\x04", "4401020304"),
+    ("IETF", "6449455446"),
+    ([1, [2, 3], [4, 5]], "8301820203820405"),
+    ({"a": 1, "b": [2, 3]}, "a26161016162820203"),
+])
+def test_cbor(value, encoded):
+    assert encoding.cbor_dumps(value).hex() == encoded
+    assert encoding.cbor_loads(bytes.fromhex(encoded)) == value
+
+
+def test_cbor_half_precision():
+    assert encoding.cbor_loads(bytes.fromhex("f93c00")) == 1.0
+
+
+def test_invalid_cbor():
+    for data in ["", "1903", "6449", "8301", "0000"]:
+        with pytest.raises(encoding.EncodingException):
+            encoding.cbor_loads(bytes.fromhex(data))
+
+
+@pytest.mark.parametrize("body_encoding, compression", [
+    ("cbor", "identity"),
+    ("cbor", "gzip"),
+    ("msgpack", "gzip"),
+    ("cbor", "zstd"),
+])
+def test_round_trip(body_encoding, compression):
+    if body_encoding == "msgpack":
+        pytest.importorskip("msgpack")
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    body, headers = encoding.encode_batch(_records(), body_encoding, compression)
+    decoded = encoding.decode_batch(
+        body, headers["Content-Type"], headers.get("Content-Encoding")
+    )
+    assert decoded == [(record.node_id, record.attributes) for record in _records()]
+
+
+def test_node_ids_are_sent_once():
+    batch = encoding.to_batch(_records())
+    assert batch["nodes"] == [bytes.fromhex(NODE_ID.replace("-", "")), "registry-node"]
+    assert [row[0] for row in batch["samples"]] == [0, 0, 1]
+
+
+def test_unsupported_content_type():
+    with pytest.raises(encoding.EncodingException):
+        encoding.decode_batch(b"{}", "application/vnd.api+json")
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+
+def test_fallback_to_json_api(monkeypatch):
+    sink = sinks.create_sink("cbor+gzip:http://localhost:8888/ingest/v1/")
+    posted = []
+
+    def _post(url, data, headers, timeout):
+        posted.append((url, headers))
+        return _Response(415)
+
+    monkeypatch.setattr(sink._session, "post", _post)
+    written = []
+    monkeypatch.setattr(sinks.JsonApiSink, "write", lambda self, records: written.extend(records))
+    sink.write(_records())
+    sink.write(_records())
+    [(url, headers)] = posted
+    assert url == "http://localhost:8888/ingest/v1/ingest/"
+    assert headers["Content-Type"] == "application/vnd.clair.samples+cbor"
+    assert headers["Content-Encoding"] == "gzip"
+    assert len(written) == 6
@@ -0,0 +1,169 @@
+import clairttn.fixtures as fixtures
+import clairttn.types as types
+import clairttn.ers as ers
+import io
+import json
+import pytest
+from click.testing import CliRunner
+from clairttn.scripts.generate_fixtures import generate_fixtures
+from tests.storage_stub import StorageStub, uplink
+
+
+class TestExternalSorter:
+    def test_in_memory(self):
+        sorter = fixtures.ExternalSorter(key=lambda item: item[0], run_size=10)
+        for item in [[3, "a"], [1, "b"], [2, "c"]]:
+            sorter.add(item)
+        assert list(sorter.sorted()) == [[1, "b"], [2, "c"], [3, "a"]]
+
+    def test_spilled_runs_are_stable(self):
+        items = [[i % 7, i] for i in range(100)]
+        sorter = fixtures.ExternalSorter(key=lambda item: item[0], run_size=8)
+        for item in items:
+            sorter.add(item)
+        assert list(sorter.sorted()) == sorted(items, key=lambda item: item[0])
+
+
+class TestFixtureWriter:
+    def test_matches_json_dumps(self):
+        items = [{"model": "core.sample", "fields": {"node": "x", "co2_ppm": i}} for i in range(3)]
+        fd = io.StringIO()
+        writer = fixtures.FixtureWriter(fd)
+        for item in items:
+            writer.write(item)
+        writer.close()
+        assert fd.getvalue() == json.dumps(items, indent=4) + "\n"
+
+    def test_empty(self):
+        fd = io.StringIO()
+        fixtures.FixtureWriter(fd).close()
+        assert json.loads(fd.getvalue()) == []
+
+
+def test_sample_fields():
+    sample = types.Sample(types.Timestamp(1600000000), types.CO2(450), types.Temperature(20.5))
+    assert fixtures.sample_fields("node-1", sample) == {
+        "node": "node-1",
+        "timestamp_s": 1600000000,
+        "co2_ppm": 450,
+        "measurement_status": "M",
+        "temperature_celsius": 20.5,
+    }
+
+
+class TestGenerateFixtures:
+    def _run(self, uplinks, *args, access_key_file):
+        with StorageStub(uplinks) as stub:
+            result = CliRunner().invoke(
+                generate_fixtures,
+                ["-b", stub.base_url, *args, "test-app", str(access_key_file)],
+            )
+        assert result.exit_code == 0, result.output
+        return json.loads(result.output)
+
+    def test_ers(self, tmp_path):
+        access_key_file = tmp_path / "key"
+        access_key_file.write_text("secret\n")
+        uplinks = [
+            uplink("ers-co2-sample1", "A81758FFFE052B0F", "06 02 C7 06 02 AB", "2021-09-21T10:35:57Z"),
+            uplink("ers-co2-sample1", "A81758FFFE052B0F", "06 02 FA 06 03 00", "2021-09-21T10:30:00Z"),
+            uplink("ers-co2-sample1", "A81758FFFE052B0F", "06", "2021-09-21T10:40:00Z"),
+        ]
+        result = self._run(
+            uplinks,
+            "--after", "2021-09-21T00:00:00Z",
+            "--before", "2021-09-22T00:00:00Z",
+            "--sort-run-size", "1",
+            access_key_file=access_key_file,
+        )
+        timestamps = [f["fields"]["timestamp_s"] for f in result]
+        assert timestamps == sorted(timestamps)
+        assert len(result) == 4
+        assert {f["fields"]["node"] for f in result} == {
+            str(ers.ErsDeviceUUID(bytes.fromhex("a81758fffe052b0f")))
+        }
+        assert [f["fields"]["co2_ppm"] for f in result] == [768, 762, 683, 711]
+
+    def test_clairchen(self, tmp_path):
+        access_key_file = tmp_path / "key"
+        access_key_file.write_text("secret\n")
+        uplinks = [
+            uplink("clairfeatherprotored", "9876B600001193E0", "02 1B E4 1A E4 19 E3", "2020-09-01T13:17:31Z"),
+        ]
+        result = self._run(
+            uplinks,
+            "--before", "2020-09-02T00:00:00Z",
+            "-p", "clairchen",
+            access_key_file=access_key_file,
+        )
+        assert [f["fields"]["timestamp_s"] for f in result] == [
+            1598966251 - 2 * 178,
+            1598966251 - 178,
+            1598966251,
+        ]
+        assert result[0]["fields"]["node"] == "c727b2f8-8377-d4cb-0e95-ac03200b8c93"
+
+    def test_csv_derives_uuid_of_unmapped_device(self, tmp_path):
+        access_key_file = tmp_path / "key"
+        access_key_file.write_text("secret\n")
+        uplinks = [
+            uplink("ers-unmapped", "A81758FFFE05FFFF", "06 02 C7 06 02 AB", "2021-09-21T10:35:57Z"),
+        ]
+        with StorageStub(uplinks) as stub:
+            result = CliRunner().invoke(generate_fixtures, [
+                "-b", stub.base_url, "--before", "2021-09-22T00:00:00Z", "-f", "csv",
+                "test-app", str(access_key_file),
+            ])
+        assert result.exit_code == 0, result.output
+        rows = result.output.splitlines()[1:]
+        assert len(rows) == 2
+        uuid = str(ers.ErsDeviceUUID(bytes.fromhex("a81758fffe05ffff")))
+        assert all(row.startswith(uuid + ",") for row in rows)
+
+
+SAMPLE_ROWS = [
+    {"node": "n1", "timestamp_s": 100, "co2_ppm": 450, "temperature_celsius": 20.5,
+     "rel_humidity_percent": 40, "measurement_status": "M"},
+    {"node": "n2", "timestamp_s": 101, "co2_ppm": 500, "measurement_status": "M"},
+]
+
+
+class TestBulkLoadWriters:
+    def test_csv(self):
+        fd = io.StringIO()
+        writer = fixtures.CopyCsvWriter(fd)
+        for row in SAMPLE_ROWS:
+            writer.write(row)
+        writer.close()
+        assert fd.getvalue() == (
+            "node,timestamp_s,co2_ppm,temperature_celsius,rel_humidity_percent,measurement_status\n"
+            "n1,100,450,20.5,40,M\n"
+            "n2,101,500,,,M\n"
+        )
+
+    def test_tsv(self):
+        fd = io.StringIO()
+        writer = fixtures.CopyTextWriter(fd)
+        for row in SAMPLE_ROWS:
+            writer.write(row)
+        writer.close()
+        assert fd.getvalue() == "n1\t100\t450\t20.5\t40\tM\nn2\t101\t500\t\\N\t\\N\tM\n"
+
+    @pytest.mark.parametrize("file_format", fixtures.COLUMNAR_FORMATS)
+    def test_columnar(self, tmp_path, file_format):
+        pyarrow = pytest.importorskip("pyarrow")
+        path = str(tmp_path / "samples")
+        writer = fixtures.ColumnarWriter(path, file_format, batch_size=1)
+        for row in SAMPLE_ROWS:
+            writer.write(row)
+        writer.close()
+        if file_format == "parquet":
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(path)
+        else:
+            import pyarrow.ipc
+            table = pyarrow.ipc.open_file(path).read_all()
+        assert table.column("node").to_pylist() == ["n1", "n2"]
+        assert table.column("co2_ppm").to_pylist() == [450.0, 500.0]
+        assert table.column("temperature_celsius").to_pylist() == [20.5, None]
+        assert table.column("timestamp").to_pylist()[0].timestamp() == 100
@@ -0,0 +1,85 @@
+import clairttn.health as health
+
+
+class TestLiveness:
+    def test_connected(self):
+        state = health.HealthState()
+        state.set_mqtt_connected("app", True)
+        live, report = state.liveness()
+        assert live
+        assert report["mqtt_connected"] == {"app": True}
+
+    def test_disconnected_beyond_grace(self):
+        state = health.HealthState(disconnect_grace=0)
+        state.set_mqtt_connected("app", False)
+        live, __ = state.liveness()
+        assert not live
+
+    def test_failed_reconnects(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(health.time, "monotonic", lambda: now[0])
+        state = health.HealthState(disconnect_grace=300)
+        state.set_mqtt_connected("app", True)
+        now[0] += 10
+        state.set_mqtt_connected("app", False)
+        for __ in range(10):
+            now[0] += 60
+            # _on_connect with rc != 0 and _on_disconnect on every attempt
+            state.set_mqtt_connected("app", False)
+            state.set_mqtt_connected("app", False)
+        live, __ = state.liveness()
+        assert not live
+        state.set_mqtt_connected("app", True)
+        live, __ = state.liveness()
+        assert live
+
+
+class TestReadiness:
+    def test_ready(self):
+        state = health.HealthState()
+        state.set_mqtt_connected("app", True)
+        state.mark_backend_success(0.1)
+        ready, report = state.readiness()
+        assert ready
+        assert report["backend_latency_seconds"] == 0.1
+
+    def test_not_connected(self):
+        state = health.HealthState()
+        ready, report = state.readiness()
+        assert not ready
+        assert report["reasons"] == ["mqtt disconnected"]
+
+    def test_backend_error(self):
+        state = health.HealthState()
+        state.set_mqtt_connected("app", True)
+        state.mark_backend_success(0.1)
+        state.mark_backend_error()
+        ready, report = state.readiness()
+        assert not ready
+        assert report["reasons"] == ["backend write failed"]
+        state.mark_backend_success(0.2)
+        ready, __ = state.readiness()
+        assert ready
+
+    def test_saturated_queue(self):
+        state = health.HealthState()
+        state.set_mqtt_connected("app", True)
+        state.register_queue("workers", lambda: 95, 100)
+        ready, report = state.readiness()
+        assert not ready
+        assert report["queue_saturation"] == {"workers": 0.95}
+
+    def test_uplink_silence(self):
+        state = health.HealthState(max_uplink_silence=0.000001)
+        state.set_mqtt_connected("app", True)
+        ready, report = state.readiness()
+        assert not ready
+        assert report["reasons"] == ["no uplink received"]
+
+    def test_draining(self):
+        state = health.HealthState()
+        state.set_mqtt_connected("app", True)
+        state.draining = True
+        ready, report = state.readiness()
+        assert not ready
+        assert report["reasons"] == ["draining"]
@@ -0,0 +1,114 @@
+import clairttn.metrics as metrics
+import clairttn.admin as admin
+import math
+import threading
+import urllib.request
+import pytest
+
+
+class TestCounter:
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter("test_events", "Events", ["kind"], registry=registry)
+        counter.labels("a").inc()
+        counter.labels("a").inc(2)
+        counter.labels("b").inc()
+        text = registry.render()
+        assert "# TYPE test_events counter" in text
+        assert 'test_events_total{kind="a"} 3' in text
+        assert 'test_events_total{kind="b"} 1' in text
+
+    def test_wrong_label_count(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter("test_events", "Events", ["kind"], registry=registry)
+        with pytest.raises(ValueError):
+            counter.labels("a", "b")
+
+
+class TestGauge:
+    def test_function(self):
+        registry = metrics.Registry()
+        gauge = metrics.Gauge("test_depth", "Depth", ["queue"], registry=registry)
+        gauge.labels("q").set_function(lambda: 7)
+        assert 'test_depth{queue="q"} 7' in registry.render()
+
+    def test_concurrent_inc_dec(self):
+        registry = metrics.Registry()
+        gauge = metrics.Gauge("test_inflight", "In flight", registry=registry).labels()
+
+        def _update():
+            for __ in range(10000):
+                gauge.inc()
+                gauge.dec()
+
+        threads = [threading.Thread(target=_update) for __ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert gauge.get() == 0
+
+
+class TestHistogram:
+    def test_buckets(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram(
+            "test_seconds", "Durations", buckets=(0.1, 1.0), registry=registry
+        )
+        child = histogram.labels()
+        for value in (0.05, 0.1, 0.5, 2.0):
+            child.observe(value)
+        text = registry.render()
+        assert 'test_seconds_bucket{le="0.1"} 2' in text
+        assert 'test_seconds_bucket{le="1.0"} 3' in text
+        assert 'test_seconds_bucket{le="+Inf"} 4' in text
+        assert "test_seconds_count 4" in text
+        assert "test_seconds_sum 2.65" in text
+
+    def test_quantile(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram(
+            "test_seconds", "Durations", buckets=(1.0, 2.0), registry=registry
+        )
+        child = histogram.labels()
+        assert math.isnan(child.quantile(0.5))
+        for value in (1.5, 1.5, 1.5, 1.5):
+            child.observe(value)
+        assert child.quantile(0.5) == pytest.approx(1.5)
+
+
+def test_render_snapshots():
+    def _registry():
+        registry = metrics.Registry()
+        counter = metrics.Counter("test_events", "Events", ["kind"], registry=registry)
+        histogram = metrics.Histogram("test_seconds", "Durations", buckets=(1.0,), registry=registry)
+        return registry, counter, histogram
+
+    registry, counter, histogram = _registry()
+    other_registry, other_counter, other_histogram = _registry()
+    counter.labels("a").inc()
+    other_counter.labels("a").inc(2)
+    other_counter.labels("b").inc()
+    histogram.labels().observe(0.5)
+    other_histogram.labels().observe(2.0)
+    text = registry.render([other_registry.snapshot()])
+    assert 'test_events_total{kind="a"} 3' in text
+    assert 'test_events_total{kind="b"} 1' in text
+    assert 'test_seconds_bucket{le="1.0"} 1' in text
+    assert "test_seconds_count 2" in text
+    assert "test_seconds_sum 2.5" in text
+    # the own values stay as they are
+    assert 'test_events_total{kind="a"} 1' in registry.render()
+
+
+def test_metrics_endpoint():
+    server = admin.AdminServer("127.0.0.1", 0)
+    server.start()
+    try:
+        metrics.PipelineMetrics("test-app", "ers-forward").messages.inc()
+        url = "http://127.0.0.1:{}/metrics".format(server.port)
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode("utf8")
+        assert 'clair_messages_total{app="test-app",mode="ers-forward"} 1' in text
+    finally:
+        server.stop()
@@ -0,0 +1,160 @@
+import json
+import jsonapi_requests.request_factory as jarequests
+import clairttn.negative_cache as negative_cache
+import clairttn.node_handler as node_handler
+from tests.handler_stub import FakeTtnClient, rx_message
+
+
+class _FakeSampleEndpoint:
+    def __init__(self):
+        self.known_nodes = set()
+        self.invalid_co2 = set()
+        self.down = False
+        self.posted = []
+
+    def post(self, object):
+        if self.down:
+            raise ConnectionError("backend down")
+        node_id = object.relationships["node"]["data"]["id"]
+        if node_id not in self.known_nodes:
+            raise jarequests.ApiClientError(404, b'{"errors": []}')
+        if object.attributes["co2_ppm"] in self.invalid_co2:
+            raise jarequests.ApiClientError(422, b'{"errors": []}')
+        self.posted.append(object.attributes["co2_ppm"])
+
+
+def test_is_rejection():
+    assert negative_cache.is_rejection(404)
+    assert negative_cache.is_rejection(403)
+    assert not negative_cache.is_rejection(422)
+    assert not negative_cache.is_rejection(409)
+    assert not negative_cache.is_rejection(429)
+    assert not negative_cache.is_rejection(500)
+
+
+def test_rejection_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(negative_cache.time, "monotonic", lambda: now[0])
+    cache = negative_cache.NegativeCache(ttl=60)
+    cache.reject("node-1", 404)
+    assert cache.is_rejected("node-1")
+    assert not cache.is_rejected("node-2")
+    assert cache.rejected_nodes() == [("node-1", 404, 60)]
+    now[0] += 61
+    assert not cache.is_rejected("node-1")
+    assert cache.rejected_nodes() == []
+
+
+def test_capacity_and_invalidate():
+    cache = negative_cache.NegativeCache(capacity=2)
+    for node_id in ("node-1", "node-2", "node-3"):
+        cache.reject(node_id, 404)
+    assert not cache.is_rejected("node-1")
+    assert cache.invalidate("node-2") == 1
+    assert not cache.is_rejected("node-2")
+    assert cache.invalidate() == 1
+    assert cache.rejected_nodes() == []
+
+
+def test_spool_survives_restart(tmp_path):
+    cache = negative_cache.NegativeCache(spool_limit=2)
+    assert not cache.spool("node-1", {"co2_ppm": 400})
+    cache.set_spool_dir(str(tmp_path))
+    for co2 in (400, 410, 420):
+        cache.spool("node-1", {"co2_ppm": co2})
+    assert cache.spooled_count("node-1") == 2
+
+    restarted = negative_cache.NegativeCache()
+    restarted.set_spool_dir(str(tmp_path))
+    assert restarted.has_spool("node-1")
+    assert restarted.spooled_samples("node-1", 10) == [{"co2_ppm": 400}, {"co2_ppm": 410}]
+    restarted.remove_spooled("node-1", 1)
+    assert restarted.spooled_samples("node-1", 10) == [{"co2_ppm": 410}]
+    restarted.remove_spooled("node-1", 1)
+    assert not restarted.has_spool("node-1")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_rejected_node_is_skipped_and_replayed(monkeypatch, tmp_path):
+    cache = negative_cache.NegativeCache(ttl=600)
+    cache.set_spool_dir(str(tmp_path))
+    monkeypatch.setattr(negative_cache, "NEGATIVE_CACHE", cache)
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/"
+    )
+    endpoint = _FakeSampleEndpoint()
+    handler._sample_endpoint = endpoint
+    node_id = str(handler._get_device_uuid(rx_message("0602C70602AB")))
+
+    handler._handle_message(rx_message("0602C70602AB"))
+    assert cache.is_rejected(node_id)
+    assert cache.spooled_count(node_id) == 2
+
+    # further samples are not posted while the node is rejected
+    handler._handle_message(rx_message("0602C70602AB"))
+    assert cache.spooled_count(node_id) == 4
+    assert endpoint.posted == []
+
+    endpoint.known_nodes.add(node_id)
+    assert negative_cache.invalidate_route({"node": node_id})[2] == json.dumps({"invalidated": 1})
+    handler._handle_message(rx_message("0602C70602AB"))
+    assert endpoint.posted == [683, 711, 683, 711, 683, 711]
+    assert not cache.has_spool(node_id)
+
+
+def test_invalid_spooled_sample_is_dropped(monkeypatch, tmp_path):
+    cache = negative_cache.NegativeCache(ttl=600)
+    cache.set_spool_dir(str(tmp_path))
+    monkeypatch.setattr(negative_cache, "NEGATIVE_CACHE", cache)
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/"
+    )
+    endpoint = _FakeSampleEndpoint()
+    handler._sample_endpoint = endpoint
+    node_id = str(handler._get_device_uuid(rx_message("0602C70602AB")))
+
+    handler._handle_message(rx_message("0602C70602AB"))
+    assert cache.spooled_count(node_id) == 2
+
+    endpoint.known_nodes.add(node_id)
+    endpoint.invalid_co2.add(683)
+    cache.invalidate(node_id)
+    handler._handle_message(rx_message("0602FA060300"))
+    assert endpoint.posted == [711, 768, 762]
+    assert not cache.is_rejected(node_id)
+    assert not cache.has_spool(node_id)
+
+
+def test_replay_in_chunks(monkeypatch, tmp_path):
+    cache = negative_cache.NegativeCache(ttl=600)
+    cache.set_spool_dir(str(tmp_path))
+    monkeypatch.setattr(negative_cache, "NEGATIVE_CACHE", cache)
+    monkeypatch.setattr(node_handler, "REPLAY_CHUNK_SIZE", 3)
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/"
+    )
+    endpoint = _FakeSampleEndpoint()
+    handler._sample_endpoint = endpoint
+    node_id = str(handler._get_device_uuid(rx_message("0602C70602AB")))
+    for co2 in range(400, 405):
+        cache.spool(node_id, {"timestamp_s": 0, "co2_ppm": co2})
+    endpoint.known_nodes.add(node_id)
+
+    # the backend fails during the replay
+    endpoint.down = True
+    handler._handle_message(rx_message("0602C70602AB"))
+    assert cache.spooled_count(node_id) == 7
+
+    # the uplink's own samples wait behind the rest of the spool
+    endpoint.down = False
+    handler._handle_message(rx_message("0602FA060300"))
+    assert endpoint.posted == [400, 401, 402]
+    assert cache.spooled_count(node_id) == 6
+    for __ in range(2):
+        handler._handle_message(rx_message("0602C70602AB"))
+    assert endpoint.posted == [400, 401, 402, 403, 404, 683, 711, 768, 762]
+    # the spool shrinks by one sample per uplink
+    for __ in range(4):
+        handler._handle_message(rx_message("0602C70602AB"))
+    assert endpoint.posted[9:] == [683, 711] * 6
+    assert not cache.has_spool(node_id)
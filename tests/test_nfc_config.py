@@ -0,0 +1,40 @@
+import zipfile
+from click.testing import CliRunner
+from clairttn.scripts.nfc_config import generate_nfc_config, _generate_nfc_config
+
+
+DEVICES = [
+    ("a81758fffe05{:04x}".format(i), "70b3d57ed0000000", "{:032x}".format(i))
+    for i in range(5)
+]
+
+
+def _config_values(nfc_config):
+    return dict(line.split(":", 1) for line in nfc_config.splitlines())
+
+
+def test_default_parameter_set():
+    config = _config_values(_generate_nfc_config("70b3d57ed0000000", "00" * 16))
+    assert (config["SplPer"], config["TempPer"], config["SendPer"]) == ("356", "0", "3")
+
+
+def test_batch_archive(tmp_path):
+    batch_file = tmp_path / "devices.csv"
+    batch_file.write_text(
+        "dev_eui,join_eui,app_key\n" + "".join("{},{},{}\n".format(*d) for d in DEVICES)
+    )
+    archive_path = tmp_path / "configs.zip"
+    result = CliRunner().invoke(
+        generate_nfc_config,
+        ["-b", str(batch_file), "-o", str(archive_path), "-m", "SF12BW125", "-j", "2"],
+    )
+    assert result.exit_code == 0, result.output
+
+    with zipfile.ZipFile(archive_path) as archive:
+        names = archive.namelist()
+        assert names[:2] == ["{}-nfc-config.txt".format(DEVICES[0][0]), "{}-nfc-config.png".format(DEVICES[0][0])]
+        assert len(names) == 2 * len(DEVICES)
+        config = _config_values(archive.read("{}-nfc-config.txt".format(DEVICES[4][0])).decode())
+        assert config["AppKey"] == DEVICES[4][2]
+        assert (config["SplPer"], config["TempPer"], config["SendPer"]) == ("948", "0", "5")
+        assert archive.read("{}-nfc-config.png".format(DEVICES[4][0])).startswith(b"\x89PNG")
@@ -0,0 +1,88 @@
+import pytest
+import clairttn.node_handler as node_handler
+import clairttn.ers as ers
+import clairttn.types as types
+from tests.handler_stub import FakeTtnClient, rx_message
+
+
+class TestErsForwardingAndConfiguration:
+    def _create_handler(self, monkeypatch):
+        ttn_client = FakeTtnClient()
+        handler = node_handler.ErsForwardingAndConfigurationHandler(
+            ttn_client, "http://localhost:8888/ingest/v1/"
+        )
+        posted = []
+        monkeypatch.setattr(
+            handler, "_post_sample", lambda sample, uuid: posted.append((sample, uuid))
+        )
+        decode_calls = []
+
+        def _decode_payload(payload, rx_datetime):
+            decode_calls.append(payload)
+            return ers._to_samples(ers._decode_measurements(payload), rx_datetime)
+
+        monkeypatch.setattr(ers, "decode_payload", _decode_payload)
+        return handler, ttn_client, posted, decode_calls
+
+    def test_conforming_uplink(self, monkeypatch):
+        handler, ttn_client, posted, decode_calls = self._create_handler(monkeypatch)
+        message = rx_message("06 02 C7 06 02 AB")
+
+        handler._handle_message(message)
+
+        assert len(decode_calls) == 1
+        assert len(posted) == 2
+        assert posted[0][1] == ers.ErsDeviceUUID(message.device_eui)
+        assert ttn_client.sent == []
+
+    def test_non_conforming_uplink(self, monkeypatch):
+        handler, ttn_client, posted, decode_calls = self._create_handler(monkeypatch)
+        message = rx_message("06 02 C7 06 02 AB 06 02 FA", mcs=types.LoRaWanMcs.SF12BW125)
+
+        handler._handle_message(message)
+
+        assert len(decode_calls) == 1
+        assert len(posted) == 3
+        assert len(ttn_client.sent) == 1
+        dev_id, port, __ = ttn_client.sent[0]
+        assert dev_id == "ers-co2-sample1"
+        assert port == 6
+
+
+class _FakeArchive:
+    def __init__(self):
+        self.samples = []
+
+    def add(self, node, sample):
+        self.samples.append((node, sample.co2.value))
+
+
+def test_forwarded_samples_are_archived(monkeypatch):
+    sample_archive = _FakeArchive()
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/", sample_archive
+    )
+    monkeypatch.setattr(handler, "_post_sample", lambda sample, uuid: None)
+    message = rx_message("06 02 C7 06 02 AB")
+
+    handler._handle_message(message)
+
+    device_uuid = ers.ErsDeviceUUID(message.device_eui)
+    assert sample_archive.samples == [(device_uuid, 683), (device_uuid, 711)]
+
+
+def test_samples_are_archived_when_the_backend_fails(monkeypatch):
+    sample_archive = _FakeArchive()
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/", sample_archive
+    )
+
+    def _post_sample(sample, uuid):
+        raise ConnectionError("backend down")
+
+    monkeypatch.setattr(handler, "_post_sample", _post_sample)
+
+    with pytest.raises(ConnectionError):
+        handler._handle_message(rx_message("06 02 C7 06 02 AB"))
+
+    assert [co2 for __, co2 in sample_archive.samples] == [683, 711]
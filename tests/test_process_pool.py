@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import threading
+import http.server
+import clairttn.admin as admin
+import clairttn.config as config
+import clairttn.health as health
+import clairttn.metrics as metrics
+import clairttn.process_pool as process_pool
+from clairttn.scripts.clairttn import _ForwardingProcessFactory, _relay_to_processes
+from tests.handler_stub import rx_message
+
+
+def _rx_message(device_index, f_cnt, payload="0602C70602AB"):
+    return rx_message(
+        payload,
+        device_id="device-{}".format(device_index),
+        device_eui="a81758fffe05{:04x}".format(device_index),
+        f_cnt=f_cnt,
+    )
+
+
+class _RecordingHandler:
+    def __init__(self, path):
+        self._fd = open(path, "a")
+        self._handled = 0
+
+    def handle(self, app_id, rx_message, trace_context):
+        self._handled += 1
+        self._fd.write("{} {} {} {}\n".format(os.getpid(), app_id, rx_message.device_id, rx_message.f_cnt))
+
+    def handled(self):
+        return self._handled
+
+    def close(self):
+        self._fd.close()
+
+
+class _RecordingHandlerFactory:
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        return _RecordingHandler("{}.{}".format(self.path, os.getpid()))
+
+
+def test_per_device_order(tmp_path):
+    pool = process_pool.ProcessPool(
+        _RecordingHandlerFactory(str(tmp_path / "handled")), processes=2, batch_size=8
+    )
+    pool.start()
+    for f_cnt in range(20):
+        for device_index in range(5):
+            pool.submit("app", _rx_message(device_index, f_cnt))
+    assert pool.stop(timeout=30)
+
+    handled = []
+    for path in tmp_path.iterdir():
+        with open(str(path)) as fd:
+            handled.extend(line.split() for line in fd)
+    assert len(handled) == 100
+    assert len({pid for pid, *__ in handled}) == 2
+    for device_index in range(5):
+        device_id = "device-{}".format(device_index)
+        by_device = [(pid, int(f_cnt)) for pid, __, d, f_cnt in handled if d == device_id]
+        assert [f_cnt for __, f_cnt in by_device] == list(range(20))
+        assert len({pid for pid, __ in by_device}) == 1
+
+
+class _StuckHandler:
+    def handle(self, app_id, rx_message, trace_context):
+        time.sleep(3600)
+
+    def close(self):
+        pass
+
+
+def test_stop_stuck_process():
+    pool = process_pool.ProcessPool(_StuckHandler, processes=1, batch_size=1)
+    pool.start()
+
+    def _submit():
+        # more than the pipe holds
+        for f_cnt in range(2000):
+            pool.submit("app", _rx_message(0, f_cnt))
+
+    submitter = threading.Thread(target=_submit)
+    submitter.start()
+    time.sleep(1)
+    started = time.monotonic()
+    assert not pool.stop(timeout=1)
+    assert time.monotonic() - started < 5
+    submitter.join(5)
+    assert not submitter.is_alive()
+
+
+def test_call(tmp_path):
+    pool = process_pool.ProcessPool(_RecordingHandlerFactory(str(tmp_path / "handled")), processes=2)
+    pool.start()
+    for device_index in range(5):
+        pool.submit("app", _rx_message(device_index, 1))
+    # answered after the uplinks submitted before
+    handled = pool.call("handled")
+    assert len(handled) == 2
+    assert sum(handled) == 5
+    assert pool.stop(timeout=30)
+    assert pool.call("handled") == []
+
+
+class _IngestHandler(http.server.BaseHTTPRequestHandler):
+    posted = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.posted.append(body["data"]["attributes"]["co2_ppm"])
+        response = json.dumps({"data": dict(body["data"], id="1")}).encode("utf8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_forwarding_processes(tmp_path):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _IngestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_root = "http://127.0.0.1:{}/ingest/v1/".format(server.server_address[1])
+    app_config = config.AppConfig("app", "key", "ers-forward", "ttn-v3", api_root)
+    trace_file = tmp_path / "trace.ndjson"
+    pool = process_pool.ProcessPool(
+        _ForwardingProcessFactory([app_config], None, 600, None, None, 60, str(trace_file)), processes=2
+    )
+    pool.start()
+    for device_index in range(4):
+        pool.submit("app", _rx_message(device_index, 1), ("ab" * 16, "cd" * 8))
+    # undecodable, quarantined in the worker process
+    pool.submit("app", _rx_message(4, 1, "0602C7"))
+
+    admin_server = admin.AdminServer("127.0.0.1", 0)
+    _relay_to_processes(admin_server, pool)
+    try:
+        __, __, body = admin_server.get_route("GET", "/dead-letters")({})
+        assert json.loads(body)["by_device"]["device-4"] == 1
+        status, __, body = admin_server.get_route("GET", "/devices/last-seen")({"eui": "a81758fffe050002"})
+        assert status == 200
+        assert json.loads(body)["device_eui"] == "a81758fffe050002"
+        __, report = health.HEALTH.readiness()
+        assert report["seconds_since_last_backend_write"] is not None
+        samples = metrics.SAMPLES.labels("app", "ers-forward").value + 8
+        __, __, body = admin_server.get_route("GET", "/metrics")({})
+        assert 'clair_samples_total{{app="app",mode="ers-forward"}} {}'.format(samples) in body
+        __, __, body = admin_server.get_route("GET", "/latency")({})
+        assert [latency["count"] for latency in json.loads(body) if latency["app"] == "app"] == [4]
+    finally:
+        health.HEALTH.backend_sources.clear()
+    assert pool.stop(timeout=30)
+    server.shutdown()
+    server.server_close()
+    assert sorted(_IngestHandler.posted) == [683] * 4 + [711] * 4
+
+    spans = [
+        span
+        for line in trace_file.read_text().splitlines()
+        for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    ]
+    assert [(span["name"], span["traceId"], span["parentSpanId"]) for span in spans if span["name"] == "handle"] == [
+        ("handle", "ab" * 16, "cd" * 8)
+    ] * 4
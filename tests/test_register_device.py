@@ -0,0 +1,125 @@
+import clairttn.ers as ers
+import http.server
+import json
+import threading
+import urllib.parse
+from click.testing import CliRunner
+from clairttn.scripts.register_device import register_device_in_managair
+
+
+EXISTING_EUI = "a81758fffe052b0f"
+NEW_EUIS = ["a81758fffe053c13", "a81758fffe053c14"]
+REJECTED_EUI = "a81758fffe053cab"
+
+
+class _ManagairStub:
+    def __init__(self, existing_node_ids):
+        self.existing_node_ids = existing_node_ids
+        self.created = []
+        self.auth_headers = set()
+        stub = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                stub.auth_headers.add(self.headers.get("Authorization"))
+                # one node per page to exercise the pagination
+                page = int(query["page[number]"])
+                node_ids = sorted(stub.existing_node_ids)
+                data = [{"type": "Node", "id": i} for i in node_ids[page - 1:page]]
+                has_next = page < len(node_ids)
+                self._respond(200, {"data": data, "links": {"next": "next" if has_next else None}})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path.startswith("/auth/login"):
+                    self._respond(200, {"data": {"type": "LoginView", "attributes": {"key": "k3y"}}})
+                    return
+                stub.auth_headers.add(self.headers.get("Authorization"))
+                node = body["data"]
+                if node["attributes"]["eui64"] == REJECTED_EUI:
+                    self._respond(400, {"errors": [{"detail": "invalid"}]})
+                    return
+                stub.created.append(node)
+                self._respond(201, {"data": node})
+
+            def _respond(self, status, payload):
+                body = json.dumps(payload).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/vnd.api+json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.api_root = "http://127.0.0.1:{}/".format(self._server.server_address[1])
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _node_id(eui):
+    return str(ers.ErsDeviceUUID(bytes.fromhex(eui)))
+
+
+def test_bulk_registration():
+    stub = _ManagairStub({_node_id(EXISTING_EUI), _node_id("0000000000000001")})
+    try:
+        eui_csv = "dev_eui,comment\n{}\n{},x\n{}\n{}\n".format(
+            EXISTING_EUI, NEW_EUIS[0], NEW_EUIS[1], REJECTED_EUI
+        )
+        result = CliRunner().invoke(
+            register_device_in_managair,
+            ["-r", stub.api_root, "-a", "como-", "-u", "user", "--password", "secret",
+             "-f", "-", "2", "2", "17"],
+            input=eui_csv,
+        )
+    finally:
+        stub.close()
+
+    assert result.exit_code == 1
+    results = [json.loads(line) for line in result.output.splitlines()]
+    assert [(r["dev_eui"], r["status"]) for r in results] == [
+        (EXISTING_EUI, "exists"),
+        (NEW_EUIS[0], "created"),
+        (NEW_EUIS[1], "created"),
+        (REJECTED_EUI, "failed"),
+    ]
+    assert results[1]["node_id"] == _node_id(NEW_EUIS[0])
+    assert sorted(node["id"] for node in stub.created) == sorted(_node_id(e) for e in NEW_EUIS)
+    assert stub.created[0]["attributes"]["alias"].startswith("como-")
+    assert stub.auth_headers == {"Token k3y"}
+
+
+def test_stdin_requires_credentials():
+    result = CliRunner().invoke(
+        register_device_in_managair,
+        ["-r", "http://127.0.0.1:9/", "-f", "-", "2", "2", "17"],
+        input="{}\n".format(NEW_EUIS[0]),
+    )
+    assert result.exit_code == 2
+    assert "required when the EUIs are read from stdin" in result.output
+
+
+def test_invalid_eui():
+    result = CliRunner().invoke(
+        register_device_in_managair,
+        ["-r", "http://127.0.0.1:9/", "-u", "user", "--password", "secret", "2", "2", "17",
+         NEW_EUIS[0], "a81758fffe05zz"],
+    )
+    assert result.exit_code == 2
+    assert "not an 8 byte hex EUI: a81758fffe05zz" in result.output
+
+    result = CliRunner().invoke(
+        register_device_in_managair,
+        ["-r", "http://127.0.0.1:9/", "-u", "user", "--password", "secret", "-f", "-", "2", "2", "17"],
+        input="dev_eui\n{}\na81758fffe05\n".format(NEW_EUIS[0]),
+    )
+    assert result.exit_code == 2
+    assert "not an 8 byte hex EUI in line 3: a81758fffe05" in result.output
@@ -0,0 +1,141 @@
+import os
+import json
+import clairttn.ers as ers
+import clairttn.registry as registry
+import clairttn.ttn_handler as ttn_handler
+import clairttn.node_handler as node_handler
+from tests.storage_stub import uplink
+from tests.handler_stub import FakeTtnClient, rx_message
+
+
+REGISTRY_CSV = """device_id,dev_eui,protocol,node_id,enabled
+ers-1,a81758fffe050001,ers,,true
+clairchen-1,9876b600001193e0,clairchen,c727b2f8-8377-d4cb-0e95-ac03200b8c93,
+ers-test,a81758fffe05ffff,ers,,false
+"""
+
+
+def _write_registry(path, content, mtime):
+    path.write_text(content)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_lookup(tmp_path):
+    path = tmp_path / "devices.csv"
+    _write_registry(path, REGISTRY_CSV, 1_000_000_000)
+    device_registry = registry.DeviceRegistry(str(path))
+
+    assert len(device_registry) == 3
+    ers_device = device_registry.get("ers-1")
+    assert ers_device.protocol == "ers"
+    assert ers_device.node_id == str(ers.ErsDeviceUUID(bytes.fromhex("a81758fffe050001")))
+    assert device_registry.get_by_eui(bytes.fromhex("9876b600001193e0")).node_id == (
+        "c727b2f8-8377-d4cb-0e95-ac03200b8c93"
+    )
+    assert device_registry.is_enabled("clairchen-1")
+    assert not device_registry.is_enabled("ers-test")
+    assert not device_registry.is_enabled("unknown")
+
+
+def test_hot_reload(tmp_path):
+    path = tmp_path / "devices.csv"
+    _write_registry(path, REGISTRY_CSV, 1_000_000_000)
+    device_registry = registry.DeviceRegistry(str(path))
+    assert not device_registry.reload_if_changed()
+
+    _write_registry(path, REGISTRY_CSV.replace(",false", ",true"), 2_000_000_000)
+    assert device_registry.reload_if_changed()
+    assert device_registry.is_enabled("ers-test")
+
+    # an invalid file leaves the registry in effect
+    for mtime, content in enumerate([
+        REGISTRY_CSV + "ers-2,not-an-eui,ers,,\n",
+        # a short row
+        REGISTRY_CSV + "ers-2\n",
+        REGISTRY_CSV + '"ers-2\n',
+    ], start=3):
+        _write_registry(path, content, mtime * 1_000_000_000)
+        assert not device_registry.reload_if_changed()
+        assert device_registry.is_enabled("ers-test")
+
+    path.write_bytes(REGISTRY_CSV.encode("utf8") + b"ers-\xff,a81758fffe050002,ers,,\n")
+    os.utime(path, ns=(6_000_000_000, 6_000_000_000))
+    assert not device_registry.reload_if_changed()
+    assert device_registry.is_enabled("ers-test")
+
+
+class _MqttMessage:
+    def __init__(self, ttn_rxmsg):
+        self.topic = "v3/app@ttn/devices/{}/up".format(ttn_rxmsg["end_device_ids"]["device_id"])
+        self.payload = json.dumps(ttn_rxmsg).encode("utf8")
+
+
+def test_topic_prefilter(tmp_path, monkeypatch):
+    path = tmp_path / "devices.csv"
+    path.write_text(REGISTRY_CSV)
+    handler = ttn_handler.TtnV3Handler("app", "key")
+    handler.device_registry = registry.DeviceRegistry(str(path))
+    handled = []
+    handler.handle_message = lambda rx_message: handled.append(rx_message.device_id)
+    parsed = []
+    loads = json.loads
+    monkeypatch.setattr(ttn_handler.json, "loads", lambda s: parsed.append(s) or loads(s))
+
+    for device_id, dev_eui in [
+        ("ers-1", "a81758fffe050001"),
+        ("ers-test", "a81758fffe05ffff"),
+        ("unknown", "a81758fffe050002"),
+    ]:
+        handler._process_message(
+            _MqttMessage(uplink(device_id, dev_eui, "0602C7", "2021-09-21T10:00:00Z"))
+        )
+
+    assert handled == ["ers-1"]
+    assert len(parsed) == 1
+
+
+def test_registry_forwarding(tmp_path, monkeypatch):
+    path = tmp_path / "devices.csv"
+    path.write_text(REGISTRY_CSV)
+    device_registry = registry.DeviceRegistry(str(path))
+    handler = node_handler.RegistryForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/", device_registry
+    )
+    posted = []
+    monkeypatch.setattr(
+        handler, "_post_sample", lambda sample, uuid: posted.append((sample.co2.value, uuid))
+    )
+
+    for device_id, dev_eui, payload in [
+        ("ers-1", "a81758fffe050001", "0602C70602AB"),
+        ("clairchen-1", "9876b600001193e0", "021BE41AE419E3"),
+    ]:
+        handler._receive(rx_message(payload, device_id, dev_eui))
+
+    ers_node_id = device_registry.get("ers-1").node_id
+    assert posted[:2] == [(683, ers_node_id), (711, ers_node_id)]
+    assert len(posted) == 5
+    assert {uuid for __, uuid in posted[2:]} == {"c727b2f8-8377-d4cb-0e95-ac03200b8c93"}
+
+
+def test_device_resolved_once(tmp_path, monkeypatch):
+    path = tmp_path / "devices.csv"
+    path.write_text(REGISTRY_CSV)
+    device_registry = registry.DeviceRegistry(str(path))
+    handler = node_handler.RegistryForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/", device_registry
+    )
+    posted = []
+    monkeypatch.setattr(
+        handler, "_post_sample", lambda sample, uuid: posted.append((sample.co2.value, uuid))
+    )
+    lookups = []
+    get = device_registry.get
+    # the device is removed by a reload right after the uplink was received
+    monkeypatch.setattr(
+        device_registry, "get", lambda device_id: None if lookups else lookups.append(1) or get(device_id)
+    )
+
+    handler._receive(rx_message("0602C70602AB", "ers-1", "a81758fffe050001"))
+
+    assert [co2 for co2, __ in posted] == [683, 711]
@@ -0,0 +1,156 @@
+import time
+import datetime as dt
+import clairttn.rollup as rollup
+import clairttn.sinks as sinks
+import clairttn.node_handler as node_handler
+from tests.handler_stub import FakeTtnClient, rx_message
+
+
+NODE_ID = "9d02faee-4260-1377-22ec-936428b572ee"
+
+
+class _RecordList:
+    def __init__(self):
+        self.records = []
+
+    def submit(self, record):
+        self.records.append(record)
+
+
+def _record(timestamp_s, co2, node_id=NODE_ID, **attributes):
+    return sinks.SampleRecord(node_id, "ers-co2-sample1", dict(attributes, timestamp_s=timestamp_s, co2_ppm=co2))
+
+
+def test_buckets():
+    stage = rollup.RollupStage(intervals=(3600, 300), lateness=60)
+    record_list = _RecordList()
+    stage.sinks = [record_list]
+    stage.submit(_record(3600, 800, temperature_celsius=21.0))
+    stage.submit(_record(3700, 1000, temperature_celsius=22.0))
+    stage.submit(_record(3900, 900))
+    stage.flush(now=3900)
+    # the first 5 minutes are over, but not yet the lateness
+    assert record_list.records == []
+    stage.submit(_record(3960, 700))
+    stage.flush(now=3960)
+    [record] = record_list.records
+    assert record.node_id == NODE_ID
+    assert record.device_id == "ers-co2-sample1"
+    assert record.attributes == {
+        "timestamp_s": 3600,
+        "interval_s": 300,
+        "sample_count": 2,
+        "co2_ppm": 900,
+        "co2_ppm_min": 800,
+        "co2_ppm_max": 1000,
+        "temperature_celsius": 21.5,
+        "temperature_celsius_min": 21.0,
+        "temperature_celsius_max": 22.0,
+    }
+    stage.flush(force=True)
+    assert [(r.attributes["interval_s"], r.attributes["sample_count"]) for r in record_list.records] == [
+        (300, 2),
+        (300, 2),
+        (3600, 4),
+    ]
+
+
+def test_silent_node():
+    stage = rollup.RollupStage(intervals=(300,), lateness=60, silence_timeout=3600)
+    record_list = _RecordList()
+    stage.sinks = [record_list]
+    stage.submit(_record(0, 800))
+    stage.flush(now=3899)
+    assert record_list.records == []
+    stage.flush(now=3900)
+    assert len(record_list.records) == 1
+
+
+def test_late_samples():
+    stage = rollup.RollupStage(intervals=(300,), lateness=0)
+    record_list = _RecordList()
+    stage.sinks = [record_list]
+    stage.submit(_record(0, 800))
+    stage.submit(_record(300, 800))
+    stage.flush(now=300)
+    stage.submit(_record(299, 2000))
+    stage.flush(force=True)
+    assert [r.attributes["co2_ppm_max"] for r in record_list.records] == [800, 800]
+
+
+def test_forward_shortest_interval():
+    forwarded = []
+    stage = rollup.RollupStage(
+        intervals=(3600, 300), forward=lambda node_id, attributes: forwarded.append((node_id, attributes))
+    )
+    stage.submit(_record(0, 800, temperature_celsius=21.25, rel_humidity_percent=40))
+    stage.submit(_record(200, 901, temperature_celsius=21.5, rel_humidity_percent=41))
+    stage.submit(_record(360, 700))
+    stage.flush(now=360)
+    assert forwarded == [(NODE_ID, {
+        "timestamp_s": 0,
+        "co2_ppm": 850.5,
+        "temperature_celsius": 21.4,
+        "rel_humidity_percent": 40,
+    })]
+
+
+def test_forward_rollups_only():
+    handler = node_handler.ErsForwardingHandler(FakeTtnClient(), "http://localhost:8888/ingest/v1/")
+    posted = []
+    handler._post_sample_attributes = lambda attributes, node_id: posted.append(attributes)
+    stage = rollup.RollupStage(intervals=(86400,), forward=handler.forward_rollup)
+    handler.sinks = [stage]
+    handler.forward_raw = False
+    handler._handle_message(rx_message(
+        "0602C70602AB", rx_datetime=dt.datetime(2021, 9, 21, 10, 0, 10, tzinfo=dt.timezone.utc)
+    ))
+    assert posted == []
+    # the end of the day plus the silence timeout
+    stage.flush(now=dt.datetime(2021, 9, 22, 2, tzinfo=dt.timezone.utc).timestamp())
+    [attributes] = posted
+    assert attributes["co2_ppm"] == 697
+
+
+def test_open_buckets_are_not_forwarded():
+    forwarded = []
+    stage = rollup.RollupStage(intervals=(300,), forward=lambda node_id, attributes: forwarded.append(node_id))
+    record_list = _RecordList()
+    stage.sinks = [record_list]
+    stage.submit(_record(time.time(), 800))
+    assert stage.stop()
+    assert len(record_list.records) == 1
+    assert forwarded == []
+
+
+def test_stop_timeout():
+    forwarded = []
+
+    def forward(node_id, attributes):
+        time.sleep(0.2)
+        forwarded.append(node_id)
+
+    stage = rollup.RollupStage(intervals=(300,), forward=forward)
+    record_list = _RecordList()
+    stage.sinks = [record_list]
+    # closed, as the nodes fell silent long ago
+    stage.submit(_record(0, 800, node_id="node-1"))
+    stage.submit(_record(0, 800, node_id="node-2"))
+    assert not stage.stop(timeout=0.1)
+    assert forwarded == ["node-1"]
+    assert len(record_list.records) == 2
+
+
+def test_line_protocol():
+    record = sinks.SampleRecord(NODE_ID, "ers-co2-sample1", {
+        "timestamp_s": 3600,
+        "interval_s": 300,
+        "sample_count": 2,
+        "co2_ppm": 900,
+        "co2_ppm_min": 800,
+        "co2_ppm_max": 1000,
+    })
+    assert sinks.LineProtocolSink.format_line(record) == (
+        "clair_rollup,node=9d02faee-4260-1377-22ec-936428b572ee,device=ers-co2-sample1,interval=300 "
+        "sample_count=2.0,co2_ppm=900.0,co2_ppm_min=800.0,co2_ppm_max=1000.0 3600"
+    )
@@ -0,0 +1,169 @@
+import json
+import time
+import threading
+import pytest
+import clairttn.sinks as sinks
+import clairttn.node_handler as node_handler
+from tests.handler_stub import FakeTtnClient, rx_message
+
+
+class _ListSink:
+    def __init__(self, name, failures=0, block=None):
+        self.name = name
+        self.written = []
+        self.batch_sizes = []
+        self.closed = False
+        self._failures = failures
+        self._block = block
+
+    def write(self, records):
+        if self._block:
+            self._block.wait()
+        if self._failures:
+            self._failures -= 1
+            raise ConnectionError("sink down")
+        self.written.extend(records)
+        self.batch_sizes.append(len(records))
+
+    def close(self):
+        self.closed = True
+
+
+def _record(co2, timestamp_s=1632220557, **attributes):
+    return sinks.SampleRecord(
+        "9d02faee-4260-1377-22ec-936428b572ee",
+        "ers-co2-sample1",
+        dict(attributes, timestamp_s=timestamp_s, co2_ppm=co2),
+    )
+
+
+def test_line_protocol():
+    record = _record(683, temperature_celsius=21.5, rel_humidity_percent=40)
+    assert sinks.LineProtocolSink.format_line(record) == (
+        "clair_sample,node=9d02faee-4260-1377-22ec-936428b572ee,device=ers-co2-sample1 "
+        "co2_ppm=683.0,temperature_celsius=21.5,rel_humidity_percent=40.0 1632220557"
+    )
+
+
+def test_line_protocol_write(monkeypatch):
+    sink = sinks.LineProtocolSink("http://localhost:8428/write?db=clair")
+    posted = []
+
+    class _Response:
+        def raise_for_status(self):
+            pass
+
+    def _post(url, data, timeout):
+        posted.append((url, data))
+        return _Response()
+
+    monkeypatch.setattr(sink._session, "post", _post)
+    sink.write([_record(683), _record(711, timestamp_s=1632220857)])
+    [(url, body)] = posted
+    assert url == "http://localhost:8428/write?db=clair&precision=s"
+    assert len(body.splitlines()) == 2
+
+
+def test_ndjson_rotation(tmp_path):
+    path = str(tmp_path / "samples.ndjson")
+    sink = sinks.NdjsonSink(path, max_bytes=200, backup_count=2)
+    for co2 in range(400, 410):
+        sink.write([_record(co2)])
+    sink.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "samples.ndjson",
+        "samples.ndjson.1",
+        "samples.ndjson.2",
+    ]
+    with open(path + ".1") as fd:
+        first = json.loads(fd.readline())
+    assert first["device"] == "ers-co2-sample1"
+    assert first["node"] == "9d02faee-4260-1377-22ec-936428b572ee"
+
+
+def test_create_sink(tmp_path):
+    assert isinstance(sinks.create_sink("ndjson:" + str(tmp_path / "s.ndjson")), sinks.NdjsonSink)
+    assert isinstance(sinks.create_sink("influx:http://localhost:8086/write?db=clair"), sinks.LineProtocolSink)
+    for spec in ["ndjson", "kafka:localhost:9092", "mqtt://"]:
+        with pytest.raises(sinks.SinkException):
+            sinks.create_sink(spec)
+
+
+def test_retry():
+    sink = _ListSink("flaky", failures=2)
+    buffered = sinks.BufferedSink(sink, batch_size=10, flush_interval=0.01, backoff=0.01)
+    buffered.start()
+    for co2 in (683, 711):
+        buffered.submit(_record(co2))
+    deadline = time.monotonic() + 5
+    while not sink.written and time.monotonic() < deadline:
+        time.sleep(0.01)
+    buffered.stop()
+    assert [r.attributes["co2_ppm"] for r in sink.written] == [683, 711]
+    assert sink.closed
+
+
+def test_flush_on_stop():
+    sink = _ListSink("slow")
+    buffered = sinks.BufferedSink(sink, batch_size=2, flush_interval=10)
+    buffered.start()
+    for co2 in range(400, 405):
+        buffered.submit(_record(co2))
+    buffered.stop()
+    assert len(sink.written) == 5
+
+
+def test_batches_wait_for_flush_interval():
+    sink = _ListSink("batched")
+    buffered = sinks.BufferedSink(sink, batch_size=3, flush_interval=0.5)
+    buffered.start()
+    # samples trickling in are collected until the batch is full or the interval passed
+    for co2 in range(400, 405):
+        buffered.submit(_record(co2))
+        time.sleep(0.02)
+    deadline = time.monotonic() + 5
+    while len(sink.written) < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    buffered.stop()
+    assert sink.batch_sizes == [3, 2]
+
+
+def test_slow_sink_does_not_block_others():
+    block = threading.Event()
+    slow, fast = _ListSink("slow", block=block), _ListSink("fast")
+    buffered_sinks = [
+        # the first sample blocks the slow sink, instead of waiting for a batch
+        sinks.BufferedSink(slow, batch_size=1, flush_interval=0.01, queue_size=2),
+        sinks.BufferedSink(fast, flush_interval=0.01, queue_size=2),
+    ]
+    for buffered in buffered_sinks:
+        buffered.start()
+    handler = node_handler.ErsForwardingHandler(
+        FakeTtnClient(), "http://localhost:8888/ingest/v1/"
+    )
+    handler._post_sample = lambda sample, device_uuid: None
+    handler.sinks = buffered_sinks
+    for __ in range(3):
+        handler._handle_message(rx_message("0602C70602AB"))
+        # let the fast sink keep up with its small queue
+        while buffered_sinks[1]._queue.qsize():
+            block.wait(0.01)
+    block.set()
+    for buffered in buffered_sinks:
+        buffered.stop()
+    assert len(fast.written) == 6
+    # the slow sink dropped what did not fit its queue
+    assert 2 <= len(slow.written) < 6
+    assert fast.written[0].device_id == "ers-co2-sample1"
+
+
+def test_stop_with_timeout():
+    block = threading.Event()
+    sink = _ListSink("stuck", block=block)
+    buffered = sinks.BufferedSink(sink, flush_interval=0.01)
+    buffered.start()
+    buffered.submit(_record(683))
+    time.sleep(0.05)
+    assert not buffered.stop(timeout=0.01)
+    assert not sink.closed
+    block.set()
@@ -0,0 +1,94 @@
+import clairttn.storage as storage
+import datetime as dt
+import json
+import os
+import pytest
+from tests.storage_stub import StorageStub, uplink
+
+
+def _utc(value):
+    return dt.datetime.fromisoformat(value).replace(tzinfo=dt.timezone.utc)
+
+
+class TestDurations:
+    def test_parse(self):
+        assert storage.parse_duration("24h") == dt.timedelta(hours=24)
+        assert storage.parse_duration("1h30m") == dt.timedelta(minutes=90)
+        assert storage.parse_duration("7d") == dt.timedelta(days=7)
+
+    def test_invalid(self):
+        for duration in ["", "24", "h", "1x"]:
+            with pytest.raises(ValueError):
+                storage.parse_duration(duration)
+
+    def test_split_windows(self):
+        windows = storage.split_windows(
+            _utc("2021-09-21 00:00"), _utc("2021-09-21 02:30"), dt.timedelta(hours=1)
+        )
+        assert windows == [
+            (_utc("2021-09-21 00:00"), _utc("2021-09-21 01:00")),
+            (_utc("2021-09-21 01:00"), _utc("2021-09-21 02:00")),
+            (_utc("2021-09-21 02:00"), _utc("2021-09-21 02:30")),
+        ]
+
+
+UPLINKS = [
+    uplink("dev-{}".format(i), "A81758FFFE052B0F", "06 02 C7 06 02 AB",
+           "2021-09-21T{:02d}:15:00Z".format(i), f_cnt=i)
+    for i in range(6)
+]
+
+
+class TestWindowedFetcher:
+    def _fetch(self, stub, work_dir):
+        windows = storage.split_windows(
+            _utc("2021-09-21 00:00"), _utc("2021-09-21 06:00"), dt.timedelta(hours=2)
+        )
+        fetcher = storage.WindowedFetcher(
+            storage.create_session(), storage.uplink_url(stub.base_url, "test-app"),
+            storage.request_headers("secret"), str(work_dir), jobs=3)
+        uplinks = []
+        for spool_path in fetcher.fetch(windows):
+            with open(spool_path, "rb") as fd:
+                uplinks.extend(storage.iter_uplinks(fd))
+        return uplinks
+
+    def test_merged_in_order(self, tmp_path):
+        with StorageStub(UPLINKS) as stub:
+            uplinks = self._fetch(stub, tmp_path)
+        assert [u["uplink_message"]["f_cnt"] for u in uplinks] == list(range(6))
+        assert len(stub.requests) == 3
+        path, query = stub.requests[0]
+        assert path == "/api/v3/as/applications/test-app/packages/storage/uplink_message"
+        assert query["order"] == "received_at"
+
+    def test_resume(self, tmp_path):
+        with StorageStub(UPLINKS) as stub:
+            self._fetch(stub, tmp_path)
+            # simulate an export interrupted before the last window was fetched
+            os.remove(tmp_path / "window-000002.ndjson")
+            stub.requests.clear()
+            uplinks = self._fetch(stub, tmp_path)
+        assert [u["uplink_message"]["f_cnt"] for u in uplinks] == list(range(6))
+        assert len(stub.requests) == 1
+        assert stub.requests[0][1]["after"].startswith("2021-09-21T04:00:00")
+        with open(tmp_path / "cursor.json") as fd:
+            assert json.load(fd)["completed"] == [0, 1, 2]
+
+    def test_stored_before(self, tmp_path):
+        with StorageStub(UPLINKS) as stub:
+            self._fetch(stub, tmp_path)
+            fetcher = storage.WindowedFetcher(
+                storage.create_session(), storage.uplink_url(stub.base_url, "test-app"),
+                storage.request_headers("secret"), str(tmp_path))
+            # a finished export is not resumed
+            assert fetcher.stored_before() is None
+            with open(tmp_path / "cursor.json") as fd:
+                cursor = json.load(fd)
+            with open(tmp_path / "cursor.json", "w") as fd:
+                json.dump(dict(cursor, completed=[0, 1]), fd)
+            assert fetcher.stored_before() == _utc("2021-09-21 06:00")
+            other_app = storage.WindowedFetcher(
+                storage.create_session(), storage.uplink_url(stub.base_url, "other-app"),
+                storage.request_headers("secret"), str(tmp_path))
+            assert other_app.stored_before() is None
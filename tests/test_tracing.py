@@ -0,0 +1,170 @@
+import clairttn.tracing as tracing
+import clairttn.profiling as profiling
+import clairttn.ttn_handler as ttn_handler
+import clairttn.workers as workers
+import json
+import os
+import pstats
+import tracemalloc
+import pytest
+import threading
+import time
+import types
+
+
+UPLINK_MESSAGE = {
+    "end_device_ids": {
+        "device_id": "clairfeatherprotored",
+        "application_ids": {"application_id": "clairchen-test"},
+        "dev_eui": "9876B600001193E0",
+    },
+    "correlation_ids": [
+        "as:up:01FG1JPY8VGZWRTHPJGY4Y41VM",
+        "ns:uplink:01FG1JPY2DYSQ25A54MTNHWRXZ",
+    ],
+    "received_at": "2021-09-20T12:25:53.180595270Z",
+    "uplink_message": {
+        "f_port": 1,
+        "f_cnt": 2621,
+        "frm_payload": "Aie0KLQotA==",
+        "settings": {"data_rate_index": 3},
+        "received_at": "2021-09-20T12:25:52.973476075Z",
+    },
+}
+
+
+def _mqtt_message():
+    return types.SimpleNamespace(
+        topic="v3/clairchen-test@ttn/devices/clairfeatherprotored/up",
+        payload=json.dumps(UPLINK_MESSAGE).encode("utf8"),
+    )
+
+
+class TestTracing:
+    def test_disabled(self):
+        tracer = tracing.Tracer()
+        with tracer.start_trace("receive") as span:
+            assert span is tracing.NULL_SPAN
+            assert tracer.span("decode") is tracing.NULL_SPAN
+
+    def test_message_spans(self, tmp_path, monkeypatch):
+        trace_file = tmp_path / "traces.jsonl"
+        tracer = tracing.Tracer()
+        tracer.configure(tracing.FileExporter(str(trace_file), flush_interval=0.1))
+        monkeypatch.setattr(tracing, "TRACER", tracer)
+
+        v3_handler = ttn_handler.TtnV3Handler("dummy", "dummy")
+
+        def _handle_message(rx_message):
+            with tracing.TRACER.span("decode"):
+                pass
+
+        v3_handler.handle_message = _handle_message
+        v3_handler._on_message(None, None, _mqtt_message())
+        tracer.shutdown()
+
+        spans = {}
+        for line in trace_file.read_text().splitlines():
+            request = json.loads(line)
+            for span in request["resourceSpans"][0]["scopeSpans"][0]["spans"]:
+                spans[span["name"]] = span
+        assert set(spans) == {"receive", "extract", "decode"}
+        root = spans["receive"]
+        assert "parentSpanId" not in root
+        assert spans["extract"]["parentSpanId"] == root["spanId"]
+        assert spans["decode"]["traceId"] == root["traceId"]
+        attributes = {a["key"]: a["value"] for a in root["attributes"]}
+        correlation_ids = attributes["ttn.correlation_ids"]["arrayValue"]["values"]
+        assert correlation_ids[0] == {"stringValue": "as:up:01FG1JPY8VGZWRTHPJGY4Y41VM"}
+        assert attributes["device.eui"] == {"stringValue": "9876b600001193e0"}
+
+
+    def test_worker_errors(self, tmp_path, monkeypatch):
+        trace_file = tmp_path / "traces.jsonl"
+        tracer = tracing.Tracer()
+        tracer.configure(tracing.FileExporter(str(trace_file), flush_interval=0.1))
+        monkeypatch.setattr(tracing, "TRACER", tracer)
+
+        v3_handler = ttn_handler.TtnV3Handler("dummy", "dummy")
+        v3_handler.worker_pool = workers.WorkerPool(1)
+        v3_handler.worker_pool.start()
+
+        def _handle_message(rx_message):
+            raise ValueError("backend down")
+
+        v3_handler.handle_message = _handle_message
+        v3_handler._on_message(None, None, _mqtt_message())
+        assert v3_handler.worker_pool.stop(5)
+        tracer.shutdown()
+
+        spans = {}
+        for line in trace_file.read_text().splitlines():
+            request = json.loads(line)
+            for span in request["resourceSpans"][0]["scopeSpans"][0]["spans"]:
+                spans[span["name"]] = span
+        assert spans["handle"]["parentSpanId"] == spans["receive"]["spanId"]
+        attributes = {a["key"]: a["value"] for a in spans["handle"]["attributes"]}
+        assert attributes["error"] == {"stringValue": "backend down"}
+
+
+class TestProfiling:
+    def test_cprofile(self, tmp_path, monkeypatch):
+        profiler = profiling.Profiler(output_dir=str(tmp_path))
+        monkeypatch.setattr(profiling, "PROFILER", profiler)
+        v3_handler = ttn_handler.TtnV3Handler("dummy", "dummy")
+        v3_handler.handle_message = lambda rx_message: None
+
+        path = profiler.start("cprofile", seconds=0.2)
+        v3_handler._on_message(None, None, _mqtt_message())
+        for __ in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+
+        stats = pstats.Stats(path)
+        assert any(
+            function_name == "_extract_rx_message"
+            for __, __, function_name in stats.stats
+        )
+
+    def test_threads_merged(self, tmp_path):
+        profiler = profiling.Profiler(output_dir=str(tmp_path))
+
+        def _first():
+            pass
+
+        def _second():
+            pass
+
+        path = profiler.start("cprofile", seconds=0.2)
+        threads = [
+            threading.Thread(target=profiler.runcall, args=(function,))
+            for function in (_first, _second)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for __ in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+
+        function_names = {function_name for __, __, function_name in pstats.Stats(path).stats}
+        assert {"_first", "_second"} <= function_names
+
+    def test_invalid_seconds(self, tmp_path, monkeypatch):
+        profiler = profiling.Profiler(output_dir=str(tmp_path))
+        monkeypatch.setattr(profiling, "PROFILER", profiler)
+        for seconds in ("1e12", "nan", "inf", "0", "-1"):
+            status, __, __ = profiling.profile_route({"kind": "tracemalloc", "seconds": seconds})
+            assert status == 400
+        assert not tracemalloc.is_tracing()
+        status, __, __ = profiling.profile_route({"kind": "cprofile", "seconds": "0.1"})
+        assert status == 202
+
+    def test_busy(self, tmp_path):
+        profiler = profiling.Profiler(output_dir=str(tmp_path))
+        profiler.start("tracemalloc", seconds=0.1)
+        with pytest.raises(profiling.ProfilerBusyException):
+            profiler.start("cprofile")
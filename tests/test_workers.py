@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+import clairttn.ttn_handler as ttn_handler
+import clairttn.workers as workers
+from tests.storage_stub import uplink
+
+
+def test_per_key_order():
+    pool = workers.WorkerPool(workers=3, queue_size=10)
+    handled = []
+    lock = threading.Lock()
+
+    def _handle(key, i):
+        with lock:
+            handled.append((key, i, threading.current_thread().name))
+
+    pool.start()
+    for i in range(50):
+        for key in ["a", "b", "c", "d"]:
+            pool.submit(key, _handle, key, i)
+    pool.stop()
+
+    assert len(handled) == 200
+    for key in ["a", "b", "c", "d"]:
+        by_key = [(i, thread) for k, i, thread in handled if k == key]
+        assert [i for i, __ in by_key] == list(range(50))
+        # all uplinks of a device are handled by the same worker
+        assert len({thread for __, thread in by_key}) == 1
+
+
+class _MqttMessage:
+    def __init__(self, ttn_rxmsg):
+        self.topic = "v3/app@ttn/devices/{}/up".format(ttn_rxmsg["end_device_ids"]["device_id"])
+        self.payload = json.dumps(ttn_rxmsg).encode("utf8")
+
+
+def test_applications_share_the_pool():
+    pool = workers.WorkerPool(workers=2)
+    handled = []
+    handlers = []
+    for app_id in ["clairchen-test", "elsys-ers-co2"]:
+        handler = ttn_handler.TtnV3Handler(app_id, "key", "Clair-Berlin-" + app_id)
+        handler.worker_pool = pool
+        handler.handle_message = lambda rx_message, app_id=app_id: handled.append(
+            (app_id, rx_message.device_id, threading.current_thread().name)
+        )
+        handlers.append(handler)
+
+    pool.start()
+    for i, handler in enumerate(handlers):
+        device_id = "device-{}".format(i)
+        handler._process_message(_MqttMessage(
+            uplink(device_id, "a81758fffe05000{}".format(i), "0602C7", "2021-09-21T10:00:00Z")
+        ))
+    pool.stop()
+
+    assert sorted(h[:2] for h in handled) == [
+        ("clairchen-test", "device-0"),
+        ("elsys-ers-co2", "device-1"),
+    ]
+    assert all(h[2].startswith("worker-") for h in handled)
+    assert handlers[0].metrics.messages is not handlers[1].metrics.messages
+
+
+def test_stop_with_timeout():
+    pool = workers.WorkerPool(workers=1, queue_size=10)
+    release = threading.Event()
+    handled = []
+    pool.start()
+    pool.submit("a", release.wait)
+    for i in range(3):
+        pool.submit("a", handled.append, i)
+    # the blocked task keeps the queued ones from being handled in time
+    assert not pool.stop(timeout=0.05)
+    assert handled == []
+    release.set()
+    assert pool.stop(timeout=5)
+    assert handled == [0, 1, 2]
+
+
+def test_drain_without_pool():
+    handler = ttn_handler.TtnV3Handler("app", "key")
+    assert handler.drain(timeout=0)
+    with handler._handle_lock:
+        assert not handler.drain(timeout=0.01)
+
+
+def test_submit_gives_up_when_stopping():
+    pool = workers.WorkerPool(workers=1, queue_size=1)
+    release = threading.Event()
+    pool.start()
+    pool.submit("a", release.wait)
+    # wait until the worker took the blocking task, then fill the queue
+    while pool.depth():
+        time.sleep(0.01)
+    assert pool.submit("a", lambda: None)
+    results = []
+    submitter = threading.Thread(target=lambda: results.append(pool.submit("a", lambda: None)))
+    submitter.start()
+    assert not pool.stop(timeout=0.05)
+    submitter.join(5)
+    assert results == [False]
+    release.set()
+    assert pool.stop(timeout=5)
+
+
+def test_disconnect_with_timeout(monkeypatch):
+    handler = ttn_handler.TtnV3Handler("app", "key")
+    release = threading.Event()
+    # the MQTT client thread is stuck in a message callback
+    monkeypatch.setattr(handler._mqtt_client, "loop_stop", release.wait)
+    assert not handler.disconnect_and_close(timeout=0.05)
+    release.set()